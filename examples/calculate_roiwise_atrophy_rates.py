@@ -3,7 +3,7 @@ import numpy as np
 import pandas as pd
 import os
 from os.path import join, exists
-from scipy.stats import linregress
+from anapyze.core.atlas import load_atlas_index
 
 
 df = pd.read_csv("vallecas_dataframe.csv")
@@ -12,12 +12,10 @@ parent_dir = os.path.dirname(os.getcwd())
 
 
 atlas_niigz = join(parent_dir, 'resources', 'atlas', 'Harvard_Oxford_cat12_1.5mm_LZ.nii.gz')
-atlas_img = nib.load(atlas_niigz)
-atlas_data = atlas_img.get_fdata().astype(np.int16) # Convert to integer type
 
-# Find all unique ROI labels in the atlas, excluding the background (0)
-roi_labels = np.unique(atlas_data)
-roi_labels = roi_labels[roi_labels != 0]
+# Voxels of every ROI (background 0 excluded), cached after the first run
+atlas_index = load_atlas_index(atlas_niigz)
+roi_labels = atlas_index.labels
 
 
 all_subject_slopes = []
@@ -39,8 +37,9 @@ for subject_ in pd.unique(df['subj']):
         visit_img_path = join(subj_dir, visit_, 'mri', f'smwp1{subj_str}_T1_{visit_}.nii')
         
         if exists(visit_img_path):
-            img_data = nib.load(visit_img_path).get_fdata()
-            visit_data.append({'time': time_, 'data': img_data})
+            # Mean GM value of every ROI at this time point
+            roi_means = atlas_index.reduce(visit_img_path, "mean")
+            visit_data.append({'time': time_, 'data': roi_means})
 
     if len(visit_data) < 2:
         
@@ -53,17 +52,11 @@ for subject_ in pd.unique(df['subj']):
     
     subject_slopes = {'subj': subject_}
 
-    # Loop through each ROI label
-    for roi in roi_labels:
-        # Get the boolean mask for the current ROI
-        roi_mask = (atlas_data == roi)
-        
-        # Extract the mean GM value within the ROI mask for each time point
-        roi_vols = [np.mean(v['data'][roi_mask]) for v in visit_data]
-        
-        # Calculate the slope (rate of change) for this ROI's time-series
-        slope, intercept, r_value, p_value, std_err = linregress(times_array, roi_vols)
-        
+    # Slope (rate of change) of every ROI's time-series in one least-squares fit
+    roi_vols = np.vstack([v['data'] for v in visit_data])
+    slopes = np.polyfit(times_array, roi_vols, 1)[0, :]
+
+    for roi, slope in zip(roi_labels, slopes):
         subject_slopes[f'roi_{int(roi)}_slope'] = slope
 
     all_subject_slopes.append(subject_slopes)
@@ -96,15 +89,15 @@ for group in ["Low", "Intermediate", "Elevated"]:
     
     avg_slopes_for_group = group_df.drop(columns=['subj', 'ptau_C2N_2cut']).mean()
 
-    group_avg_slope_map = np.zeros_like(atlas_data, dtype=np.float32)
+    group_avg_slopes_by_roi = np.zeros(atlas_index.n_labels, dtype=np.float32)
 
     for col_name, avg_slope in avg_slopes_for_group.items():
 
         roi_label = int(col_name.replace('roi_', '').replace('_slope', ''))
 
-        group_avg_slope_map[atlas_data == roi_label] = avg_slope
+        group_avg_slopes_by_roi[atlas_index.positions(roi_label)[0]] = avg_slope
 
 
     output_filename = join(cohort_dir, f'average_roi_slope_map_{group}_C2N.nii.gz')
-    avg_slope_img = nib.Nifti1Image(group_avg_slope_map, atlas_img.affine)
+    avg_slope_img = atlas_index.paint(group_avg_slopes_by_roi)
     nib.save(avg_slope_img, output_filename)
\ No newline at end of file
@@ -4,6 +4,8 @@ import pandas as pd
 import os
 from os.path import join, exists
 from anapyze.core import utils, processor
+from anapyze.core.cohort import CohortCube
+from anapyze.core.image_access import get_volume
 
 df = pd.read_csv("vallecas_dataframe.csv")
 
@@ -16,7 +18,7 @@ parent_dir = os.path.dirname(os.getcwd())
 
 mask_niigz = join(parent_dir, 'resources', 'mask', 'gm_cat12.nii.gz')
 mask_img = nib.load(mask_niigz)
-mask_data = mask_img.get_fdata()[:,:,:,0]
+mask_data = get_volume(mask_img)
 
 template_img_path = '/mnt/nasneuro_share/data/derivatives/CAT12_cross/PVallecas/0001/V01/mri/smwp10001_T1_V01.nii'
 template_img = nib.load(template_img_path)
@@ -43,60 +45,58 @@ for root, dirs, i_files in os.walk(cohort_dir):
 
 processor.smooth_images_spm(images_to_smooth, [smoothing,smoothing,smoothing], mfile_name, spm_path=spm_path)
 
-print("Calculate slope image for each subject...")
+print("Packing the smoothed visits into a cohort cube...")
 
-for subject_ in pd.unique(df['subj']):
+visit_imgs = []
+visit_ids = []
+visit_times = {}
 
-    subj_str = f'{subject_:04d}'
+for index_, row_ in df.iterrows():
 
-    subj_df = df.loc[df['subj'] == subject_]
-    subj_dir = join(cohort_dir, str(subj_str))
+    subj_str = f'{row_["subj"]:04d}'
+    visit_ = "V" + row_['subj+vis'][-2:]
 
-    subj_imgs_ = []
-    times_ = []
-    
-    for index_, row_ in subj_df.iterrows():
+    visit_img_path = join(cohort_dir, subj_str, visit_, 'mri', f'smwp1{subj_str}_T1_{visit_}.nii')
 
-        visit_ = "V" + row_['subj+vis'][-2:]
-        time_ = row_['yrs_from_mribl']
+    if exists(visit_img_path):
+        visit_imgs.append(visit_img_path)
+        visit_ids.append(f'{subj_str}_{visit_}')
+        visit_times[f'{subj_str}_{visit_}'] = row_['yrs_from_mribl']
 
-        visit_img_path = join(subj_dir,visit_, 'mri', f'smwp1{subj_str}_T1_{visit_}.nii')
-        
-        if exists(visit_img_path):
-            visit_img_ = nib.load(visit_img_path)
-            visit_img_data = visit_img_.get_fdata()
+cube_dir = join(cohort_dir, 'cube_smwp1')
 
-            subj_imgs_.append(visit_img_data)
+cube = CohortCube(cube_dir) if exists(join(cube_dir, 'meta.json')) else None
 
-            # Potential improvement calculate volume at each visit as a percentage of the first visit
-            # This way the slope will be a %change/year
+# the cube is rebuilt when visits were added or removed since it was packed
+if cube is None or cube.subject_ids != visit_ids or cube.sources != visit_imgs:
+    cube = CohortCube.build(cube_dir, visit_imgs, nib.Nifti1Image(mask_data, mask_img.affine), visit_ids,
+                            overwrite=True)
 
-            
-            times_.append(time_)
+print("Calculate slope image for each subject...")
 
-            
-    if len(subj_imgs_)>2:
-        
-        print(subject_)
+for subject_ in pd.unique(df['subj']):
 
-        subj_4d_data = np.stack(subj_imgs_, axis=0)
-        times_array = np.array(times_)
+    subj_str = f'{subject_:04d}'
+    subj_dir = join(cohort_dir, str(subj_str))
 
-        mask_indices = np.where(mask_data == 1)
+    # Potential improvement calculate volume at each visit as a percentage of the first visit
+    # This way the slope will be a %change/year
+    subj_visits = [v for v in cube.subject_ids if v.startswith(subj_str + '_')]
 
-        masked_voxel_timeseries = subj_4d_data[:, mask_indices[0], mask_indices[1], mask_indices[2]]
+    if len(subj_visits) > 2:
 
-        fit_coeffs = np.polyfit(times_array, masked_voxel_timeseries, 1)
+        print(subject_)
 
-        slopes = fit_coeffs[0, :]
+        rows = cube.subject_index(subj_visits)
+        times_array = np.array([visit_times[v] for v in subj_visits])
 
-        subject_slope_map = np.zeros_like(mask_data, dtype=np.float32)
+        slopes = np.zeros(cube.n_voxels, dtype=np.float32)
 
-        subject_slope_map[mask_indices] = slopes
+        for voxels, block in cube.iter_voxel_blocks(subjects=rows):
+            slopes[voxels] = np.polyfit(times_array, block, 1)[0, :]
 
         output_filename = join(subj_dir, f'slope_map_{subject_}.nii.gz')
-        slope_img = nib.Nifti1Image(subject_slope_map, template_img.affine)
-        nib.save(slope_img, output_filename)
+        nib.save(cube.to_image(slopes), output_filename)
 
 
 print("Calculate average slope by group...")
@@ -0,0 +1,67 @@
+"""
+Per-subject PET preprocessing written as a DAG instead of numbered scripts.
+
+Each stage only declares what it needs and what it writes for one subject.
+The scheduler runs the (subject, stage) nodes concurrently within the CPU and
+memory budget and skips every node whose outputs already exist, so the script
+can be re-run after adding subjects or after an interruption.
+"""
+
+import os
+from os.path import join, exists
+import nibabel as nib
+from anapyze.core import utils, processor, smoothing
+from anapyze.core.pipeline import Stage, Pipeline
+
+dir_patients = r'/Volumes/txusser_data/IBIS_DATA/Reorder_New/FDG'
+spm_path = r'/Users/jsilva/software/spm12'
+smoothing_fwhm = 8
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+template_fdg_nii = join(dir_patients, 'FDG_PET_template.nii')
+template_fdg_img = nib.load(join(parent_dir, 'resources', 'templates', 'FDG_PET_template.nii.gz'))
+mask_img = nib.load(join(parent_dir, 'resources', 'mask', 'mask_nc.nii.gz'))
+
+if not exists(template_fdg_nii):
+    nib.save(template_fdg_img, template_fdg_nii)
+
+
+def subj_file(subject, name):
+    return join(dir_patients, subject, name)
+
+
+def clean(subject):
+    img_ = utils.remove_nan_negs(nib.load(subj_file(subject, 'fdg.nii')))
+    nib.save(img_, subj_file(subject, 'cfdg.nii'))
+
+
+def normalize(subject):
+    processor.old_normalize_spm(subj_file(subject, 'cfdg.nii'), template_fdg_nii,
+                                subj_file(subject, 'fdg_spatial_norm.m'), spm_path = spm_path)
+
+
+def smooth(subject):
+    smoothed = smoothing.smooth_image(nib.load(subj_file(subject, 'wcfdg.nii')), smoothing_fwhm)
+    nib.save(smoothed, subj_file(subject, 'swcfdg.nii'))
+
+
+def intensity_normalize(subject):
+    norm_value, norm_img = processor.intensity_normalize_pet_histogram(
+        nib.load(subj_file(subject, 'swcfdg.nii')), template_fdg_img, mask_img)
+    nib.save(norm_img, subj_file(subject, 'swcfdg_normhist.nii'))
+
+
+stages = [
+    Stage('clean', clean, outputs = lambda s: [subj_file(s, 'cfdg.nii')],
+          inputs = lambda s: [subj_file(s, 'fdg.nii')]),
+    Stage('normalize', normalize, outputs = lambda s: [subj_file(s, 'wcfdg.nii')], after = 'clean',
+          mem_gb = 4),
+    Stage('smooth', smooth, outputs = lambda s: [subj_file(s, 'swcfdg.nii')], after = 'normalize'),
+    Stage('intensity_normalize', intensity_normalize, outputs = lambda s: [subj_file(s, 'swcfdg_normhist.nii')],
+          after = 'smooth'),
+]
+
+subjects = sorted(d for d in os.listdir(dir_patients) if os.path.isdir(join(dir_patients, d)))
+
+status = Pipeline(stages).run(subjects, max_cpus = 8, max_mem_gb = 16)
+status.to_csv(join(dir_patients, 'pipeline_status.csv'), index = False)
@@ -10,6 +10,7 @@ import numpy as np
 import time
 from datetime import datetime
 import nilearn.image as proc
+from anapyze.core.image_access import get_data
 
 """
 This script corrects distortions in the DTI data using 'dipy', 'nilearn', and 'nibabel' libraries along with ANTs software. 
@@ -81,10 +82,8 @@ for i in list_dirs:
             ants_log = 'ANTs_log.txt'
 
             img_4d = nib.load(dti_source)
-            # Get the 4D data array
-            data_4d = img_4d.get_fdata()
-            # Extract the first frame (3D) from the 4D data
-            data_3d = data_4d[:, :, :, 0]
+            # Read only the first frame (3D) of the 4D data
+            data_3d = get_data(img_4d, frame = 0)
 
             # Create a new 3D NIfTI image with the same header as the original 4D image
             img_3d = nib.Nifti1Image(data_3d, img_4d.affine, img_4d.header)
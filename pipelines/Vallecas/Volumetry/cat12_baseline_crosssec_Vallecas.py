@@ -5,6 +5,7 @@ import os, sys
 from os.path import join, exists
 import shutil
 from anapyze.core import processor
+from anapyze.core.cache import ResultCache, file_digest
 
 warnings.filterwarnings("ignore")
 
@@ -25,9 +26,19 @@ baseline_dir = r'/mnt/nasneuro_share/data/derivatives/CAT12_baseline'
 
 tpm = r'/mnt/WORK/software/spm12/tpm/TPM.nii'
 template_volumes = r'/mnt/WORK/software/spm12/toolbox/cat12/templates_MNI152NLin2009cAsym/Template_0_GS.nii'
+
+# Subjects with a final GM image are skipped as before. The others are restored from the cache
+# when their T1 was already segmented with the same parameters, templates (by content) and CAT12
+# version, so changing any of them reprocesses the subjects. The whole CAT12 output set
+# (mri, report, label, surf, ...) is cached and restored.
+cache = ResultCache(join(baseline_dir, '.anapyze_cache'), max_size_gb = 200)
+cat12_version = 'CAT12.9'
+cat12_params = {'output_vox_size': 1.5, 'bounding_box': 'cat12', 'surface_processing': 0,
+                'tpm': file_digest(tpm), 'template_volumes': file_digest(template_volumes)}
 #---------------------------------------------------------------------------------------------------------------
 
 imgs_to_segment = []
+pending_cache = []
 
 for index_, row_ in df_baseline.iterrows():
 
@@ -53,36 +64,51 @@ for index_, row_ in df_baseline.iterrows():
         final_gm = join(dest_dir,'mri','mwp1%s_T1_V0%s.nii' % (fsubject,visit))
         print(final_gm)
 
-        if not exists(final_gm):
-        
-            if not exists(dest_dir):
-                os.makedirs(dest_dir)
+        if exists(final_gm):
+            print(f"Final GM already exists: {fsubject}")
+            continue
 
-            nifti_dest = join(dest_dir,f'{fsubject}_T1_{fvisit}.nii')
+        cache_key = cache.key('cat12_segmentation_crossec', [nifti_img_orginal], cat12_params, cat12_version)
 
-            if format == 'nii.gz':
-                img = nib.load(nifti_img_orginal)
-                nib.save(img, nifti_dest)
-            else:
-                shutil.copy(nifti_img_orginal,nifti_dest)
+        if cache.fetch(cache_key, root = dest_dir) and exists(final_gm):
+            print(f"CAT12 outputs restored from cache: {fsubject}")
+            continue
 
-            print(nifti_dest)
+        if not exists(dest_dir):
+            os.makedirs(dest_dir)
 
-            if exists(nifti_dest):
-                print('OK!')
+        nifti_dest = join(dest_dir,f'{fsubject}_T1_{fvisit}.nii')
 
-            imgs_to_segment.append(nifti_dest)
-    
-    else:
-        print(f"Final GM already exists: {fsubject}")
+        if format == 'nii.gz':
+            img = nib.load(nifti_img_orginal)
+            nib.save(img, nifti_dest)
+        else:
+            shutil.copy(nifti_img_orginal,nifti_dest)
 
-processor.cat12_segmentation_crossec(imgs_to_segment, mfile_name,
-                                      template_tpm = tpm, template_volumes = template_volumes,
-                                      output_vox_size = 1.5, bounding_box = "cat12", surface_processing = 0,
-                                      spm_path="/mnt/WORK/software/spm12")
+        print(nifti_dest)
 
+        if exists(nifti_dest):
+            print('OK!')
 
+        imgs_to_segment.append(nifti_dest)
+        pending_cache.append((cache_key, dest_dir, nifti_dest, final_gm))
 
+    else:
+        print(f"T1 not found: {fsubject}")
+
+if imgs_to_segment:
 
+    processor.cat12_segmentation_crossec(imgs_to_segment, mfile_name,
+                                          template_tpm = tpm, template_volumes = template_volumes,
+                                          output_vox_size = 1.5, bounding_box = "cat12", surface_processing = 0,
+                                          spm_path="/mnt/WORK/software/spm12")
 
+for cache_key, dest_dir, nifti_dest, final_gm in pending_cache:
 
+    if exists(final_gm):
+        # every file CAT12 wrote for the subject, but not the copy of its T1
+        outputs = [join(root, f) for root, _, files in os.walk(dest_dir) for f in files]
+        outputs = [o for o in outputs if o != nifti_dest]
+        cache.store(cache_key, outputs, step = 'cat12_segmentation_crossec', root = dest_dir)
+    else:
+        print(f"Segmentation failed, not cached: {final_gm}")
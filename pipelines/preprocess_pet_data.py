@@ -66,19 +66,24 @@ for i in list_dirs:
 
 processor.smooth_images_spm(images_to_smooth, [smoothing,smoothing,smoothing], mfile_name, spm_path=spm_path)
 
+images_to_normalize = []
+
 for i in list_dirs:
 
     dir_subj = join(dir_patients, i)
 
     fdg_image = join(dir_subj, 'swfdg.nii')
-    fdg_norm = join(dir_subj, 'swfdg_normhist.nii')
 
     if exists(fdg_image):
 
-        norm_value, norm_image =  processor.intensity_normalize_pet_histogram(fdg_image, template_fdg_img, mask_img)
-        nib.save(norm_image, fdg_norm)
+        images_to_normalize.append(fdg_image)
+
+# Writes swfdg_normhist.nii for every subject, the template and mask are read only once
+norm_values = processor.intensity_normalize_pet_histogram_cohort(images_to_normalize, template_fdg_img, mask_img,
+                                                                 output_suffix='_normhist')
+norm_values.to_csv(join(dir_patients, 'fdg_normhist_values.csv'), index=False)
 
-        print("Normalization_Value: ", norm_value)
+print(norm_values)
 
 
 
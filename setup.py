@@ -26,6 +26,12 @@ setup(
         exclude=['pipelines', 'resources', 'examples', '__MACOSX']
     ),
     install_requires=requirements,
+    entry_points={
+        'console_scripts': [
+            'anapyze-profile=anapyze.core.instrumentation:main',
+            'anapyze-fwhm=anapyze.core.resolution:main',
+        ],
+    },
     include_package_data=False,  # set to True if you add data files via MANIFEST.in
     classifiers=[
         'Programming Language :: Python :: 3',
@@ -5,9 +5,23 @@ Statistical analysis routines for anapyze.
 from .two_samples import (
     run_2sample_ttest_spm,
     run_2sample_ttest_cat12_new_tiv_model,
-    run_2sample_ttest_atlas
+    run_2sample_ttest_atlas,
     run_2sample_anova_with_covariate_atlas,
-
+)
+from .glm import (
+    two_sample_design,
+    fit_glm,
+    run_glm,
+)
+from .permutation import (
+    permutation_test,
+    run_permutation_glm,
+)
+from .tfce import (
+    mask_adjacency,
+    tfce_scores,
+    tfce_transform,
+    tfce_image,
 )
 from .correlations import (
     voxel_wise_corr_images_vs_scale,
@@ -21,6 +35,15 @@ __all__ = [
     'run_2sample_ttest_atlas',
     'voxel_wise_corr_images_vs_scale',
     'image_to_image_corr_atlas_based_spearman',
-    'normalized_cross_correlation_2images'
-    ' run_2sample_anova_with_covariate_atlas'
+    'normalized_cross_correlation_2images',
+    'run_2sample_anova_with_covariate_atlas',
+    'two_sample_design',
+    'fit_glm',
+    'run_glm',
+    'permutation_test',
+    'run_permutation_glm',
+    'mask_adjacency',
+    'tfce_scores',
+    'tfce_transform',
+    'tfce_image',
 ]
@@ -1,88 +1,140 @@
 import numpy as np
 import nibabel as nib
-from scipy.stats import pearsonr, spearmanr
+from scipy.stats import spearmanr, rankdata
+from scipy.stats import t as t_dist
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.atlas import LabelIndex
+from anapyze.core.image_access import get_data, get_volume, masked_blocks
+from anapyze.core.multiple_comparisons import correct_pvalues
+from anapyze.core.cohort import CohortCube
 
-def voxel_wise_corr_images_vs_scale(images, scale, mask, corr = "pearson"):
+def _correlation_block(block, scale_z, corr):
+    """Correlation of every column of a subjects x voxels block with a standardized scale, and its
+    two-tailed p-value (t distribution with n - 2 degrees of freedom, as pearsonr and spearmanr)."""
+
+    block = np.asarray(block, dtype = np.float64)
+
+    if corr == "spearman":
+        # average ranks for ties, like spearmanr
+        block = rankdata(block, axis = 0)
+
+    centered = block - block.mean(axis = 0)
+    norms = np.sqrt(np.einsum("ij,ij->j", centered, centered))
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        r = np.clip(scale_z @ centered / norms, -1, 1)
+        df = block.shape[0] - 2
+        t_values = r * np.sqrt(df / ((1 - r) * (1 + r)))
+        p = 2 * t_dist.sf(np.abs(t_values), df)
+
+    return r, p
+
+
+@instrumented
+def voxel_wise_corr_images_vs_scale(images, scale, mask, corr = "pearson", correction = None, alpha = 0.05,
+                                    max_block_mb = 256, n_jobs = 4):
     """
     Computes voxel-wise correlation between a list of 3D NIfTI images and a set of scalar values.
 
+    The correlations of all the voxels are computed at once, in blocks of voxels: for Pearson the
+    voxel values are centered and normalized along the subjects and multiplied by the standardized
+    scale; for Spearman the values (and the scale) are first replaced by their ranks, with average
+    ranks for ties. The p-values come from the t distribution with n - 2 degrees of freedom, as in
+    `scipy.stats.pearsonr` and `scipy.stats.spearmanr`.
+
     Parameters
     ----------
-    images : List[nibabel.Nifti1Image]
-        List of loaded NIfTI image objects (all must have the same shape and affine). Each element
+    images : List[nibabel.Nifti1Image] or CohortCube
+        List of loaded NIfTI image objects or paths (all must have the same shape and affine). Each element
         represents a subject’s image for which you want to correlate voxel intensities with the
-        provided scale values.
+        provided scale values. A `anapyze.core.cohort.CohortCube` can be given instead, in which
+        case its own mask is used and `mask` must be None.
     scale : Sequence[float]
         A sequence of numeric values (e.g., neuropsychological test scores) of the same length as
         `images`. Each entry corresponds to the scalar value for the subject of the same index
         in `images`.
     mask : nibabel.Nifti1Image
         A binary NIfTI image whose nonzero voxels define the mask region. Correlation is computed
-        only for voxels where `mask.get_fdata() != 0`. Must have the same spatial dimensions as
+        only for voxels where the mask is nonzero. Must have the same spatial dimensions as
         the images in `images`.
     corr : {"pearson", "spearman"}, default "pearson"
         Specifies which correlation coefficient to compute at each voxel:
-        - `"pearson"`: Pearson’s r and two-tailed p-value via `scipy.stats.pearsonr`.
-        - `"spearman"`: Spearman’s rho and two-tailed p-value via `scipy.stats.spearmanr`.
+        - `"pearson"`: Pearson’s r and two-tailed p-value.
+        - `"spearman"`: Spearman’s rho and two-tailed p-value.
+    correction : {None, "fdr_bh", "fdr_by", "holm", "bonferroni"}, default None
+        If given, the p-values of the in-mask voxels are corrected for multiple comparisons
+        (see `anapyze.core.multiple_comparisons.correct_pvalues`) and `corr_p_img` holds the
+        adjusted p-values.
+    alpha : float, default 0.05
+        Level used for the threshold printed when `correction` is given.
+    max_block_mb : float, default 256
+        Memory of one block of voxels (subjects x voxels, float64).
+    n_jobs : int, default 4
+        Number of images read at the same time.
 
     Returns
     -------
     corr_r_img : nibabel.Nifti1Image
         A NIfTI image where each voxel contains the correlation coefficient (r or rho) between
         the intensity values across subjects and the corresponding `scale` values. Voxels outside
-        the mask are set to zero.
+        the mask are set to zero. Voxels with constant values across subjects are NaN.
+        The images are read and the maps computed in float64, as with `pearsonr`/`spearmanr`.
     corr_p_img : nibabel.Nifti1Image
         A NIfTI image where each voxel contains the two-tailed p-value associated with the
         computed correlation. Voxels outside the mask are set to zero.
     """
 
-    mask_data =  mask.get_fdata()
-    
-    sample_img = images[0]
-    sample_data = sample_img.get_fdata()
-
-    corr_r = sample_data * 0
-    corr_p = sample_data * 0
-
-    data = sample_data[..., np.newaxis]
-
-    for image in images[1:]:
-        
-        img_data = image.get_fdata()[..., np.newaxis]
-        data = np.append(data, img_data, axis=3)
-
-    print("Data shape: ", data.shape)
-    print("Mask shape: ", mask_data.shape)
-    print("Scale values: ", len(scale))
-
-    for i in range(sample_data.shape[0]):
-        for j in range(sample_data.shape[1]):
-            for k in range(sample_data.shape[2]):
-                if mask_data[i, j, k] == 0:
-                    pass
-
-                else:
-                    data_array = data[i, j, k, :]
-
-                    if corr == "pearson":
-                        r_, p_ = pearsonr(data_array, scale)
-
-                    elif corr == "spearman":
-                        r_, p_ = spearmanr(data_array, scale)
-
-                    else:
-                        raise ValueError(
-                            "corr variable must be pearson or spearman"
-                        )
-
-                    corr_r[i, j, k] = r_
-                    corr_p[i, j, k] = p_
-
-    corr_r_img = nib.Nifti1Image(corr_r, sample_img.affine, header = sample_img.header)
-    corr_p_img = nib.Nifti1Image(corr_p, sample_img.affine, header = sample_img.header)
+    if corr not in ("pearson", "spearman"):
+        raise ValueError("corr variable must be pearson or spearman")
+
+    scale = np.asarray(scale, dtype = np.float64)
+    if corr == "spearman":
+        scale = rankdata(scale)
+    scale_z = scale - scale.mean()
+    scale_z = scale_z / np.sqrt(scale_z @ scale_z)
+
+    if isinstance(images, CohortCube):
+        if mask is not None:
+            raise ValueError("The mask of a CohortCube is the mask it was built with")
+        mask_data = images.mask
+        shape, affine, header = images.shape, images.affine, None
+        blocks = ((np.arange(voxels.start, voxels.stop), block)
+                  for voxels, block in images.iter_voxel_blocks(max_block_mb = max_block_mb))
+        n_images = images.n_subjects
+    else:
+        mask_data = get_volume(mask) != 0
+        sample_img = nib.load(images[0]) if type(images[0]) is str else images[0]
+        shape, affine, header = sample_img.shape[0:3], sample_img.affine, sample_img.header
+        blocks = masked_blocks(images, mask_data, max_block_mb = max_block_mb, n_jobs = n_jobs,
+                               dtype = np.float64)
+        n_images = len(images)
+
+    if len(scale) != n_images:
+        raise ValueError(f"{len(scale)} scale values for {n_images} images")
+
+    print(f"{n_images} images, {int(mask_data.sum())} voxels in the mask")
+
+    r_values = np.zeros(int(mask_data.sum()), dtype = np.float64)
+    p_values = np.zeros(int(mask_data.sum()), dtype = np.float64)
+
+    for positions, block in blocks:
+        r_values[positions], p_values[positions] = _correlation_block(block, scale_z, corr)
+
+    if correction:
+        p_values, p_threshold = correct_pvalues(p_values, correction, alpha)
+        print(f"{correction} threshold (alpha = {alpha}): p <= {p_threshold:.3g}")
+
+    corr_r = np.zeros(shape, dtype = np.float64)
+    corr_p = np.zeros(shape, dtype = np.float64)
+    corr_r[mask_data] = r_values
+    corr_p[mask_data] = p_values
+
+    corr_r_img = nib.Nifti1Image(corr_r, affine, header = header)
+    corr_p_img = nib.Nifti1Image(corr_p, affine, header = header)
     
     return corr_r_img, corr_p_img
     
+@instrumented
 def image_to_image_corr_atlas_based_spearman(image_1, image_2, atlas):
     """
     Calculates the Spearman correlation coefficient and p-value between two 3D NIfTI images
@@ -95,7 +147,7 @@ def image_to_image_corr_atlas_based_spearman(image_1, image_2, atlas):
         `image_2` and `atlas`.
     image_2 : nibabel.Nifti1Image
         Second input NIfTI image. Must align with `image_1` and `atlas`.
-    atlas : nibabel.Nifti1Image
+    atlas : nibabel.Nifti1Image or LabelIndex
         Atlas NIfTI image defining ROIs. Nonzero integer labels indicate distinct regions;
         voxels labeled 0 are treated as background and ignored.
 
@@ -107,38 +159,18 @@ def image_to_image_corr_atlas_based_spearman(image_1, image_2, atlas):
         Two‐tailed p‐value associated with the computed Spearman correlation.
     """
 
-    # Load the two images + atlas using nibabel library
-    img_1_data = image_1.get_fdata()
-    img_2_data = image_2.get_fdata()
-    atlas_data = atlas.get_fdata()
-
-    # Get the unique values of the atlas, which correspond to the ROIs
-    rois = np.unique(atlas_data)
-
-    # Initialize lists to store the mean values of the images for each ROI
-    img_1_array = []
-    img_2_array = []
-
-    # Loop over the ROIs
-    for i in rois:
-        if i != 0:
-            # Get the indices of the voxels that belong to the current ROI
-            indx = np.where(atlas_data == i)
-
-            # Calculate the mean value of the first image for the current ROI
-            mean_1 = np.mean(img_1_data[indx])
-            # Calculate the mean value of the second image for the current ROI
-            mean_2 = np.mean(img_2_data[indx])
+    atlas_index = atlas if isinstance(atlas, LabelIndex) else LabelIndex.from_image(atlas)
 
-            # Append the mean values to the lists
-            img_1_array.append(mean_1)
-            img_2_array.append(mean_2)
+    # Mean value of each image in every ROI (background label 0 excluded)
+    img_1_array = atlas_index.reduce(image_1, "mean")
+    img_2_array = atlas_index.reduce(image_2, "mean")
 
     # Calculate the spearman correlation coefficient and p-value between the mean values of the images for each ROI
     rho, p = spearmanr(img_1_array, img_2_array)
     
     return rho, p
 
+@instrumented
 def normalized_cross_correlation_2images(img1, img2, no_zeros = True):
     """
     Computes the Normalized Cross-Correlation (NCC) between two 3D NIfTI images.
@@ -161,8 +193,8 @@ def normalized_cross_correlation_2images(img1, img2, no_zeros = True):
     """
 
     # Load Nifti images
-    img1_data = img1.get_fdata()
-    img2_data = img2.get_fdata()
+    img1_data = get_data(img1, dtype = np.float64)
+    img2_data = get_data(img2, dtype = np.float64)
 
     if no_zeros:
     # Get non-zero indices
@@ -171,14 +203,14 @@ def normalized_cross_correlation_2images(img1, img2, no_zeros = True):
         img2_data = img2_data[non_zero_mask]
 
     # Subtract the mean from each image
-    img1_data = img1_data - np.mean(img1_data)
-    img2_data = img2_data - np.mean(img2_data)
+    img1_data = img1_data - np.mean(img1_data, dtype = np.float64)
+    img2_data = img2_data - np.mean(img2_data, dtype = np.float64)
 
     # Calculate the numerator of the NCC equation
-    numerator = np.sum(img1_data * img2_data)
+    numerator = np.sum(img1_data * img2_data, dtype = np.float64)
 
     # Calculate the denominator of the NCC equation  
-    denominator = np.sqrt(np.sum(img1_data ** 2) * np.sum(img2_data ** 2))
+    denominator = np.sqrt(np.sum(img1_data ** 2, dtype = np.float64) * np.sum(img2_data ** 2, dtype = np.float64))
 
     # Calculate and return the NCC
     return numerator / denominator
@@ -0,0 +1,172 @@
+"""
+Mass-univariate GLM estimated in-process, a MATLAB-free alternative to the SPM
+model / estimate / contrast batches.
+
+The design is fitted to every in-mask voxel at once: the pseudo-inverse of the
+design matrix is computed once and applied to blocks of voxels (subjects x voxels
+matrices read slab by slab, or the blocks of a ``CohortCube``), so the memory
+used is bounded by `max_block_mb` whatever the size of the cohort. The maps are
+written with SPM's names (beta_0001.nii ..., ResMS.nii, con_0001.nii,
+spmT_0001.nii, mask.nii), NaN outside the analysis mask.
+
+The model is ordinary least squares with one error variance. SPM's two-sample
+designs written by ``io.spm.generate_mfile_model`` estimate unequal group
+variances (ReML), so the t values match SPM exactly only when the variances of
+the groups are equal.
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+from os.path import join
+
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.image_access import get_volume, masked_blocks
+from anapyze.core.cohort import CohortCube
+
+
+def parse_contrast(contrast):
+    """Contrast weights from an SPM string ("[1 -1 0]") or a sequence of numbers."""
+
+    if type(contrast) is str:
+        contrast = contrast.strip("[] ").replace(",", " ").split()
+
+    return np.asarray(contrast, dtype = np.float64)
+
+
+def two_sample_design(n1: int, n2: int, covariates = ()):
+    """Design matrix of a two-sample t-test: one column per group, then the covariates.
+
+    Covariates are entered without centering or interactions, as in the SPM batches
+    (iCFI = 1), so the group contrast is [1 -1 0 ...].
+
+    :param n1: number of subjects of group 1 (the first n1 rows)
+    :param n2: number of subjects of group 2
+    :param covariates: sequence of covariates, each with n1 + n2 values (group 1 first)
+    :return: (n1 + n2, 2 + n_covariates) float64 array
+    """
+    groups = np.zeros((n1 + n2, 2))
+    groups[0:n1, 0] = 1
+    groups[n1:, 1] = 1
+
+    columns = [np.asarray(c, dtype = np.float64).reshape(-1, 1) for c in covariates]
+    for column in columns:
+        if len(column) != n1 + n2:
+            raise ValueError(f"Covariates must have {n1 + n2} values, got {len(column)}")
+
+    return np.hstack([groups] + columns)
+
+
+def fit_glm(Y, X, contrast):
+    """Fits the GLM to every column of Y.
+
+    :param Y: (n_subjects, n_voxels) data
+    :param X: (n_subjects, n_regressors) design matrix
+    :param contrast: weights of the regressors
+    :return: dict with beta (n_regressors, n_voxels), ResMS, con and t (n_voxels) and df
+    """
+    X = np.asarray(X, dtype = np.float64)
+    contrast = parse_contrast(contrast)
+
+    if contrast.shape != (X.shape[1],):
+        raise ValueError(f"The contrast has {contrast.size} weights, the design {X.shape[1]} regressors")
+
+    pinv_X = np.linalg.pinv(X)
+    df = X.shape[0] - np.linalg.matrix_rank(X)
+    # variance factor of the contrast, c (X'X)^-1 c'
+    c_var = contrast @ pinv_X @ pinv_X.T @ contrast
+
+    Y = np.asarray(Y, dtype = np.float64)
+    beta = pinv_X @ Y
+    residuals = Y - X @ beta
+    res_ms = np.einsum("ij,ij->j", residuals, residuals) / df
+
+    con = contrast @ beta
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        t_values = con / np.sqrt(res_ms * c_var)
+    t_values[res_ms <= 0] = np.nan
+
+    return {"beta": beta, "ResMS": res_ms, "con": con, "t": t_values, "df": df}
+
+
+@instrumented
+def run_glm(images, design, contrast, save_dir, mask = None, max_block_mb = 256, n_jobs = 4):
+    """Estimates a GLM at every voxel and writes the SPM-like maps.
+
+    Voxels where any image is not finite, or with no residual variance, are left out (NaN).
+
+    :param images: list of co-registered images or paths (rows of the design), or a CohortCube
+    :param design: (n_subjects, n_regressors) design matrix, e.g. from ``two_sample_design``
+    :param contrast: t contrast, SPM string ("[1 -1 0]") or weights
+    :param save_dir: output directory (created if needed)
+    :param mask: mask image, array or path; voxels > 0 are analysed. Defaults to every voxel,
+        or to the mask of the cube
+    :param max_block_mb: memory of one block of voxels
+    :param n_jobs: number of images read at the same time
+    :return: dict of output name (beta, ResMS, con, spmT, mask) to path (a list of paths for beta)
+    """
+    design = np.asarray(design, dtype = np.float64)
+    os.makedirs(save_dir, exist_ok = True)
+
+    if isinstance(images, CohortCube):
+        n_subjects = images.n_subjects
+        shape, affine = images.shape, images.affine
+        mask_data = images.mask.copy()
+        if mask is not None:
+            raise ValueError("The analysis mask of a CohortCube is the mask it was built with")
+        blocks = ((np.arange(voxels.start, voxels.stop), block)
+                  for voxels, block in images.iter_voxel_blocks(max_block_mb = max_block_mb))
+    else:
+        n_subjects = len(images)
+        reference = nib.load(images[0]) if type(images[0]) is str else images[0]
+        shape, affine = reference.shape[0:3], reference.affine
+        if mask is None:
+            mask_data = np.ones(shape, dtype = bool)
+        else:
+            if type(mask) is str:
+                mask = nib.load(mask)
+            mask_data = (get_volume(mask) if hasattr(mask, "dataobj") else np.asarray(mask)) > 0
+        if mask_data.shape != shape:
+            raise ValueError(f"Mask shape {mask_data.shape} does not match image shape {shape}")
+        blocks = masked_blocks(images, mask_data, max_block_mb = max_block_mb, n_jobs = n_jobs)
+
+    if design.shape[0] != n_subjects:
+        raise ValueError(f"The design has {design.shape[0]} rows for {n_subjects} images")
+
+    n_voxels = int(mask_data.sum())
+    n_regressors = design.shape[1]
+
+    beta = np.full((n_regressors, n_voxels), np.nan, dtype = np.float32)
+    res_ms = np.full(n_voxels, np.nan, dtype = np.float32)
+    con = np.full(n_voxels, np.nan, dtype = np.float32)
+    t_values = np.full(n_voxels, np.nan, dtype = np.float32)
+
+    for positions, block in blocks:
+
+        valid = np.isfinite(block).all(axis = 0)
+        fit = fit_glm(block[:, valid], design, contrast)
+
+        positions = positions[valid]
+        beta[:, positions] = fit["beta"]
+        res_ms[positions] = fit["ResMS"]
+        con[positions] = fit["con"]
+        t_values[positions] = fit["t"]
+
+    def save(values, name):
+        volume = np.full(shape, np.nan, dtype = np.float32)
+        volume[mask_data] = values
+        path = join(save_dir, name)
+        nib.save(nib.Nifti1Image(volume, affine), path)
+        return path
+
+    outputs = {"beta": [save(beta[i], f"beta_{i + 1:04d}.nii") for i in range(n_regressors)],
+               "ResMS": save(res_ms, "ResMS.nii"),
+               "con": save(con, "con_0001.nii"),
+               "spmT": save(t_values, "spmT_0001.nii")}
+
+    analysed = np.zeros(shape, dtype = np.uint8)
+    analysed[mask_data] = np.isfinite(t_values)
+    outputs["mask"] = join(save_dir, "mask.nii")
+    nib.save(nib.Nifti1Image(analysed, affine), outputs["mask"])
+
+    return outputs
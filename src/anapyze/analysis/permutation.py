@@ -0,0 +1,351 @@
+"""
+Permutation inference with max-statistic FWE correction for GLM designs.
+
+Nuisance regressors are handled with Freedman-Lane: the data are residualised
+against the part of the design not tested by the contrast (Rz), the residuals
+are permuted and the full model is refitted. With G = C X+ and Q an orthonormal
+basis of the design, every statistic of a permutation P is a function of G P Rz
+and Q' P Rz, so a block of B permutations is a single (B (k + r), n) x (n, V)
+matrix product. The blocks run in a process pool; the workers read Rz from a
+temporary memory-mapped file and draw their permutations from children of one
+SeedSequence, so the results depend on `seed` and `block_size` but not on the
+number of workers.
+
+The first permutation is the identity, so p-values are never below
+1 / n_permutations. Rows are assumed exchangeable (no variance groups or blocks).
+
+    result = permutation_test(Y, two_sample_design(n1, n2, [ages]), "[1 -1 0]", n_permutations = 10000)
+    result["p_fwe"]  # FWE-corrected p-value of every column of Y
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.image_access import get_volume, masked_blocks
+from anapyze.core.cohort import CohortCube
+from anapyze.analysis import glm
+from anapyze.analysis.tfce import tfce_transform
+
+_state = {}
+
+
+def _contrast_matrix(contrast):
+
+    if type(contrast) is str:
+        return glm.parse_contrast(contrast).reshape(1, -1)
+
+    return np.atleast_2d(np.asarray(contrast, dtype = np.float64))
+
+
+def _model(X, C, stat):
+    """Matrices shared by every permutation: the rows multiplied by the permuted residuals."""
+
+    X = np.asarray(X, dtype = np.float64)
+    n, p = X.shape
+
+    if C.shape[1] != p:
+        raise ValueError(f"The contrast has {C.shape[1]} weights, the design {p} regressors")
+    if stat == "t" and C.shape[0] != 1:
+        raise ValueError("A t statistic needs a single-row contrast, use stat = 'F'")
+
+    pinv_X = np.linalg.pinv(X)
+    G = C @ pinv_X
+
+    if stat == "F":
+        # whitening of the contrast estimates: ||L' G P Rz||^2 is the F numerator times k
+        L = np.linalg.cholesky(np.linalg.inv(G @ G.T))
+        G = L.T @ G
+    else:
+        G = G / np.sqrt(G @ G.T)
+
+    # nuisance space: the part of the design the contrast does not test
+    Z = X @ (np.eye(p) - np.linalg.pinv(C) @ C)
+    U, s, _ = np.linalg.svd(Z, full_matrices = False)
+    Z_basis = U[:, s > s.max(initial = 0) * max(n, p) * np.finfo(float).eps] if s.size else U[:, 0:0]
+
+    U, s, _ = np.linalg.svd(X, full_matrices = False)
+    Q = U[:, s > s.max() * max(n, p) * np.finfo(float).eps]
+
+    return {"G": G, "Qt": Q.T, "Z": Z_basis, "df": n - Q.shape[1], "stat": stat}
+
+
+def _statistics(R, norms, rows_G, rows_Q, n_perm, model):
+    """Statistics of n_perm permutations of the residual columns R, shape (n_perm, n_columns)."""
+
+    k, r = model["G"].shape[0], model["Qt"].shape[0]
+
+    product = np.vstack([rows_G, rows_Q]) @ R
+    numerator = product[0:n_perm * k].reshape(n_perm, k, -1)
+    fitted = product[n_perm * k:].reshape(n_perm, r, -1)
+
+    rss = norms - np.einsum("brv,brv->bv", fitted, fitted)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        sigma = np.sqrt(np.where(rss > 0, rss, np.nan) / model["df"])
+        if model["stat"] == "t":
+            return numerator[:, 0, :] / sigma
+        return np.einsum("bkv,bkv->bv", numerator, numerator) / k / sigma ** 2
+
+
+def _block_rows(model, permutations):
+    """Rows of G P and Q' P for a (n_perm, n) array of permutations."""
+
+    inverse = np.argsort(permutations, axis = 1)
+
+    rows_G = model["G"][:, inverse].transpose(1, 0, 2).reshape(-1, inverse.shape[1])
+    rows_Q = model["Qt"][:, inverse].transpose(1, 0, 2).reshape(-1, inverse.shape[1])
+
+    return rows_G, rows_Q
+
+
+def _init_worker(residuals, norms, observed, model, tails, max_block_mb, transform = None, valid = None):
+
+    if type(residuals) is str:
+        residuals = np.load(residuals, mmap_mode = "r")
+
+    _state.update(residuals = residuals, norms = norms, observed = observed, model = model,
+                  tails = tails, max_block_mb = max_block_mb, transform = transform, valid = valid)
+
+
+def _transformed(stats, transform, valid):
+    """`transform` applied to every map (row) of stats, given over the valid features only."""
+
+    full = np.zeros(valid.shape)
+    rows = []
+    for row in stats:
+        full[valid] = np.nan_to_num(row, nan = 0)
+        rows.append(np.asarray(transform(full))[valid])
+
+    return np.vstack(rows)
+
+
+def _run_block(task):
+    """Worker: maxima and exceedance counts of one block of permutations."""
+
+    seed_sequence, n_perm, identity = task
+
+    residuals, norms, observed = _state["residuals"], _state["norms"], _state["observed"]
+    model = _state["model"]
+    n, n_columns = residuals.shape
+
+    rng = np.random.default_rng(seed_sequence)
+    permutations = np.vstack([rng.permutation(n) for _ in range(n_perm)])
+    if identity:
+        permutations[0] = np.arange(n)
+
+    rows_G, rows_Q = _block_rows(model, permutations)
+
+    rows = rows_G.shape[0] + rows_Q.shape[0]
+    chunk = max(1, int(_state["max_block_mb"] * 1024 ** 2 // (8 * (rows + n + 2 * n_perm))))
+
+    maxima = np.full(n_perm, -np.inf)
+    counts = np.zeros(n_columns, dtype = np.int64)
+
+    transform = _state["transform"]
+    if transform is not None:
+        # the transform needs whole maps: compute them first, then handle them as one chunk
+        stats = np.empty((n_perm, n_columns), dtype = np.float32)
+        for start in range(0, n_columns, chunk):
+            columns = slice(start, min(start + chunk, n_columns))
+            R = np.asarray(residuals[:, columns], dtype = np.float64)
+            stats[:, columns] = _statistics(R, norms[columns], rows_G, rows_Q, n_perm, model)
+        maps = [(slice(0, n_columns), _transformed(stats, transform, _state["valid"]))]
+    else:
+        maps = ((slice(start, min(start + chunk, n_columns)), None) for start in range(0, n_columns, chunk))
+
+    for columns, stats in maps:
+
+        if stats is None:
+            R = np.asarray(residuals[:, columns], dtype = np.float64)
+            stats = _statistics(R, norms[columns], rows_G, rows_Q, n_perm, model)
+        if model["stat"] == "t" and _state["tails"] == 2:
+            stats = np.abs(stats)
+
+        stats = np.nan_to_num(stats, nan = -np.inf)
+        maxima = np.maximum(maxima, stats.max(axis = 1))
+
+        if observed is not None:
+            reference = observed[columns]
+            counts[columns] += (stats >= reference - 1e-6 * np.abs(reference)).sum(axis = 0)
+
+    return maxima, counts
+
+
+def permutation_test(Y, X, contrast, n_permutations = 5000, stat = "t", tails = 2, n_jobs = None,
+                     seed = None, block_size = 100, max_block_mb = 256, transform = None):
+    """Freedman-Lane permutation test of a GLM contrast at every column of Y.
+
+    :param Y: (n_subjects, n_features) data (ROI values, masked voxels ...)
+    :param X: (n_subjects, n_regressors) design matrix
+    :param contrast: t contrast (SPM string or weights) or (k, n_regressors) F contrast
+    :param n_permutations: number of permutations, the identity included
+    :param stat: "t" (single-row contrast) or "F"
+    :param tails: for t, 2 uses |t|, 1 tests the positive direction
+    :param n_jobs: worker processes, defaults to all the cores. 1 runs in this process
+    :param seed: seed of the SeedSequence the permutations are drawn from
+    :param block_size: permutations per block (one matrix product per block and chunk of features)
+    :param max_block_mb: memory of the products of one chunk of features
+    :param transform: optional picklable function applied to every statistic map (a vector over all the
+        columns of Y, 0 where Y is not finite) before taking maxima, e.g. ``tfce.tfce_transform(mask)``.
+        The p-values are then those of the transformed statistic
+    :return: dict with stat (observed statistic), transformed (observed transformed statistic, when
+        `transform` is given), p_uncorrected, p_fwe, max_null (maxima of every permutation) and df
+    """
+    if stat not in ("t", "F"):
+        raise ValueError(f"Unknown statistic {stat}, expected 't' or 'F'")
+
+    Y = np.asarray(Y)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+
+    model = _model(X, _contrast_matrix(contrast), stat)
+
+    if Y.shape[0] != model["G"].shape[1]:
+        raise ValueError(f"The design has {model['G'].shape[1]} rows for {Y.shape[0]} subjects")
+
+    valid = np.isfinite(Y).all(axis = 0)
+    Y = Y[:, valid]
+
+    # Freedman-Lane residuals of the nuisance model, stored in float32 like the images
+    Z = model["Z"]
+    residuals = np.empty(Y.shape, dtype = np.float32)
+    norms = np.empty(Y.shape[1])
+    chunk = max(1, int(max_block_mb * 1024 ** 2 // (8 * max(Y.shape[0], 1))))
+    for start in range(0, Y.shape[1], chunk):
+        block = np.asarray(Y[:, start:start + chunk], dtype = np.float64)
+        total = np.einsum("ij,ij->j", block, block)
+        residuals[:, start:start + chunk] = block - Z @ (Z.T @ block)
+        # norms of the stored (rounded) residuals, so every statistic sees the same data
+        block = np.asarray(residuals[:, start:start + chunk], dtype = np.float64)
+        block_norms = np.einsum("ij,ij->j", block, block)
+        # columns explained by the nuisance model (e.g. constant) have no residual variance
+        norms[start:start + chunk] = np.where(block_norms > 1e-12 * total, block_norms, 0)
+
+    # observed statistic: the identity permutation
+    rows_G, rows_Q = _block_rows(model, np.arange(Y.shape[0]).reshape(1, -1))
+    observed = np.concatenate([_statistics(np.asarray(residuals[:, s:s + chunk], dtype = np.float64),
+                                           norms[s:s + chunk], rows_G, rows_Q, 1, model)[0]
+                               for s in range(0, Y.shape[1], chunk)]) if Y.shape[1] else np.zeros(0)
+    transformed = None if transform is None else _transformed(observed.reshape(1, -1), transform, valid)[0]
+    compared = observed if transform is None else transformed
+    compared = np.abs(compared) if stat == "t" and tails == 2 else compared
+    # features with no residual variance are never significant
+    compared = np.nan_to_num(compared, nan = -np.inf)
+
+    block_sizes = [min(block_size, n_permutations - start) for start in range(0, n_permutations, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    tasks = [(s, b, i == 0) for i, (s, b) in enumerate(zip(seeds, block_sizes))]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    if n_jobs == 1 or len(tasks) == 1:
+        _init_worker(residuals, norms, compared, model, tails, max_block_mb, transform, valid)
+        results = [_run_block(task) for task in tasks]
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix = "anapyze_perm_")
+        try:
+            residuals_file = join(tmp_dir, "residuals.npy")
+            np.save(residuals_file, residuals)
+            with ProcessPoolExecutor(max_workers = n_jobs, initializer = _init_worker,
+                                     initargs = (residuals_file, norms, compared, model, tails,
+                                                 max_block_mb, transform, valid)) as executor:
+                results = list(executor.map(_run_block, tasks))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    _state.clear()
+
+    max_null = np.concatenate([maxima for maxima, _ in results])
+    counts = np.sum([c for _, c in results], axis = 0) if results else np.zeros(Y.shape[1])
+
+    sorted_null = np.sort(max_null)
+    exceed = n_permutations - np.searchsorted(sorted_null, compared - 1e-6 * np.abs(compared), side = "left")
+
+    def expand(values, fill):
+        full = np.full(valid.shape, fill, dtype = np.float64)
+        full[valid] = values
+        return full
+
+    result = {"stat": expand(observed, np.nan),
+              "p_uncorrected": expand(counts / n_permutations, 1.0),
+              "p_fwe": expand(exceed / n_permutations, 1.0),
+              "max_null": max_null,
+              "df": model["df"]}
+
+    if transform is not None:
+        result["transformed"] = expand(transformed, 0.0)
+
+    return result
+
+
+@instrumented
+def run_permutation_glm(images, design, contrast, save_dir, mask = None, n_permutations = 5000, stat = "t",
+                        tails = 2, n_jobs = None, seed = None, max_block_mb = 256, tfce = None):
+    """Voxel-wise permutation test of a GLM contrast, with max-statistic FWE correction.
+
+    :param images: list of co-registered images or paths (rows of the design), or a CohortCube
+    :param design: (n_subjects, n_regressors) design matrix, e.g. from ``glm.two_sample_design``
+    :param contrast: t contrast (SPM string or weights) or F contrast matrix
+    :param save_dir: output directory (created if needed)
+    :param mask: mask image, array or path; voxels > 0 are analysed (the mask of the cube for a CohortCube)
+    :param n_permutations: number of permutations, the identity included
+    :param stat: "t" or "F"
+    :param tails: for t, 2 for a two-sided test, 1 for the positive direction
+    :param n_jobs: worker processes, defaults to all the cores
+    :param seed: seed of the permutations
+    :param max_block_mb: memory of one block of voxels
+    :param tfce: True, or a dict of ``tfce.tfce_transform`` parameters (connectivity, E, H, dh), to
+        base the p-values on the TFCE of the statistic (two-sided for two-tailed t tests)
+    :return: dict of output name (stat, [tfce], p_uncorrected, p_fwe) to path
+    """
+    os.makedirs(save_dir, exist_ok = True)
+
+    if isinstance(images, CohortCube):
+        if mask is not None:
+            raise ValueError("The analysis mask of a CohortCube is the mask it was built with")
+        Y = images.data
+        mask_data, shape, affine = images.mask, images.shape, images.affine
+
+    else:
+        reference = nib.load(images[0]) if type(images[0]) is str else images[0]
+        shape, affine = reference.shape[0:3], reference.affine
+        if mask is None:
+            mask_data = np.ones(shape, dtype = bool)
+        else:
+            if type(mask) is str:
+                mask = nib.load(mask)
+            mask_data = (get_volume(mask) if hasattr(mask, "dataobj") else np.asarray(mask)) > 0
+
+        Y = np.empty((len(images), int(mask_data.sum())), dtype = np.float32)
+        for positions, block in masked_blocks(images, mask_data, max_block_mb = max_block_mb):
+            Y[:, positions] = block
+
+    transform = None
+    if tfce:
+        parameters = {"two_sided": stat == "t" and tails == 2}
+        parameters.update(tfce if type(tfce) is dict else {})
+        transform = tfce_transform(mask_data, **parameters)
+
+    result = permutation_test(Y, design, contrast, n_permutations = n_permutations, stat = stat, tails = tails,
+                              n_jobs = n_jobs, seed = seed, max_block_mb = max_block_mb, transform = transform)
+
+    maps = [("stat", f"{stat}.nii", np.nan), ("p_uncorrected", "p_uncorrected.nii", 1), ("p_fwe", "p_fwe.nii", 1)]
+    if tfce:
+        result["tfce"] = result["transformed"]
+        maps.insert(1, ("tfce", "tfce.nii", 0))
+
+    outputs = {}
+    for name, file_name, fill in maps:
+        volume = np.full(shape, fill, dtype = np.float32)
+        volume[mask_data] = result[name]
+        outputs[name] = join(save_dir, file_name)
+        nib.save(nib.Nifti1Image(volume, affine), outputs[name])
+
+    return outputs
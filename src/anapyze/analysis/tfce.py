@@ -0,0 +1,230 @@
+"""
+Threshold-free cluster enhancement (Smith & Nichols, 2009) of statistic maps.
+
+    TFCE(v) = sum over h = dh, 2 dh, ... <= stat(v) of extent(v, h) ** E * h ** H * dh
+
+where extent(v, h) is the number of voxels of the cluster containing v in the map
+thresholded at h. The maps are handled as vectors of in-mask voxels with the
+neighbour pairs of the mask (``mask_adjacency``), computed once per mask and
+connectivity. The clusters are not relabelled at every height: the heights are
+swept from the top, voxels and neighbour pairs are added when the height reaches
+them and clusters are merged with a union-find over voxels (union by size, the
+merges of one height step solved with scipy's connected_components). The
+enhancement of a cluster is accumulated only when its size changes, so a map
+costs O(V + edges) vector operations whatever the number of heights, which
+is what ``permutation.permutation_test(..., transform = ...)`` needs to run it
+on every permuted map.
+"""
+
+import numpy as np
+import nibabel as nib
+from functools import partial
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.image_access import get_volume
+
+CONNECTIVITIES = (6, 18, 26)
+
+
+def mask_adjacency(mask, connectivity = 26):
+    """Neighbour pairs of the voxels of a mask.
+
+    :param mask: 3D boolean array (or mask image / path; voxels > 0)
+    :param connectivity: 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners)
+    :return: (2, n_edges) int array of positions in the vector of in-mask voxels (mask order), each
+        pair once
+    """
+    if connectivity not in CONNECTIVITIES:
+        raise ValueError(f"Unknown connectivity {connectivity}, expected one of {CONNECTIVITIES}")
+
+    if type(mask) is str:
+        mask = nib.load(mask)
+    mask = (get_volume(mask) if hasattr(mask, "dataobj") else np.asarray(mask)) > 0
+
+    n_voxels = int(mask.sum())
+    dtype = np.int32 if n_voxels < 2 ** 31 else np.int64
+    positions = np.full(mask.shape, -1, dtype = dtype)
+    positions[mask] = np.arange(n_voxels, dtype = dtype)
+
+    pairs = []
+    for offset in np.ndindex(3, 3, 3):
+        offset = np.array(offset) - 1
+        distance = np.abs(offset).sum()
+        # half of the neighbourhood: the first non-zero component is positive
+        if distance == 0 or offset[np.flatnonzero(offset)[0]] < 0:
+            continue
+        if (connectivity == 6 and distance > 1) or (connectivity == 18 and distance > 2):
+            continue
+
+        source = tuple(slice(max(0, -o), s - max(0, o)) for o, s in zip(offset, mask.shape))
+        target = tuple(slice(max(0, o), s - max(0, -o)) for o, s in zip(offset, mask.shape))
+
+        a, b = positions[source], positions[target]
+        both = (a >= 0) & (b >= 0)
+        pairs.append(np.vstack([a[both], b[both]]))
+
+    return np.hstack(pairs) if pairs else np.zeros((2, 0), dtype = dtype)
+
+
+def _find(parent, offset, nodes):
+    """Roots of `nodes` and the sum of the offsets on the way; the paths are compressed."""
+
+    current = nodes.copy()
+    total = offset[nodes].copy()
+
+    while True:
+        up = parent[current]
+        moving = up != current
+        if not moving.any():
+            break
+        current[moving] = up[moving]
+        total[moving] += offset[up[moving]]
+
+    # point straight to the root; the root offset (0) is not part of the node offset
+    parent[nodes] = current
+    offset[nodes] = np.where(current == nodes, 0, total)
+
+    return current
+
+
+def _tfce_positive(values, edges, E, H, dh):
+    """TFCE of the positive part of a map."""
+
+    n = values.size
+    steps = np.floor(np.nan_to_num(values, nan = 0) / dh).astype(np.int64)
+    n_steps = int(steps.max(initial = 0))
+
+    scores = np.zeros(n)
+    if n_steps < 1:
+        return scores
+
+    # S[k]: sum of (j dh) ** H dh for j = 1..k, so a cluster of constant size between steps
+    # k_low < k <= k_high contributes size ** E * (S[k_high] - S[k_low])
+    heights = np.arange(0, n_steps + 1) * dh
+    S = np.concatenate([[0], np.cumsum(heights[1:] ** H * dh)])
+
+    edge_steps = np.minimum(steps[edges[0]], steps[edges[1]])
+    active = edge_steps >= 1
+    edges, edge_steps = edges[:, active], edge_steps[active]
+
+    # voxels and edges grouped by the step at which they appear (stable sort of small ints is a radix sort)
+    sort_dtype = np.int16 if n_steps < 2 ** 15 else np.int64
+    edge_order = np.argsort(-edge_steps.astype(sort_dtype), kind = "stable")
+    edges, edge_steps = edges[:, edge_order], edge_steps[edge_order]
+    edge_bounds = np.searchsorted(-edge_steps, -np.arange(n_steps, -1, -1), side = "left")
+
+    parent = np.arange(n)
+    offset = np.zeros(n)
+    size = np.ones(n, dtype = np.int64)
+    since = steps.copy()  # step from which the current size of a root holds
+    accumulated = np.zeros(n)
+
+    for k, start, stop in zip(range(n_steps, 0, -1), edge_bounds[0:-1], edge_bounds[1:]):
+
+        if stop == start:
+            continue
+
+        roots = _find(parent, offset, edges[:, start:stop].ravel())
+        roots_a, roots_b = roots[0:stop - start], roots[stop - start:]
+        joining = roots_a != roots_b
+        if not joining.any():
+            continue
+        roots_a, roots_b = roots_a[joining], roots_b[joining]
+
+        nodes, local = np.unique(np.concatenate([roots_a, roots_b]), return_inverse = True)
+        local_a, local_b = local[0:roots_a.size], local[roots_a.size:]
+        graph = coo_matrix((np.ones(local_a.size), (local_a, local_b)), shape = (nodes.size, nodes.size))
+        _, group = connected_components(graph, directed = False)
+
+        # close the constant-size interval of every merging cluster
+        accumulated[nodes] += size[nodes] ** E * (S[since[nodes]] - S[k])
+
+        # the largest cluster of each group survives, the others hang from it
+        order = np.lexsort((-size[nodes], group))
+        first = np.r_[True, group[order][1:] != group[order][0:-1]]
+        survivor_of_group = nodes[order][first]
+        survivor = survivor_of_group[group]
+
+        merged = nodes != survivor
+        offset[nodes[merged]] = accumulated[nodes[merged]] - accumulated[survivor[merged]]
+        parent[nodes[merged]] = survivor[merged]
+
+        size[survivor_of_group] = np.bincount(group, weights = size[nodes]).astype(np.int64)
+        since[survivor_of_group] = k
+
+    # close the last interval of the remaining clusters, down to the first height
+    roots = _find(parent, offset, np.arange(n))
+    is_root = (roots == np.arange(n)) & (steps >= 1)
+    accumulated[is_root] += size[is_root] ** E * S[since[is_root]]
+
+    scores = offset + accumulated[roots]
+    scores[steps < 1] = 0
+
+    return scores
+
+
+def tfce_scores(values, edges, E = 0.5, H = 2.0, dh = 0.1, two_sided = False):
+    """TFCE of a statistic map given as a vector of in-mask voxels.
+
+    :param values: statistic of every in-mask voxel (NaN is treated as 0)
+    :param edges: neighbour pairs from ``mask_adjacency``
+    :param E: extent exponent
+    :param H: height exponent
+    :param dh: height step. None uses 1/100 of the largest absolute value of the map
+    :param two_sided: also enhance the negative part (returned with negative sign), for t maps
+    :return: float64 array of TFCE scores
+    """
+    values = np.asarray(values, dtype = np.float64)
+    edges = np.asarray(edges)
+
+    if dh is None:
+        dh = np.nanmax(np.abs(values), initial = 0) / 100 or 1.0
+
+    scores = _tfce_positive(values, edges, E, H, dh)
+    if two_sided:
+        scores -= _tfce_positive(-values, edges, E, H, dh)
+
+    return scores
+
+
+def tfce_transform(mask, connectivity = 26, E = 0.5, H = 2.0, dh = 0.1, two_sided = False):
+    """TFCE of the in-mask vectors of a mask as a picklable function of one map, e.g. for
+    ``permutation.permutation_test(..., transform = tfce_transform(mask))``."""
+
+    return partial(tfce_scores, edges = mask_adjacency(mask, connectivity), E = E, H = H, dh = dh, two_sided = two_sided)
+
+
+@instrumented
+def tfce_image(img, mask = None, connectivity = 26, E = 0.5, H = 2.0, dh = 0.1, two_sided = False):
+    """TFCE of a 3D statistic image (e.g. spmT_0001.nii).
+
+    :param img: nibabel image or path
+    :param mask: mask image, array or path; voxels > 0 are used. Defaults to the finite non-zero voxels
+    :param connectivity: 6, 18 or 26
+    :param E: extent exponent
+    :param H: height exponent
+    :param dh: height step (None for 1/100 of the maximum)
+    :param two_sided: also enhance negative values
+    :return: float32 nifti image of TFCE scores, 0 outside the mask
+    """
+    if type(img) is str:
+        img = nib.load(img)
+
+    data = get_volume(img)
+
+    if mask is None:
+        mask_data = np.isfinite(data) & (data != 0)
+    else:
+        if type(mask) is str:
+            mask = nib.load(mask)
+        mask_data = (get_volume(mask) if hasattr(mask, "dataobj") else np.asarray(mask)) > 0
+
+    scores = tfce_scores(data[mask_data], mask_adjacency(mask_data, connectivity), E = E, H = H, dh = dh,
+                         two_sided = two_sided)
+
+    volume = np.zeros(data.shape, dtype = np.float32)
+    volume[mask_data] = scores
+
+    return nib.Nifti1Image(volume, img.affine)
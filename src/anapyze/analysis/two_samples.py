@@ -4,14 +4,19 @@ import numpy as np
 import nibabel as nib
 import shutil
 import subprocess
-import pandas as pd
-import statsmodels.api as sm
 from anapyze.io import spm
 from anapyze.io import cat12
+from anapyze.analysis import glm
+from anapyze.analysis import permutation
 from anapyze.core import processor
 from anapyze.core import utils
 from scipy.stats import ttest_ind
+from scipy.stats import f as f_dist
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.atlas import load_atlas_index
+from anapyze.core.multiple_comparisons import correct_pvalues
 
+@instrumented
 def run_2sample_ttest_spm(spm_path,save_dir,
         group1: list,
         group2: list,
@@ -23,10 +28,13 @@ def run_2sample_ttest_spm(spm_path,save_dir,
         mask: str = False,
         contrast_name: str = "contrast",
         contrast: str = "[1 -1 0]",
+        backend: str = "spm",
+        n_permutations: int = 0,
+        seed = None,
         ):
     """
-    Executes a two-sample voxel-wise t-test in SPM via MATLAB, computes Cohen’s d maps,
-    and estimates FDR-corrected thresholds for Cohen’s d.
+    Executes a two-sample voxel-wise t-test in SPM via MATLAB (or in-process with NumPy),
+    computes Cohen’s d maps, and estimates FDR-corrected thresholds for Cohen’s d.
 
     The function performs the following steps:
       1. Creates a fresh output directory (`save_dir`).
@@ -70,6 +78,17 @@ def run_2sample_ttest_spm(spm_path,save_dir,
     contrast : str, default "[1 -1 0 0]"
         Contrast vector in SPM format. The length must match the number of regressors in the model.
         For example, "[1 -1 0 0]" compares group1 > group2 while controlling for covariates.
+    backend : {"spm", "numpy"}, default "spm"
+        "spm" runs the SPM batches in MATLAB. "numpy" fits the same design (groups, age and
+        the optional second covariate) with `anapyze.analysis.glm.run_glm`, without MATLAB; it
+        writes the same maps (plus `beta_*.nii`, `ResMS.nii`, `con_0001.nii` and `mask.nii`) but
+        no m-files or `SPM.mat`, and assumes equal group variances.
+    n_permutations : int, default 0
+        If > 0, the same design and contrast are also tested with
+        `anapyze.analysis.permutation.run_permutation_glm` (Freedman-Lane, two-sided max-T),
+        which writes `t.nii`, `p_uncorrected.nii` and the FWE-corrected `p_fwe.nii`.
+    seed : int or None, default None
+        Seed of the permutations.
 
     Returns
     -------
@@ -94,33 +113,50 @@ def run_2sample_ttest_spm(spm_path,save_dir,
 
     os.makedirs(save_dir)
 
-    print("Creating SPM model....")
+    covariates = [list(group1_ages) + list(group2_ages)]
+    if covar2_name:
+        covariates.append(list(group1_covar2) + list(group2_covar2))
 
-    mfile_model = join(save_dir, "model.m")
+    design = glm.two_sample_design(len(group1), len(group2), covariates)
 
-    spm.generate_mfile_model(spm_path, mfile_model, save_dir, group1, group2,
-                         covar1_name='Age', group1_covar1=group1_ages, group2_covar1=group2_ages,
-                         covar2_name=covar2_name, group1_covar2=group1_covar2, group2_covar2=group2_covar2,
-                         mask=mask)
+    if backend == "numpy":
 
-    processor.run_matlab_command(mfile_model)
+        print("Estimating model (NumPy)....")
 
-    print("Estimating model....")
+        glm.run_glm(list(group1) + list(group2), design, contrast, save_dir, mask = mask if mask else None)
 
-    mfile_estimate = join(save_dir, "estimate.m")
-    spm_mat = join(save_dir, "SPM.mat")
+    elif backend == "spm":
 
-    spm.generate_mfile_estimate_model(spm_path,mfile_estimate,spm_mat)
+        print("Creating SPM model....")
 
-    processor.run_matlab_command(mfile_estimate)
+        mfile_model = join(save_dir, "model.m")
 
-    print("Calculating results....")
+        spm.generate_mfile_model(spm_path, mfile_model, save_dir, group1, group2,
+                             covar1_name='Age', group1_covar1=group1_ages, group2_covar1=group2_ages,
+                             covar2_name=covar2_name, group1_covar2=group1_covar2, group2_covar2=group2_covar2,
+                             mask=mask)
 
-    mfile_results = join(save_dir, "results.m")
-    spm_mat = join(save_dir, "SPM.mat")
+        processor.run_matlab_command(mfile_model)
 
-    spm.generate_mfile_contrast(spm_path, mfile_results, spm_mat, contrast_name = contrast_name, contrast = contrast)
-    processor.run_matlab_command(mfile_results)
+        print("Estimating model....")
+
+        mfile_estimate = join(save_dir, "estimate.m")
+        spm_mat = join(save_dir, "SPM.mat")
+
+        spm.generate_mfile_estimate_model(spm_path,mfile_estimate,spm_mat)
+
+        processor.run_matlab_command(mfile_estimate)
+
+        print("Calculating results....")
+
+        mfile_results = join(save_dir, "results.m")
+        spm_mat = join(save_dir, "SPM.mat")
+
+        spm.generate_mfile_contrast(spm_path, mfile_results, spm_mat, contrast_name = contrast_name, contrast = contrast)
+        processor.run_matlab_command(mfile_results)
+
+    else:
+        raise ValueError(f"Unknown backend {backend}, expected 'spm' or 'numpy'")
 
     print("Converting results to Cohens d....")
 
@@ -133,6 +169,12 @@ def run_2sample_ttest_spm(spm_path,save_dir,
     t_thres, cohens_d_thres = utils.get_fdr_thresholds_from_spmt(out_t_values, n1 = len(group1), n2 = len(group2))
     print(t_thres,cohens_d_thres)
 
+    if n_permutations:
+        print(f"Running {n_permutations} permutations (FWE corrected)....")
+        permutation.run_permutation_glm(list(group1) + list(group2), design, contrast, save_dir,
+                                        mask = mask if mask else None, n_permutations = n_permutations, seed = seed)
+
+@instrumented
 def run_2sample_ttest_cat12_new_tiv_model(spm_path, save_dir,
         group1: list,
         group2: list,
@@ -143,10 +185,13 @@ def run_2sample_ttest_cat12_new_tiv_model(spm_path, save_dir,
         mask: str = False,
         contrast_name: str = "contrast",
         contrast: str = "[1 -1 0 0]",
+        backend: str = "spm",
+        n_permutations: int = 0,
+        seed = None,
         ):
     """
-    Executes a two-sample voxel-wise t-test in SPM using the CAT12 New TIV model, computes
-    Cohen’s d maps, and estimates FDR-corrected thresholds for Cohen’s d.
+    Executes a two-sample voxel-wise t-test in SPM using the CAT12 New TIV model (or in-process
+    with NumPy), computes Cohen’s d maps, and estimates FDR-corrected thresholds for Cohen’s d.
 
     This function performs the following steps:
       1. Creates (or recreates) the output directory (`save_dir`).
@@ -186,6 +231,16 @@ def run_2sample_ttest_cat12_new_tiv_model(spm_path, save_dir,
     contrast : str, default "[1 -1 0 0]"
         Contrast vector in SPM format. Its length must match the number of regressors in the model
         (including covariates).
+    backend : {"spm", "numpy"}, default "spm"
+        "spm" runs the CAT12/SPM batches in MATLAB. "numpy" fits groups, age and TIV (the
+        TIV enters as a nuisance covariate, like CAT12's global ANCOVA) with
+        `anapyze.analysis.glm.run_glm`, without MATLAB, and writes the same maps.
+    n_permutations : int, default 0
+        If > 0, the same design and contrast are also tested with
+        `anapyze.analysis.permutation.run_permutation_glm` (Freedman-Lane, two-sided max-T),
+        which writes `t.nii`, `p_uncorrected.nii` and the FWE-corrected `p_fwe.nii`.
+    seed : int or None, default None
+        Seed of the permutations.
 
     Returns
     -------
@@ -205,31 +260,46 @@ def run_2sample_ttest_cat12_new_tiv_model(spm_path, save_dir,
 
     os.makedirs(save_dir)
 
-    print("Creating SPM model....")
+    covariates = [list(group1_ages) + list(group2_ages), list(group1_tivs) + list(group2_tivs)]
+    design = glm.two_sample_design(len(group1), len(group2), covariates)
 
-    mfile_model = join(save_dir, "model_cat12.m")
+    if backend == "numpy":
 
-    cat12.generate_mfile_model(spm_path, save_dir, group1, group1_ages, group1_tivs,
-                               group2,group2_ages, group2_tivs, mask)
+        print("Estimating model (NumPy)....")
 
-    processor.run_matlab_command(mfile_model)
+        glm.run_glm(list(group1) + list(group2), design, contrast, save_dir, mask = mask if mask else None)
 
-    print("Estimating model....")
+    elif backend == "spm":
 
-    mfile_estimate = join(save_dir, "estimate.m")
-    spm_mat = join(save_dir, "SPM.mat")
+        print("Creating SPM model....")
 
-    spm.generate_mfile_estimate_model(mfile_estimate, spm_mat)
+        # model, estimate and results: three batches, each run once on its own m-file
+        mfile_model = join(save_dir, "model_cat12.m")
 
-    processor.run_matlab_command(mfile_model)
+        cat12.generate_mfile_cat12_new_tiv_model(spm_path, mfile_model, save_dir, group1, group1_ages, group1_tivs,
+                                                 group2, group2_ages, group2_tivs, mask)
 
-    print("Calculating results....")
+        processor.run_matlab_command(mfile_model)
 
-    mfile_results = join(save_dir, "results.m")
-    spm_mat = join(save_dir, "SPM.mat")
+        print("Estimating model....")
 
-    spm.generate_mfile_contrast(spm_path, mfile_results, spm_mat, contrast_name = contrast_name, contrast = contrast)
-    processor.run_matlab_command(mfile_model)
+        mfile_estimate = join(save_dir, "estimate.m")
+        spm_mat = join(save_dir, "SPM.mat")
+
+        spm.generate_mfile_estimate_model(spm_path, mfile_estimate, spm_mat)
+
+        processor.run_matlab_command(mfile_estimate)
+
+        print("Calculating results....")
+
+        mfile_results = join(save_dir, "results.m")
+        spm_mat = join(save_dir, "SPM.mat")
+
+        spm.generate_mfile_contrast(spm_path, mfile_results, spm_mat, contrast_name = contrast_name, contrast = contrast)
+        processor.run_matlab_command(mfile_results)
+
+    else:
+        raise ValueError(f"Unknown backend {backend}, expected 'spm' or 'numpy'")
 
     print("Converting results to Cohens d....")
 
@@ -242,105 +312,115 @@ def run_2sample_ttest_cat12_new_tiv_model(spm_path, save_dir,
     t_thres, cohens_d_thres = utils.get_fdr_thresholds_from_spmt(out_t_values, n1 = len(group1), n2 = len(group2))
     print(t_thres,cohens_d_thres)
 
-def run_2sample_ttest_atlas(group1: list, group2: list, atlas_path, output_path, operation = "mean"):
-
-    atlas_img = nib.load(atlas_path)
-    atlas_data = atlas_img.get_fdata()
-
-    result = atlas_data * 0
-    p_vals = atlas_data * 0
-
-    # Get the unique values of the atlas, which correspond to the ROIs
-    rois = np.unique(atlas_data)
-    
-    # Loop over the ROIs
-    for i in rois:
-        if i != 0:
-            # Get the indices of the voxels that belong to the current ROI
-            indx = np.where(atlas_data == i)
-            
-            group_1_vals = []
-            
-            for image in group1:
-                img_ = nib.load(image)
-                img_data = img_.get_fdata()
-                if operation == "mean":
-                    val = np.mean(img_data[indx])
-                if operation == "sum":
-                    val = np.sum(img_data[indx])
-                group_1_vals.append(val)
-            
-            group_2_vals = []
-            
-            for image in group2:
-                img_ = nib.load(image)
-                img_data = img_.get_fdata()
-                if operation == "mean":
-                    val = np.mean(img_data[indx])
-                if operation == "sum":
-                    val = np.sum(img_data[indx])
-                group_2_vals.append(val)
-        
-            t_stat, p_val = ttest_ind(group_1_vals, group_2_vals, equal_var=True)
-            cohens_d = t_stat*(np.sqrt(1 / len(group_1_vals) + 1 / len(group_2_vals)))
-
-            result[indx] =  cohens_d
-            p_vals[indx] = p_val
-    
-    results_img = nib.Nifti1Image(result,atlas_img.affine, atlas_img.header)
-    nib.save(results_img,join(output_path,'cohens_d.nii'))
-
-    pvals_img = nib.Nifti1Image(p_vals,atlas_img.affine, atlas_img.header)
-    nib.save(pvals_img,join(output_path,'p_values.nii'))
-
-
-def run_2sample_anova_with_covariate_atlas(group1, group2, group1_covar, group2_covar, atlas_path, output_path, operation="mean"):
-  
-    atlas_img = nib.load(atlas_path)
-    atlas_data = atlas_img.get_fdata()
-
-    d_vals = np.zeros_like(atlas_data)
-    f_stats = np.zeros_like(atlas_data)
-    p_vals = np.ones_like(atlas_data)
-
-    rois = np.unique(atlas_data)
-    rois = rois[rois != 0]
-    
-    all_imgs = group1 + group2
-    all_covars = group1_covar + group2_covar
-    all_groups = [0] * len(group1) + [1] * len(group2)
+    if n_permutations:
+        print(f"Running {n_permutations} permutations (FWE corrected)....")
+        permutation.run_permutation_glm(list(group1) + list(group2), design, contrast, save_dir,
+                                        mask = mask if mask else None, n_permutations = n_permutations, seed = seed)
 
+@instrumented
+def run_2sample_ttest_atlas(group1: list, group2: list, atlas_path, output_path, operation = "mean",
+                            correction = "fdr_bh", alpha = 0.05, n_permutations = 0, seed = None):
 
-    n1 = len(group1)
-    n2 = len(group2)
+    atlas_index = load_atlas_index(atlas_path)
+
+    # (n_subjects, n_rois) matrices of ROI values, one pass per image
+    group_1_vals = atlas_index.reduce_many(group1, operation)
+    group_2_vals = atlas_index.reduce_many(group2, operation)
+
+    t_stat, p_val = ttest_ind(group_1_vals, group_2_vals, equal_var=True, axis=0)
+    cohens_d = t_stat*(np.sqrt(1 / len(group1) + 1 / len(group2)))
 
-    for roi in rois:
-        mask = atlas_data == roi
-        roi_vals = []
+    nib.save(atlas_index.paint(cohens_d),join(output_path,'cohens_d.nii'))
+    nib.save(atlas_index.paint(p_val),join(output_path,'p_values.nii'))
 
-        for img_path in all_imgs:
-            data = nib.load(img_path).get_fdata()
-            val = np.mean(data[mask]) if operation == "mean" else np.sum(data[mask])
-            roi_vals.append(val)
+    if correction:
+        p_corrected, _ = correct_pvalues(p_val, correction, alpha)
+        nib.save(atlas_index.paint(p_corrected, fill = 1), join(output_path, f'p_values_{correction}.nii'))
 
-        df = pd.DataFrame({
-            "value": roi_vals,
-            "Group": all_groups, 
-            "age": all_covars
-        })
+    if n_permutations:
+        # max-T over the ROIs gives FWE-corrected p-values
+        design = glm.two_sample_design(len(group1), len(group2))
+        result = permutation.permutation_test(np.vstack([group_1_vals, group_2_vals]), design, [1, -1],
+                                              n_permutations = n_permutations, seed = seed)
+        nib.save(atlas_index.paint(result["p_fwe"], fill = 1), join(output_path, 'p_values_fwe.nii'))
 
-        df['Group'] = df['Group'].astype('category')
-        X = sm.add_constant(pd.get_dummies(df[["Group", "age"]], drop_first=True))
-        model = sm.OLS(df["value"], X).fit()
-        f_test = model.f_test("Group[T.1]")
 
-        f_val = f_test.fvalue.item()
-        d_val = np.sqrt(f_val * (n1 + n2) / (n1 * n2)) if f_val > 0 else 0.0
+@instrumented
+def run_2sample_anova_with_covariate_atlas(group1, group2, group1_covar, group2_covar, atlas_path, output_path, operation="mean",
+                                           correction = "fdr_bh", alpha = 0.05, n_permutations = 0, seed = None):
+    """
+    ROI-wise ANCOVA of a group effect adjusted for covariates, fitted to all the ROIs at once.
+
+    The ROI values of every image are extracted in one pass per image, and the design
+    (one column per group plus the covariates) is solved for every ROI with a single
+    pseudo-inverse. The group F (1 degree of freedom), its p-value and
+    d = sqrt(F (n1 + n2) / (n1 n2)) are computed for all the ROIs together.
 
-        f_stats[mask] = f_val
-        d_vals[mask] = d_val
-        p_vals[mask] = f_test.pvalue.item()
+    Parameters
+    ----------
+    group1, group2 : list[str]
+        Image paths of the two groups.
+    group1_covar, group2_covar : sequence or array-like
+        Covariates of the subjects of each group: one value per subject (e.g. ages) for a
+        single covariate, or an (n_subjects, n_covariates) array / DataFrame for several.
+    atlas_path : str
+        Atlas image (see `anapyze.core.atlas.load_atlas_index`).
+    output_path : str
+        Directory where `f_stat_group.nii`, `cohens_d_group.nii`, `p_values_group.nii` (and the
+        corrected p-maps) are written.
+    operation : {"mean", "sum"}, default "mean"
+        ROI value of every image.
+    correction : str or None, default "fdr_bh"
+        Multiple-comparison correction of the ROI p-values, written as `p_values_group_<correction>.nii`.
+    alpha : float, default 0.05
+        Level of the correction.
+    n_permutations : int, default 0
+        If > 0, FWE-corrected p-values from Freedman-Lane permutations (max-F over the ROIs),
+        written as `p_values_group_fwe.nii`.
+    seed : int or None, default None
+        Seed of the permutations.
+    """
+
+    atlas_index = load_atlas_index(atlas_path)
+
+    all_imgs = group1 + group2
+
+    n1 = len(group1)
+    n2 = len(group2)
 
-    nib.save(nib.Nifti1Image(f_stats, atlas_img.affine, atlas_img.header), os.path.join(output_path, "f_stat_group.nii"))
-    nib.save(nib.Nifti1Image(d_vals, atlas_img.affine, atlas_img.header), os.path.join(output_path, "cohens_d_group.nii"))
-    nib.save(nib.Nifti1Image(p_vals, atlas_img.affine, atlas_img.header), os.path.join(output_path, "p_values_group.nii"))
+    covariates = []
+    for group_covar, n in ((group1_covar, n1), (group2_covar, n2)):
+        group_covar = np.asarray(group_covar, dtype = float)
+        group_covar = group_covar.reshape(-1, 1) if group_covar.ndim == 1 else group_covar
+        if group_covar.shape[0] != n:
+            raise ValueError(f"Covariates for {group_covar.shape[0]} subjects, the group has {n} images")
+        covariates.append(group_covar)
+    all_covars = np.vstack(covariates)
+
+    # (n_subjects, n_rois) matrix of ROI values, one pass per image
+    all_roi_vals = atlas_index.reduce_many(all_imgs, "mean" if operation == "mean" else "sum")
+
+    # one design for every ROI: group 1, group 2, covariates
+    design = glm.two_sample_design(n1, n2, all_covars.T)
+    contrast = np.r_[1, -1, np.zeros(all_covars.shape[1])]
+    fit = glm.fit_glm(all_roi_vals, design, contrast)
+
+    # F of a single contrast row is t squared
+    f_stats = fit["t"] ** 2
+    p_vals = f_dist.sf(f_stats, 1, fit["df"])
+    with np.errstate(invalid = "ignore"):
+        d_vals = np.where(f_stats > 0, np.sqrt(f_stats * (n1 + n2) / (n1 * n2)), 0.0)
+
+    nib.save(atlas_index.paint(f_stats), os.path.join(output_path, "f_stat_group.nii"))
+    nib.save(atlas_index.paint(d_vals), os.path.join(output_path, "cohens_d_group.nii"))
+    nib.save(atlas_index.paint(p_vals, fill = 1), os.path.join(output_path, "p_values_group.nii"))
+
+    if correction:
+        p_corrected, _ = correct_pvalues(p_vals, correction, alpha)
+        nib.save(atlas_index.paint(p_corrected, fill = 1), os.path.join(output_path, f"p_values_group_{correction}.nii"))
+
+    if n_permutations:
+        # Freedman-Lane with the covariates as nuisance, max-F over the ROIs
+        result = permutation.permutation_test(all_roi_vals, design, [contrast], stat = "F",
+                                              n_permutations = n_permutations, seed = seed)
+        nib.save(atlas_index.paint(result["p_fwe"], fill = 1), os.path.join(output_path, "p_values_group_fwe.nii"))
@@ -4,14 +4,28 @@ Anapyze core processing utilities.
 This module bundles all functions from:
   - processor.py
   - utils.py
+  - matlab_pool.py
+  - parallel_spm.py
+  - smoothing.py
+  - cache.py
+  - cohort.py
+  - atlas.py
+  - multiple_comparisons.py
+  - resolution.py
+  - image_access.py
+  - pipeline.py
+  - instrumentation.py
 """
 
 from .processor import (
     run_matlab_command,
     intensity_normalize_pet_histogram,
+    intensity_normalize_pet_histogram_cohort,
     intensity_normalize_pet_ref_region,
     histogram_matching,
     logpow_histogram_matching,
+    ReferenceDistribution,
+    load_reference_distribution,
     coregister_spm,
     old_normalize_spm,
     new_normalize_spm,
@@ -27,10 +41,12 @@ from .processor import (
 from .utils import (
     check_input_image_shape,
     change_image_dtype,
+    resample_to_grid,
     resample_image_by_matrix_size,
     resample_image_by_voxel_sizes,
     remove_nan_negs,
     add_poisson_noise,
+    RunningMeanStd,
     create_mean_std_imgs,
     create_atlas_csv_from_normals_imgs,
     transform_img_to_atlas_zscores,
@@ -40,14 +56,46 @@ from .utils import (
     get_tiv_from_cat12_xml_report,
     get_weighted_average_iqrs_from_cat12_xml_report,
 )
+from .matlab_pool import (
+    MatlabPool,
+    start_matlab_pool,
+    stop_matlab_pool,
+)
+from .parallel_spm import (
+    run_sharded_spm_batch,
+    smooth_images_spm_sharded,
+    old_normalize_spm_sharded,
+    new_deformations_sharded,
+)
+from .smoothing import (
+    smooth_image,
+    smooth_images,
+)
+from .cache import ResultCache
+from .cohort import CohortCube
+from .atlas import LabelIndex, label_stats, load_atlas_index
+from .multiple_comparisons import stat_to_p, correct_pvalues, correct_map
+from .resolution import estimate_fwhm_cohort
+from .image_access import get_data, get_volume, clear_cache, masked_blocks
+from .pipeline import Stage, Pipeline
+from .instrumentation import (
+    enable_instrumentation,
+    disable_instrumentation,
+    subject_label,
+    external_tool,
+    with_context,
+)
 
 __all__ = [
     # from processor.py
     "run_matlab_command",
     "intensity_normalize_pet_histogram",
+    "intensity_normalize_pet_histogram_cohort",
     "intensity_normalize_pet_ref_region",
     "histogram_matching",
     "logpow_histogram_matching",
+    "ReferenceDistribution",
+    "load_reference_distribution",
     "coregister_spm",
     "old_normalize_spm",
     "new_normalize_spm",
@@ -62,10 +110,12 @@ __all__ = [
     # from utils.py
     "check_input_image_shape",
     "change_image_dtype",
+    "resample_to_grid",
     "resample_image_by_matrix_size",
     "resample_image_by_voxel_sizes",
     "remove_nan_negs",
     "add_poisson_noise",
+    "RunningMeanStd",
     "create_mean_std_imgs",
     "create_atlas_csv_from_normals_imgs",
     "transform_img_to_atlas_zscores",
@@ -74,4 +124,44 @@ __all__ = [
     "get_fdr_thresholds_from_spmt",
     "get_tiv_from_cat12_xml_report",
     "get_weighted_average_iqrs_from_cat12_xml_report",
+    # from matlab_pool.py
+    "MatlabPool",
+    "start_matlab_pool",
+    "stop_matlab_pool",
+    # from parallel_spm.py
+    "run_sharded_spm_batch",
+    "smooth_images_spm_sharded",
+    "old_normalize_spm_sharded",
+    "new_deformations_sharded",
+    # from smoothing.py
+    "smooth_image",
+    "smooth_images",
+    # from cache.py
+    "ResultCache",
+    # from cohort.py
+    "CohortCube",
+    # from atlas.py
+    "LabelIndex",
+    "label_stats",
+    "load_atlas_index",
+    # from multiple_comparisons.py
+    "stat_to_p",
+    "correct_pvalues",
+    "correct_map",
+    # from resolution.py
+    "estimate_fwhm_cohort",
+    # from image_access.py
+    "get_data",
+    "get_volume",
+    "clear_cache",
+    "masked_blocks",
+    # from pipeline.py
+    "Stage",
+    "Pipeline",
+    # from instrumentation.py
+    "enable_instrumentation",
+    "disable_instrumentation",
+    "subject_label",
+    "external_tool",
+    "with_context",
 ]
@@ -0,0 +1,302 @@
+"""
+Single-pass ROI statistics over labelled atlases.
+
+A ``LabelIndex`` is built once per atlas: the foreground voxels are sorted by
+label, so the voxels of every ROI are contiguous. Reducing an image to ROI
+values is then one gather of the foreground voxels and one segmented reduction
+(np.add.reduceat) for all the labels at once, O(V) per image instead of one
+full-volume comparison per label.
+
+``load_atlas_index`` keeps the index of every atlas file in the user cache
+directory (<cache>/atlas/*.npz, keyed on the sha256 of the atlas and of its csv)
+together with the ROI names of the companion csv, so after the first use an atlas is loaded without
+decompressing the image or scanning its labels.
+"""
+
+import os
+import glob
+import tempfile
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from os.path import join, exists, basename, dirname
+from concurrent.futures import ThreadPoolExecutor
+
+from anapyze.core.cache import default_cache_dir, file_digest
+from anapyze.core.image_access import get_volume
+
+STATS = ("mean", "sum", "std", "median", "count", "volume")
+
+
+def _image_data(img, dtype = np.float64):
+    """Data of an image, path or array as `dtype`; for 4D images only the first volume is read."""
+
+    if type(img) is str:
+        img = nib.load(img)
+
+    if not hasattr(img, "dataobj"):
+        return np.asarray(img, dtype = dtype)
+
+    return get_volume(img, dtype = dtype)
+
+
+class LabelIndex:
+    """Voxels of every label of an atlas, sorted by label.
+
+    :param labels: sorted non-background labels
+    :param order: flat indices of the foreground voxels, grouped by label in the order of `labels`
+    :param counts: number of voxels of each label
+    :param shape: 3D shape of the atlas
+    :param affine: affine of the atlas
+    :param header: optional header of the atlas, used for the images written by ``paint``
+    :param names: optional ROI names of the labels
+    """
+
+    def __init__(self, labels, order, counts, shape, affine, header = None, names = None):
+
+        self.labels = np.asarray(labels)
+        self.order = np.asarray(order)
+        self.counts = np.asarray(counts)
+        self.shape = tuple(shape)
+        self.affine = np.asarray(affine)
+        self.header = header
+        self.names = names
+
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.voxel_volume = abs(np.linalg.det(self.affine[0:3, 0:3]))
+
+    @classmethod
+    def from_image(cls, atlas_img, background = 0):
+        """Builds the index of a nibabel atlas image (or path)."""
+
+        if type(atlas_img) is str:
+            atlas_img = nib.load(atlas_img)
+
+        atlas_data = np.asanyarray(atlas_img.dataobj)
+        if atlas_data.ndim == 4:
+            atlas_data = atlas_data[:, :, :, 0]
+
+        flat = atlas_data.ravel()
+        foreground = np.flatnonzero(flat != background)
+        if flat.size < 2 ** 31:
+            foreground = foreground.astype(np.int32)
+
+        # stable sort keeps the voxels of a label in memory order, which helps the gathers
+        by_label = np.argsort(flat[foreground], kind = "stable")
+        order = foreground[by_label]
+        labels, counts = np.unique(flat[order], return_counts = True)
+
+        return cls(labels, order, counts, atlas_data.shape, atlas_img.affine, atlas_img.header)
+
+    def save(self, path):
+        """Writes the index to a .npz file (atomically)."""
+
+        arrays = {"labels": self.labels, "order": self.order, "counts": self.counts,
+                  "shape": np.array(self.shape), "affine": self.affine}
+        if self.names is not None:
+            arrays["names"] = np.array(self.names, dtype = str)
+        if self.header is not None:
+            # raw NIfTI-1 header (qform/sform codes, units, zooms ...), so ``paint`` writes the same
+            # header whether the index was built or loaded
+            header = nib.Nifti1Header.from_header(self.header)
+            arrays["header"] = np.frombuffer(header.binaryblock, dtype = np.uint8)
+
+        os.makedirs(dirname(path) or ".", exist_ok = True)
+
+        fd, tmp_path = tempfile.mkstemp(suffix = ".npz", dir = dirname(path) or ".")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by ``save``."""
+
+        with np.load(path) as arrays:
+            names = [str(n) for n in arrays["names"]] if "names" in arrays else None
+            header = nib.Nifti1Header(arrays["header"].tobytes()) if "header" in arrays else None
+            return cls(arrays["labels"], arrays["order"], arrays["counts"], tuple(int(s) for s in arrays["shape"]),
+                       arrays["affine"], header = header, names = names)
+
+    @property
+    def n_labels(self):
+        return len(self.labels)
+
+    def positions(self, roi_nums):
+        """Positions of the labels `roi_nums` in ``labels`` (-1 for labels not in the atlas)."""
+
+        roi_nums = np.atleast_1d(roi_nums)
+        pos = np.searchsorted(self.labels, roi_nums)
+        pos = np.minimum(pos, self.n_labels - 1)
+
+        return np.where(self.labels[pos] == roi_nums, pos, -1)
+
+    def _values(self, img):
+
+        data = _image_data(img)
+
+        if data.shape[0:3] != self.shape:
+            raise ValueError(f"Image shape {data.shape} does not match the atlas shape {self.shape}")
+        if data.ndim == 4:
+            data = data[:, :, :, 0]
+
+        return data.ravel()[self.order]
+
+    def reduce(self, img, stat = "mean"):
+        """Value of `stat` for every label of one image.
+
+        :param img: nibabel image, path or array with the shape of the atlas
+        :param stat: one of "mean", "sum", "std" (population), "median", "count", "volume" (mm3)
+        :return: array with one value per label, in the order of ``labels``
+        """
+        if stat == "count":
+            return self.counts.copy()
+        if stat == "volume":
+            return self.counts * self.voxel_volume
+
+        values = self._values(img)
+        starts = self.offsets[:-1]
+
+        sums = np.add.reduceat(values, starts)
+
+        if stat == "sum":
+            return sums
+
+        means = sums / self.counts
+
+        if stat == "mean":
+            return means
+
+        if stat == "std":
+            deviations = values - np.repeat(means, self.counts)
+            return np.sqrt(np.add.reduceat(deviations * deviations, starts) / self.counts)
+
+        if stat == "median":
+            # sort the values inside every label segment
+            label_of_value = np.repeat(np.arange(self.n_labels), self.counts)
+            values = values[np.lexsort((values, label_of_value))]
+            lower = values[starts + (self.counts - 1) // 2]
+            upper = values[starts + self.counts // 2]
+            return (lower + upper) / 2
+
+        raise ValueError(f"Unknown statistic {stat}, expected one of {STATS}")
+
+    def reduce_many(self, images, stat = "mean", n_jobs = 4):
+        """Value of `stat` for every label of a list of images.
+
+        :return: array of shape (n_images, n_labels)
+        """
+        with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+            rows = list(executor.map(lambda img: self.reduce(img, stat), images))
+
+        return np.vstack(rows) if rows else np.zeros((0, self.n_labels))
+
+    def stats(self, img, stats = STATS):
+        """Table of statistics of one image, one row per label (ROI_NUM, [ROI_NAME], stats...)."""
+
+        table = pd.DataFrame({"ROI_NUM": self.labels})
+
+        if self.names is not None:
+            table["ROI_NAME"] = self.names
+
+        for stat in stats:
+            table[stat] = self.reduce(img, stat)
+
+        return table
+
+    def paint(self, values, fill = 0):
+        """Image with `values` (one per label, in the order of ``labels``) written on every ROI.
+
+        :return: float32 nifti image with the geometry of the atlas
+        """
+        values = np.asarray(values, dtype = np.float32)
+
+        if values.shape != (self.n_labels,):
+            raise ValueError(f"Expected {self.n_labels} values, got {values.shape}")
+
+        volume = np.full(int(np.prod(self.shape)), fill, dtype = np.float32)
+        volume[self.order] = np.repeat(values, self.counts)
+
+        header = self.header.copy() if self.header is not None else None
+        if header is not None:
+            header.set_data_dtype(np.float32)
+
+        return nib.Nifti1Image(volume.reshape(self.shape), self.affine, header = header)
+
+
+def label_stats(img, atlas_img, stats = STATS):
+    """Statistics of an image for every label of an atlas, in one pass.
+
+    :param img: nibabel image or path
+    :param atlas_img: atlas nibabel image, path or a LabelIndex
+    :param stats: statistics to compute, any of "mean", "sum", "std", "median", "count", "volume"
+    :return: pandas DataFrame with one row per label
+    """
+    index = atlas_img if isinstance(atlas_img, LabelIndex) else LabelIndex.from_image(atlas_img)
+
+    return index.stats(img, stats)
+
+
+def _companion_csv(atlas_path):
+    """CSV next to the atlas whose name is the longest prefix of the atlas name
+    (e.g. Harvard_Oxford.csv for Harvard_Oxford_cat12_1.5mm_LZ.nii.gz)."""
+
+    atlas_name = basename(atlas_path).split(".nii")[0]
+    candidates = [csv for csv in glob.glob(join(dirname(atlas_path), "*.csv"))
+                  if atlas_name.startswith(basename(csv)[0:-4])]
+
+    return max(candidates, key = len) if candidates else None
+
+
+def _roi_names(csv_path, labels):
+
+    atlas_df = pd.read_csv(csv_path)
+
+    if "ROI_NUM" in atlas_df and "ROI_NAME" in atlas_df:
+        nums, names = atlas_df["ROI_NUM"], atlas_df["ROI_NAME"]
+    else:
+        nums, names = atlas_df.iloc[:, 0], atlas_df.iloc[:, 1]
+
+    name_of = dict(zip(pd.to_numeric(nums, errors = "coerce"), names.astype(str)))
+
+    return [name_of.get(label, "") for label in labels]
+
+
+def load_atlas_index(atlas_path, csv_path = None, cache_dir = None):
+    """LabelIndex of an atlas file, built on first use and then read from the cache.
+
+    :param atlas_path: path of the atlas image
+    :param csv_path: csv with the ROI names (ROI_NUM, ROI_NAME). By default the companion
+        csv of the atlas, if there is one
+    :param cache_dir: directory of the cached indexes, defaults to <user cache>/atlas
+    :return: LabelIndex with the ROI names joined from the csv
+    """
+    if cache_dir is None:
+        cache_dir = join(default_cache_dir(), "atlas")
+
+    if csv_path is None:
+        csv_path = _companion_csv(atlas_path)
+
+    key = file_digest(atlas_path)
+    if csv_path is not None:
+        key = f"{key[0:32]}_{file_digest(csv_path)[0:32]}"
+
+    cache_file = join(cache_dir, f"{key}.npz")
+
+    if exists(cache_file):
+        try:
+            cached = LabelIndex.load(cache_file)
+            # entries written before the header was stored are rebuilt
+            if cached.header is not None:
+                return cached
+        except (OSError, ValueError, KeyError):
+            pass  # corrupted entry, rebuilt below
+
+    index = LabelIndex.from_image(nib.load(atlas_path))
+
+    if csv_path is not None:
+        index.names = _roi_names(csv_path, index.labels)
+
+    index.save(cache_file)
+
+    return index
@@ -0,0 +1,272 @@
+"""
+Content-addressed cache for the outputs of anapyze processing steps.
+
+A step is identified by a key hashed from the content of its input files, its
+parameters, the step name and the tool version (anapyze plus whatever external
+tool the step runs, e.g. "CAT12 r2556"). The outputs of a computed step are
+copied into a managed store under that key, so a later run with the same inputs
+and parameters restores them instead of recomputing, even if the inputs were
+moved or renamed. Changing a parameter or the tool version gives a new key.
+
+The store is kept under `max_size_gb` by evicting the least recently used
+entries. Batched steps (one m-file for many subjects) can use ``fetch`` and
+``store`` per subject around the batch; single steps can use ``run``.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from os.path import join, exists, expanduser, basename, getsize, getmtime
+
+
+def default_cache_dir():
+    """User cache directory for anapyze ($XDG_CACHE_HOME/anapyze or ~/.cache/anapyze)."""
+
+    root = os.environ.get("XDG_CACHE_HOME", join(expanduser("~"), ".cache"))
+    return join(root, "anapyze")
+
+
+def anapyze_version():
+
+    try:
+        from importlib.metadata import version
+        return version("anapyze")
+    except Exception:
+        return "unknown"
+
+
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file content, memoized on (path, size, mtime) for the current process."""
+
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+    with _hash_lock:
+        if memo_key in _hash_memo:
+            return _hash_memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    digest = sha.hexdigest()
+
+    with _hash_lock:
+        _hash_memo[memo_key] = digest
+
+    return digest
+
+
+def _same_copy(stored, output):
+    """True if `output` is the stored file (hard link) or a copy2 of it."""
+
+    if not exists(output):
+        return False
+
+    a, b = os.stat(stored), os.stat(output)
+
+    return (a.st_ino, a.st_dev) == (b.st_ino, b.st_dev) or (a.st_size == b.st_size and
+                                                           a.st_mtime_ns == b.st_mtime_ns)
+
+
+class ResultCache:
+    """Managed store of step outputs keyed on inputs, parameters and tool version.
+
+    :param store_dir: directory of the store, defaults to <user cache>/results
+    :param max_size_gb: the least recently used entries are evicted above this size
+    :param link: restore outputs as hard links instead of copies (same file system only)
+    """
+
+    def __init__(self, store_dir=None, max_size_gb=50, link=False):
+
+        if store_dir is None:
+            store_dir = join(default_cache_dir(), "results")
+
+        self.store_dir = store_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.link = link
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def key(self, step, input_files, params=None, tool_version=None):
+        """Key of a step: hash of the step name, input contents, parameters and versions."""
+
+        if type(input_files) is str:
+            input_files = [input_files]
+
+        description = {
+            "step": step,
+            "inputs": [file_digest(f) for f in input_files],
+            "params": params or {},
+            "tool_version": tool_version,
+            "anapyze_version": anapyze_version(),
+        }
+
+        encoded = json.dumps(description, sort_keys=True, default=str).encode()
+
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _entry_dir(self, key):
+        return join(self.store_dir, key[0:2], key)
+
+    def fetch(self, key, output_files=None, root=None):
+        """Restores the outputs stored under `key` to `output_files`.
+
+        Outputs stored with a `root` can be restored without listing them: pass
+        output_files=None and the root they are restored under. Outputs that are
+        already in place (same size and modification time as the stored copy) are
+        left untouched.
+
+        :return: True on a cache hit, False if the key is not in the store
+        """
+        if type(output_files) is str:
+            output_files = [output_files]
+
+        entry_dir = self._entry_dir(key)
+        entry_file = join(entry_dir, "entry.json")
+
+        if not exists(entry_file):
+            return False
+
+        with open(entry_file) as f:
+            entry = json.load(f)
+
+        if output_files is None:
+            if root is None or "paths" not in entry:
+                return False
+            output_files = [join(root, path) for path in entry["paths"]]
+
+        if len(entry["outputs"]) != len(output_files):
+            return False
+
+        for stored, output in zip(entry["outputs"], output_files):
+
+            stored = join(entry_dir, stored)
+            if _same_copy(stored, output):
+                continue
+
+            out_dir = os.path.dirname(output)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            if exists(output):
+                os.remove(output)
+
+            if self.link:
+                try:
+                    os.link(stored, output)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(stored, output)
+
+        # the modification time of entry.json is the last access used for LRU eviction
+        os.utime(entry_file)
+
+        return True
+
+    def store(self, key, output_files, step=None, root=None):
+        """Copies `output_files` into the store under `key` and evicts old entries if needed.
+
+        :param root: if given, the paths of the outputs relative to it are recorded, so
+            ``fetch(key, root=...)`` can restore the whole set under another root
+        """
+
+        if type(output_files) is str:
+            output_files = [output_files]
+
+        missing = [f for f in output_files if not exists(f)]
+        if missing:
+            raise FileNotFoundError(f"Outputs not found, nothing cached: {missing}")
+
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entry_dir))
+
+        stored = []
+        for n, output in enumerate(output_files):
+            name = f"{n:03d}_{basename(output)}"
+            shutil.copy2(output, join(tmp_dir, name))
+            stored.append(name)
+
+        entry = {"step": step, "outputs": stored, "size": sum(getsize(f) for f in output_files),
+                 "created": time.time()}
+        if root is not None:
+            entry["paths"] = [os.path.relpath(f, root) for f in output_files]
+
+        with open(join(tmp_dir, "entry.json"), "w") as f:
+            json.dump(entry, f)
+
+        if exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.replace(tmp_dir, entry_dir)
+
+        self.evict()
+
+    def run(self, step, func, input_files, output_files, params=None, tool_version=None):
+        """Runs a step through the cache.
+
+        :param step: name of the step (e.g. "smooth_image")
+        :param func: function without arguments that computes and writes `output_files`
+        :param input_files: files the result depends on
+        :param output_files: files written by `func`
+        :param params: dict of parameters that change the result
+        :param tool_version: version of the external tool used by the step
+        :return: True if the outputs were restored from the cache, False if they were computed
+        """
+        key = self.key(step, input_files, params, tool_version)
+
+        if self.fetch(key, output_files):
+            return True
+
+        func()
+        self.store(key, output_files, step=step)
+
+        return False
+
+    def entries(self):
+        """List of (entry_dir, size in bytes, last access time) of the stored entries."""
+
+        found = []
+
+        for prefix in os.listdir(self.store_dir):
+            prefix_dir = join(self.store_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_file = join(prefix_dir, key, "entry.json")
+                if key.startswith(".tmp_") or not exists(entry_file):
+                    continue
+                with open(entry_file) as f:
+                    size = json.load(f)["size"]
+                found.append((join(prefix_dir, key), size, getmtime(entry_file)))
+
+        return found
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the store fits in max_size_gb."""
+
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+
+        for entry_dir, size, _ in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        os.makedirs(self.store_dir, exist_ok=True)
@@ -0,0 +1,191 @@
+"""
+On-disk, memory-mapped store of a co-registered cohort for voxel-wise statistics.
+
+A ``CohortCube`` packs the in-mask voxels of a list of images into one
+subjects x voxels float32 matrix (``data.npy``, opened with np.memmap) next to
+the mask (``mask.npy``) and a ``meta.json`` with the affine, image shape and
+subject identifiers. It is built once per cohort and mask; the statistics then
+read it in blocks of voxels, so the size of the cohort is not limited by RAM and
+the images are not decoded again for every analysis.
+
+    cube = CohortCube.build("/data/cube_gm", images, mask_img, subject_ids)
+    for voxels, block in cube.iter_voxel_blocks():
+        ...  # block is a (n_subjects, n_block_voxels) float32 array
+    img = cube.to_image(values)
+"""
+
+import os
+import json
+import shutil
+import numbers
+import numpy as np
+import nibabel as nib
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+
+from anapyze.core.image_access import get_volume
+
+
+def _load(img):
+    return nib.load(img) if type(img) is str else img
+
+
+class CohortCube:
+    """Memory-mapped subjects x masked-voxels matrix of a cohort.
+
+    :param directory: directory written by ``CohortCube.build``
+    :param mode: np.load mmap mode, "r" (read only) or "r+" (read/write)
+    """
+
+    def __init__(self, directory, mode = "r"):
+
+        meta_file = join(directory, "meta.json")
+        if not exists(meta_file):
+            raise FileNotFoundError(f"No cohort cube in {directory} (meta.json not found)")
+
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+        self.directory = directory
+        self.subject_ids = meta["subject_ids"]
+        self.sources = meta.get("sources")
+        self.shape = tuple(meta["shape"])
+        self.affine = np.array(meta["affine"])
+        self.mask = np.load(join(directory, "mask.npy"))
+        self.data = np.load(join(directory, "data.npy"), mmap_mode = mode)
+
+    @classmethod
+    def build(cls, directory, images, mask = None, subject_ids = None, n_jobs = 4, overwrite = False):
+        """Writes the cube of a cohort.
+
+        :param directory: output directory (created)
+        :param images: list of co-registered 3D nibabel images or nifti paths
+        :param mask: mask image, array or path; voxels > 0 are stored. Defaults to all the voxels
+        :param subject_ids: identifiers of the images, defaults to the file paths or their index
+        :param n_jobs: number of images read at the same time
+        :param overwrite: replace an existing cube in `directory`
+        :return: the opened CohortCube
+        """
+        if exists(join(directory, "meta.json")):
+            if not overwrite:
+                raise FileExistsError(f"A cohort cube already exists in {directory}")
+            shutil.rmtree(directory)
+
+        os.makedirs(directory, exist_ok = True)
+
+        if subject_ids is None:
+            subject_ids = [img if type(img) is str else str(i) for i, img in enumerate(images)]
+        if len(subject_ids) != len(images):
+            raise ValueError("subject_ids and images must have the same length")
+
+        reference = _load(images[0])
+        shape = reference.shape[0:3]
+        affine = reference.affine
+
+        if mask is None:
+            mask_data = np.ones(shape, dtype = bool)
+        else:
+            mask = _load(mask)
+            if hasattr(mask, "dataobj"):
+                mask_data = get_volume(mask) > 0
+            else:
+                mask_data = np.asarray(mask)
+                if mask_data.ndim == 4:
+                    mask_data = mask_data[:, :, :, 0]
+                mask_data = mask_data > 0
+
+        if mask_data.shape != shape:
+            raise ValueError(f"Mask shape {mask_data.shape} does not match image shape {shape}")
+
+        np.save(join(directory, "mask.npy"), mask_data)
+
+        data = np.lib.format.open_memmap(join(directory, "data.npy"), mode = "w+", dtype = np.float32,
+                                         shape = (len(images), int(mask_data.sum())))
+
+        def write_row(n):
+            img = _load(images[n])
+            if img.shape[0:3] != shape:
+                raise ValueError(f"{subject_ids[n]}: shape {img.shape} does not match {shape}")
+            if not np.allclose(img.affine, affine, atol = 1e-3):
+                raise ValueError(f"{subject_ids[n]}: affine does not match the first image")
+            img_data = get_volume(img)
+            data[n, :] = img_data[mask_data]
+
+        with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+            list(executor.map(write_row, range(len(images))))
+
+        data.flush()
+        del data
+
+        meta = {
+            "subject_ids": [str(s) for s in subject_ids],
+            "sources": [img if type(img) is str else None for img in images],
+            "shape": [int(s) for s in shape],
+            "affine": affine.tolist(),
+        }
+
+        # meta.json is written last, so an interrupted build is not taken for a cube
+        with open(join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent = 1)
+
+        return cls(directory)
+
+    @property
+    def n_subjects(self):
+        return self.data.shape[0]
+
+    @property
+    def n_voxels(self):
+        return self.data.shape[1]
+
+    def subject_index(self, subject_ids):
+        """Row numbers of a list of subject identifiers."""
+
+        rows = {s: n for n, s in enumerate(self.subject_ids)}
+        return [rows[str(s)] for s in subject_ids]
+
+    def iter_voxel_blocks(self, block_size = None, max_block_mb = 256, subjects = None):
+        """Iterates over the cube in blocks of voxels.
+
+        :param block_size: number of voxels per block, by default as many as fit in max_block_mb
+        :param max_block_mb: memory of one block when block_size is not given
+        :param subjects: optional list of rows (ints) to read, in that order
+        :return: generator of (voxel slice, float32 array of shape (n_subjects, n_block_voxels))
+        """
+        n_rows = self.n_subjects if subjects is None else len(subjects)
+
+        if block_size is None:
+            block_size = max(1, int(max_block_mb * 1024 ** 2 // (4 * max(n_rows, 1))))
+
+        for start in range(0, self.n_voxels, block_size):
+            voxels = slice(start, min(start + block_size, self.n_voxels))
+            if subjects is None:
+                block = np.array(self.data[:, voxels])
+            else:
+                block = np.array(self.data[subjects, voxels])
+            yield voxels, block
+
+    def subject_image(self, subject):
+        """Image of one subject (row number or identifier), zero outside the mask."""
+
+        row = int(subject) if isinstance(subject, numbers.Integral) else self.subject_index([subject])[0]
+        return self.to_image(self.data[row])
+
+    def to_image(self, values, fill = 0):
+        """Scatters a vector of masked-voxel values (or a (k, n_voxels) array) back into an image.
+
+        :return: float32 nifti image, 3D for a vector and 4D for a 2D array
+        """
+        values = np.asarray(values)
+
+        if values.shape[-1] != self.n_voxels:
+            raise ValueError(f"Expected {self.n_voxels} values per volume, got {values.shape[-1]}")
+
+        if values.ndim == 1:
+            volume = np.full(self.shape, fill, dtype = np.float32)
+            volume[self.mask] = values
+        else:
+            volume = np.full(self.shape + (values.shape[0],), fill, dtype = np.float32)
+            volume[self.mask] = values.T
+
+        return nib.Nifti1Image(volume, self.affine)
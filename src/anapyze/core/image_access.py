@@ -0,0 +1,175 @@
+"""
+Lazy access to image data through the nibabel ``dataobj`` proxies.
+
+``img.get_fdata()`` always produces (and by default caches on the image) a
+float64 copy of the whole array. ``get_data`` instead slices the proxy, so only
+the requested frame or slab is read and scaled, and converts it to the requested
+dtype (float32 by default). Nothing is cached unless asked for with
+``cache=True``; ``clear_cache`` releases what was cached.
+
+    b0 = get_data(dwi_img, frame = 0)           # one volume of a 4D series
+    top = get_data(img, slab = np.s_[:, :, 60:])  # a block of axial slices
+
+``masked_blocks`` reads the in-mask voxels of a list of co-registered images as
+subjects x voxels blocks, one slab of axial slices at a time, for the
+mass-univariate statistics.
+"""
+
+import os
+import threading
+import weakref
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+_image_cache = weakref.WeakKeyDictionary()
+_path_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _normalize_slab(slab):
+
+    if slab is None:
+        return (slice(None),) * 3
+
+    if type(slab) is not tuple:
+        slab = (slab,)
+
+    return tuple(slab) + (slice(None),) * (3 - len(slab))
+
+
+def _slab_key(slab):
+    return tuple((s.start, s.stop, s.step) if isinstance(s, slice) else s for s in slab)
+
+
+def get_data(img, dtype = np.float32, frame = None, slab = None, cache = False):
+    """Reads the data of an image, or a part of it, without loading the rest.
+
+    :param img: nibabel image or path to an image
+    :param dtype: dtype of the returned array (float32 by default)
+    :param frame: for 4D images, index of the volume to read (None reads every volume)
+    :param slab: index of the spatial part to read, e.g. np.s_[:, :, 10:20] (None reads the whole volume)
+    :param cache: keep the result in memory for the next calls with the same arguments
+    :return: numpy array owned by the caller (unless cached), scaled by the image slope/intercept
+    """
+    slab = _normalize_slab(slab)
+    dtype = np.dtype(dtype)
+
+    if type(img) is str:
+        stat = os.stat(img)
+        cache_key = (os.path.realpath(img), stat.st_mtime_ns)
+        store = _path_cache
+    else:
+        cache_key = img
+        store = _image_cache
+
+    request = (dtype.str, frame, _slab_key(slab))
+
+    if cache:
+        with _cache_lock:
+            cached = store.get(cache_key, {}).get(request)
+        if cached is not None:
+            return cached
+
+    loaded = nib.load(img) if type(img) is str else img
+    dataobj = loaded.dataobj
+
+    index = slab
+    if len(loaded.shape) > 3:
+        index = slab + (slice(None) if frame is None else frame,)
+    elif frame not in (None, 0):
+        raise IndexError(f"Frame {frame} requested from a 3D image")
+
+    data = np.asanyarray(dataobj[index])
+
+    if isinstance(dataobj, np.ndarray) and np.shares_memory(data, dataobj):
+        # in-memory image: never hand out a view of the image array
+        data = np.array(data, dtype = dtype)
+    else:
+        data = data.astype(dtype, copy = False)
+
+    if cache:
+        data.setflags(write = False)
+        with _cache_lock:
+            store.setdefault(cache_key, {})[request] = data
+
+    return data
+
+
+def get_volume(img, dtype = np.float32, cache = False):
+    """3D data of an image: the first volume of a 4D image, the whole data of a 3D one."""
+
+    shape = img.shape if not type(img) is str else nib.load(img).shape
+    frame = 0 if len(shape) > 3 else None
+
+    data = get_data(img, dtype = dtype, frame = frame, cache = cache)
+
+    # (x, y, z, 1, ...) images
+    return data.reshape(data.shape[0:3]) if data.ndim > 3 else data
+
+
+def clear_cache(img = None):
+    """Drops the cached arrays of one image (object or path), or of every image."""
+
+    with _cache_lock:
+        if img is None:
+            _image_cache.clear()
+            _path_cache.clear()
+        elif type(img) is str:
+            real_path = os.path.realpath(img)
+            for key in [k for k in _path_cache if k[0] == real_path]:
+                del _path_cache[key]
+        else:
+            _image_cache.pop(img, None)
+
+
+def _slabs(mask_data, n_subjects, max_block_mb):
+    """Groups of axial slices whose in-mask voxels fit in max_block_mb (float64 rows)."""
+
+    per_slice = mask_data.sum(axis = (0, 1))
+    max_voxels = max(1, int(max_block_mb * 1024 ** 2 // (8 * max(n_subjects, 1))))
+
+    start, count = 0, 0
+    for z, n in enumerate(per_slice):
+        if count and count + n > max_voxels:
+            yield start, z
+            start, count = z, 0
+        count += n
+
+    yield start, len(per_slice)
+
+
+def masked_blocks(images, mask_data, max_block_mb = 256, n_jobs = 4, dtype = np.float32):
+    """In-mask voxels of a list of images, one slab of axial slices at a time.
+
+    Only the slab is read from every image (the first volume of 4D images), by `n_jobs`
+    threads. The slabs are sized so that a float64 copy of a block fits in `max_block_mb`.
+
+    :param images: list of co-registered images or paths
+    :param mask_data: 3D boolean array of the voxels to read
+    :param max_block_mb: memory of one block
+    :param n_jobs: number of images read at the same time
+    :param dtype: dtype of the blocks
+    :return: generator of (positions of the voxels in the vector of in-mask voxels,
+        (n_images, n_block_voxels) array)
+    """
+    images = [nib.load(img) if type(img) is str else img for img in images]
+
+    # position of every in-mask voxel in the vector of in-mask voxels
+    positions = (np.cumsum(mask_data.ravel()) - 1).reshape(mask_data.shape)
+
+    for z0, z1 in _slabs(mask_data, len(images), max_block_mb):
+
+        slab_mask = mask_data[:, :, z0:z1]
+        if not slab_mask.any():
+            continue
+
+        def read(img):
+            frame = 0 if len(img.shape) > 3 else None
+            data = get_data(img, dtype = dtype, frame = frame, slab = np.s_[:, :, z0:z1])
+            return data.reshape(data.shape[0:3])[slab_mask]
+
+        with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+            block = np.vstack(list(executor.map(read, images)))
+
+        yield positions[:, :, z0:z1][slab_mask], block
@@ -0,0 +1,269 @@
+"""
+Opt-in instrumentation of the anapyze processing and analysis steps.
+
+When enabled (``enable_instrumentation(path)`` or the ANAPYZE_PROFILE environment
+variable set to a file path), every function decorated with ``@instrumented``
+appends one JSON line to the sink with:
+
+  - step, subject label (see ``subject_label``), status and start time
+  - wall time, CPU time of the process and CPU time of finished child processes
+  - peak RSS of the process and bytes read/written by the process (Linux)
+  - seconds spent in external tools, measured with the ``external_tool`` context
+    manager around subprocess calls. anapyze wraps its MATLAB and FreeSurfer
+    calls (recon-all, mri_synthstrip); it does not call FSL or ANTs, so scripts
+    that do can wrap them with ``external_tool("fsl")`` or ``external_tool("ants")``
+
+CPU, RSS and I/O counters are process-wide, so steps running concurrently in
+threads share them. When disabled the decorator only adds one check per call.
+Functions submitted to thread pools should be wrapped with ``with_context`` so
+the workers keep the subject label and add their tool time to the calling step.
+
+Summary per step::
+
+    anapyze-profile summary profile.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import pandas as pd
+
+_sink = os.environ.get("ANAPYZE_PROFILE") or None
+_sink_lock = threading.Lock()
+_tools_lock = threading.Lock()
+
+_subject = contextvars.ContextVar("anapyze_subject", default=None)
+_open_records = contextvars.ContextVar("anapyze_open_records", default=())
+
+
+def enable_instrumentation(path):
+    """Starts appending step records to the JSON-lines file `path`."""
+
+    global _sink
+    _sink = path
+
+
+def disable_instrumentation():
+
+    global _sink
+    _sink = None
+
+
+def is_enabled():
+    return _sink is not None
+
+
+@contextmanager
+def subject_label(label):
+    """Labels the records of the steps run inside the block with a subject identifier."""
+
+    token = _subject.set(label)
+    try:
+        yield
+    finally:
+        _subject.reset(token)
+
+
+@contextmanager
+def external_tool(name):
+    """Adds the time spent inside the block to the `name` tool time of the running steps."""
+
+    if _sink is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        # records can be shared by worker threads (see with_context)
+        with _tools_lock:
+            for record in _open_records.get():
+                record[name] = record.get(name, 0.0) + elapsed
+
+
+def with_context(func):
+    """Wraps `func` to run in a copy of the caller's context, for thread pool workers.
+
+    Threads start with an empty context, so without it the subject label and the
+    open step records of the caller are lost inside the workers.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # a context cannot be entered by two threads at once, each call gets its own copy
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def _io_counters():
+
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _max_rss_mb():
+
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def _children_cpu():
+
+    if resource is None:
+        return 0.0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _write(record):
+
+    line = json.dumps(record, default=str)
+
+    with _sink_lock:
+        with open(_sink, "a") as f:
+            f.write(line + "\n")
+
+
+def instrumented(func):
+    """Decorator recording wall/CPU time, memory, I/O and tool time of a step."""
+
+    step = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        if _sink is None:
+            return func(*args, **kwargs)
+
+        tools = {}
+        token = _open_records.set(_open_records.get() + (tools,))
+
+        started = time.time()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children_cpu = _children_cpu()
+        read_0, written_0 = _io_counters()
+
+        status = "ok"
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            status = f"error: {type(e).__name__}"
+            raise
+        finally:
+            _open_records.reset(token)
+            read_1, written_1 = _io_counters()
+
+            _write({
+                "step": step,
+                "subject": _subject.get(),
+                "status": status,
+                "start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+                "wall_s": round(time.perf_counter() - wall, 4),
+                "cpu_s": round(time.process_time() - cpu, 4),
+                "children_cpu_s": round(_children_cpu() - children_cpu, 4),
+                "max_rss_mb": _max_rss_mb(),
+                "read_bytes": None if read_0 is None else read_1 - read_0,
+                "written_bytes": None if written_0 is None else written_1 - written_0,
+                "tools_s": {name: round(seconds, 4) for name, seconds in tools.items()},
+                "pid": os.getpid(),
+            })
+
+    return wrapper
+
+
+def load_records(path):
+    """Reads a JSON-lines sink into a DataFrame, with one tool_<name>_s column per tool."""
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    records_df = pd.DataFrame(records)
+
+    if "tools_s" in records_df:
+        tools = pd.DataFrame(list(records_df.pop("tools_s").apply(lambda t: t or {})), index=records_df.index)
+        tools.columns = [f"tool_{name}_s" for name in tools.columns]
+        records_df = pd.concat([records_df, tools], axis=1)
+
+    return records_df
+
+
+def summarize(path):
+    """Aggregates the records of a sink per step.
+
+    :return: DataFrame indexed by step with calls, errors, subjects, wall/CPU times,
+        peak RSS, bytes read/written and total seconds per external tool
+    """
+    records = load_records(path)
+
+    grouped = records.groupby("step")
+
+    summary = pd.DataFrame({
+        "calls": grouped.size(),
+        "errors": grouped["status"].apply(lambda s: int((s != "ok").sum())),
+        "subjects": grouped["subject"].nunique(),
+        "wall_total_s": grouped["wall_s"].sum(),
+        "wall_mean_s": grouped["wall_s"].mean(),
+        "wall_max_s": grouped["wall_s"].max(),
+        "cpu_total_s": grouped["cpu_s"].sum(),
+        "children_cpu_total_s": grouped["children_cpu_s"].sum(),
+        "max_rss_mb": grouped["max_rss_mb"].max(),
+        "read_mb": grouped["read_bytes"].sum() / 1024 ** 2,
+        "written_mb": grouped["written_bytes"].sum() / 1024 ** 2,
+    })
+
+    for column in records.columns:
+        if column.startswith("tool_"):
+            summary[column[0:-2] + "_total_s"] = grouped[column].sum()
+
+    return summary.sort_values("wall_total_s", ascending=False)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="anapyze-profile",
+                                     description="Summaries of anapyze instrumentation records")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser("summary", help="aggregate the records per step")
+    summary_parser.add_argument("records", help="JSON-lines file written by the instrumentation")
+    summary_parser.add_argument("-o", "--output", help="also write the summary to this csv")
+
+    args = parser.parse_args(argv)
+
+    summary = summarize(args.records)
+
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(summary.round(3))
+
+    if args.output:
+        summary.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
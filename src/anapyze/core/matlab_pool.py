@@ -0,0 +1,376 @@
+"""
+Persistent MATLAB workers for running the generated SPM/CAT12 m-files.
+
+Starting MATLAB and warming up SPM (``addpath``, ``spm('defaults')``,
+``spm_jobman('initcfg')``) is often slower than the batch itself. A
+``MatlabPool`` keeps ``n_workers`` MATLAB processes alive and sends them
+m-files through their stdin pipe. Each worker answers with a status token on
+stdout, which is how jobs, health checks and timeouts are tracked.
+
+Once a pool is registered with ``start_matlab_pool`` every call to
+``processor.run_matlab_command`` is routed to it; without a pool the usual
+one-shot ``matlab -batch`` execution is used.
+"""
+
+import queue
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from os.path import join, abspath
+
+READY_TOKEN = "__ANAPYZE_READY__"
+DONE_TOKEN = "__ANAPYZE_DONE__"
+FAILED_TOKEN = "__ANAPYZE_FAILED__"
+
+WORKER_NAME = "anapyze_matlab_worker"
+
+_worker_template = """function {name}()
+% anapyze persistent worker: runs the m-files received on stdin.
+{warmup}
+fprintf('{ready}\\n');
+while true
+    cmd = input('', 's');
+    if strcmp(cmd, 'EXIT')
+        break;
+    elseif strcmp(cmd, 'PING')
+        fprintf('{ready}\\n');
+    elseif strncmp(cmd, 'RUN ', 4)
+        try
+            run_job(strtrim(cmd(5:end)));
+            fprintf('{done}\\n');
+        catch err
+            fprintf('{failed} %s\\n', strrep(err.message, newline, ' '));
+        end
+    end
+end
+end
+
+function run_job(mfile)
+% Runs the job in its own workspace so the batches cannot clash.
+run(mfile);
+end
+"""
+
+
+def _warmup_commands(spm_path):
+
+    if not spm_path:
+        return ""
+
+    return (f"addpath('{spm_path}');\n"
+            "spm('defaults','fmri');\n"
+            "spm_jobman('initcfg');")
+
+
+class MatlabWorker:
+    """A single MATLAB process that executes m-files sent through its stdin.
+
+    :param matlab_cmd: MATLAB executable (or a stub that speaks the same protocol)
+    :param worker_dir: directory holding the worker m-file
+    :param startup_timeout: seconds to wait for the worker to become ready
+    """
+
+    def __init__(self, matlab_cmd, worker_dir, startup_timeout=300):
+
+        self.matlab_cmd = matlab_cmd
+        self.worker_dir = worker_dir
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.restarts = 0
+        self._stdout = queue.Queue()
+        self._stderr = []
+
+    def start(self):
+
+        command = shlex.split(self.matlab_cmd) + ["-nosplash", "-sd", self.worker_dir, "-batch", WORKER_NAME]
+
+        self._stdout = queue.Queue()
+        self._stderr = []
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, text=True, bufsize=1)
+
+        threading.Thread(target=self._pump, args=(self.process.stdout, self._stdout.put, True), daemon=True).start()
+        threading.Thread(target=self._pump, args=(self.process.stderr, self._stderr.append, False), daemon=True).start()
+
+        status, _ = self._read_until(self.startup_timeout)
+
+        if status != READY_TOKEN:
+            self.kill()
+            raise RuntimeError(f"MATLAB worker did not start ({status}): {''.join(self._stderr)}")
+
+    @staticmethod
+    def _pump(stream, push, mark_eof):
+        for line in stream:
+            push(line)
+        if mark_eof:
+            push(None)
+
+    def _read_until(self, timeout):
+        """Collects stdout lines until a status token is read.
+
+        :return: (status, log) where status is one of the tokens, "timeout" or "crashed"
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        log = []
+
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return "timeout", "".join(log)
+            try:
+                line = self._stdout.get(timeout=remaining)
+            except queue.Empty:
+                return "timeout", "".join(log)
+
+            if line is None:
+                return "crashed", "".join(log)
+
+            stripped = line.strip()
+            if stripped == READY_TOKEN or stripped == DONE_TOKEN:
+                return stripped, "".join(log)
+            if stripped.startswith(FAILED_TOKEN):
+                log.append(stripped[len(FAILED_TOKEN):].strip() + "\n")
+                return FAILED_TOKEN, "".join(log)
+
+            log.append(line)
+
+    def _send(self, command):
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+            return True
+        except (BrokenPipeError, OSError, ValueError):
+            return False
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ping(self, timeout=30):
+        """Health check: the worker must answer a PING within `timeout` seconds."""
+
+        if not self.is_alive() or not self._send("PING"):
+            return False
+
+        status, _ = self._read_until(timeout)
+        return status == READY_TOKEN
+
+    def run(self, mfile, timeout=None):
+        """Runs an m-file in the worker.
+
+        :param mfile: path to the m-file
+        :param timeout: seconds before the job is aborted and the worker killed
+        :return: status token ("timeout" and "crashed" included) and the job log
+        """
+        self._stderr.clear()
+
+        if not self._send("RUN " + abspath(mfile)):
+            return "crashed", "".join(self._stderr)
+
+        status, log = self._read_until(timeout)
+
+        if self._stderr:
+            log += "".join(self._stderr)
+
+        return status, log
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def stop(self, timeout=30):
+        if self.is_alive():
+            self._send("EXIT")
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                pass
+        self.kill()
+
+    def restart(self):
+        self.kill()
+        self.restarts += 1
+        self.start()
+
+
+class MatlabPool:
+    """Keeps `n_workers` warm MATLAB processes and dispatches m-files to them.
+
+    Jobs block until a worker is idle, so the pool can be shared by several threads.
+    A worker that crashes or exceeds the job timeout is killed and restarted, and the
+    job raises an Exception like a failed ``matlab -batch`` call does.
+
+    :param n_workers: number of MATLAB processes to keep alive
+    :param matlab_cmd: MATLAB executable
+    :param spm_path: if set, the workers add SPM to the path and run ``spm_jobman('initcfg')`` on start
+    :param job_timeout: default per-job timeout in seconds (None waits forever)
+    :param startup_timeout: seconds allowed for a worker to start and warm up
+    """
+
+    def __init__(self, n_workers=2, matlab_cmd="/usr/local/MATLAB/R2025a/bin/matlab", spm_path=None,
+                 job_timeout=None, startup_timeout=300):
+
+        self.n_workers = n_workers
+        self.matlab_cmd = matlab_cmd
+        self.spm_path = spm_path
+        self.job_timeout = job_timeout
+        self.startup_timeout = startup_timeout
+
+        self.workers = []
+        self._idle = queue.Queue()
+        self._worker_dir = None
+
+    def start(self):
+
+        self._worker_dir = tempfile.mkdtemp(prefix="anapyze_matlab_")
+
+        with open(join(self._worker_dir, WORKER_NAME + ".m"), "w") as f:
+            f.write(_worker_template.format(name=WORKER_NAME, warmup=_warmup_commands(self.spm_path),
+                                            ready=READY_TOKEN, done=DONE_TOKEN, failed=FAILED_TOKEN))
+
+        for _ in range(self.n_workers):
+            worker = MatlabWorker(self.matlab_cmd, self._worker_dir, self.startup_timeout)
+            worker.start()
+            self.workers.append(worker)
+            self._idle.put(worker)
+
+        return self
+
+    def run(self, mfile, timeout=None):
+        """Runs an m-file on the next idle worker.
+
+        :param mfile: path to the m-file
+        :param timeout: per-job timeout in seconds, defaults to the pool's `job_timeout`
+        :return: the MATLAB output of the job
+        """
+        if timeout is None:
+            timeout = self.job_timeout
+
+        worker = self._idle.get()
+        if worker is None:
+            # sentinel left by the recovery of the last worker
+            self._idle.put(None)
+            raise RuntimeError("The MATLAB pool has no live workers")
+
+        try:
+            if not worker.is_alive():
+                dead, worker = worker, None
+                worker = self._recover(dead)
+
+            status, log = worker.run(mfile, timeout)
+
+            if status in ("timeout", "crashed"):
+                dead, worker = worker, None
+                worker = self._recover(dead)
+                raise Exception(f"MATLAB worker {status} while running {mfile}\n{log}")
+
+            if status == FAILED_TOKEN:
+                raise Exception(log)
+
+            return log
+
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def _recover(self, worker):
+        """Restarts a worker. A worker that cannot be restarted is dropped from the pool
+        and a new one is started in its place.
+
+        :return: the worker to put back in the idle queue
+        """
+        try:
+            worker.restart()
+            return worker
+        except Exception:
+            worker.kill()
+            self.workers.remove(worker)
+
+        replacement = MatlabWorker(self.matlab_cmd, self._worker_dir, self.startup_timeout)
+        try:
+            replacement.start()
+        except Exception:
+            if not self.workers:
+                self._idle.put(None)
+            raise
+
+        self.workers.append(replacement)
+        return replacement
+
+    def health_check(self, timeout=30):
+        """Pings every idle worker and restarts those that do not answer.
+
+        :return: list of booleans, True for workers that were healthy
+        """
+        checked = []
+
+        for _ in range(len(self.workers)):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            if worker is None:
+                self._idle.put(None)
+                break
+
+            healthy = worker.ping(timeout)
+            checked.append(healthy)
+            if not healthy:
+                worker = self._recover(worker)
+
+            self._idle.put(worker)
+
+        return checked
+
+    def close(self):
+
+        for worker in self.workers:
+            worker.stop()
+
+        self.workers = []
+        self._idle = queue.Queue()
+
+        if self._worker_dir is not None:
+            shutil.rmtree(self._worker_dir, ignore_errors=True)
+            self._worker_dir = None
+
+    def __enter__(self):
+        if not self.workers:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_active_pool = None
+
+
+def start_matlab_pool(n_workers=2, matlab_cmd="/usr/local/MATLAB/R2025a/bin/matlab", spm_path=None,
+                      job_timeout=None, startup_timeout=300):
+    """Starts a MatlabPool and routes ``run_matlab_command`` through it."""
+
+    global _active_pool
+
+    stop_matlab_pool()
+    _active_pool = MatlabPool(n_workers, matlab_cmd, spm_path, job_timeout, startup_timeout).start()
+
+    return _active_pool
+
+
+def stop_matlab_pool():
+    """Closes the active pool; ``run_matlab_command`` goes back to one-shot MATLAB calls."""
+
+    global _active_pool
+
+    if _active_pool is not None:
+        _active_pool.close()
+        _active_pool = None
+
+
+def get_matlab_pool():
+    return _active_pool
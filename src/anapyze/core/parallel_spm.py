@@ -0,0 +1,151 @@
+"""
+Sharded execution of the SPM batches generated in ``anapyze.io.spm``.
+
+``smooth_images_spm``, ``old_normalize_spm`` and ``new_deformations`` put a whole
+cohort in a single m-file that one MATLAB process works through image by image.
+The functions here split the image list into balanced shards, write one m-file
+per shard and run the shards concurrently (through the MATLAB pool if one is
+active). The shard logs are merged next to `mfile_name` and every image gets a
+status row, so failures can be traced back to single images.
+"""
+
+import os
+import time
+from os.path import exists, join, getsize, getmtime
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from anapyze.io import spm
+from anapyze.core import processor
+from anapyze.core.instrumentation import with_context
+
+
+def split_balanced(images, n_shards):
+    """Splits a list of images into `n_shards` groups of similar total file size.
+
+    Images are assigned largest first to the lightest shard, which keeps both the
+    number of images and the amount of data per shard balanced.
+
+    :param images: list of image paths
+    :param n_shards: number of shards
+    :return: list of lists of image indexes (empty shards are dropped)
+    """
+    n_shards = max(1, min(n_shards, len(images)))
+
+    sizes = [getsize(i) if exists(i) else 0 for i in images]
+    order = sorted(range(len(images)), key=lambda i: sizes[i], reverse=True)
+
+    shards = [[] for _ in range(n_shards)]
+    loads = [0] * n_shards
+
+    for i in order:
+        lightest = min(range(n_shards), key=lambda s: (loads[s], len(shards[s])))
+        shards[lightest].append(i)
+        loads[lightest] += sizes[i]
+
+    return [sorted(shard) for shard in shards if shard]
+
+
+def _output_path(image, prefix):
+    img_dir, img_name = os.path.split(image)
+    return join(img_dir, prefix + img_name)
+
+
+def run_sharded_spm_batch(generate_mfile, images, mfile_name, output_prefix, n_shards=4, max_parallel=None):
+    """Runs an SPM batch split in shards of images.
+
+    :param generate_mfile: function (mfile_name, shard_images) that writes the m-file of a shard
+    :param images: list of images to process
+    :param mfile_name: path of the m-file of the full batch; shards are written as <name>_shardNN.m
+    :param output_prefix: prefix SPM adds to the output images (e.g. "s" for smoothing)
+    :param n_shards: number of m-files the images are split into
+    :param max_parallel: maximum number of shards running at the same time, defaults to n_shards
+    :return: pandas DataFrame with one row per image (image, output, shard, status, error)
+    """
+    if type(images) is str:
+        images = [images]
+
+    shards = split_balanced(images, n_shards)
+
+    if max_parallel is None:
+        max_parallel = len(shards)
+
+    mfile_root = mfile_name[0:-2]
+
+    def run_shard(item):
+
+        n, indexes = item
+        shard_mfile = f"{mfile_root}_shard{n + 1:02d}.m"
+        generate_mfile(shard_mfile, [images[i] for i in indexes])
+
+        # outputs left by earlier runs must be rewritten after `start` to count as done
+        existing = {i for i in indexes if exists(_output_path(images[i], output_prefix))}
+        start = time.time()
+        try:
+            log = processor.run_matlab_command(shard_mfile)
+            error = None
+        except Exception as e:
+            log = str(e)
+            error = str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)
+
+        return n, shard_mfile, start, existing, log, error
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        results = list(executor.map(with_context(run_shard), enumerate(shards)))
+
+    rows = [None] * len(images)
+
+    with open(mfile_root + ".log", "w") as merged_log:
+
+        for n, shard_mfile, start, existing, log, error in results:
+
+            merged_log.write(f"===== {os.path.basename(shard_mfile)} ({len(shards[n])} images) =====\n")
+            merged_log.write((log or "") + "\n")
+
+            for i in shards[n]:
+                output = _output_path(images[i], output_prefix)
+
+                if exists(output) and (i not in existing or getmtime(output) >= start):
+                    status = "ok"
+                elif error is not None:
+                    status = "failed"
+                else:
+                    status = "missing_output"
+
+                rows[i] = {"image": images[i], "output": output, "shard": n + 1,
+                           "status": status, "error": error if status != "ok" else None}
+
+    report = pd.DataFrame(rows)
+
+    n_failed = int((report["status"] != "ok").sum())
+    print(f"{len(images) - n_failed}/{len(images)} images processed in {len(shards)} shards")
+
+    return report
+
+
+def smooth_images_spm_sharded(images_to_smooth, smoothing, mfile_name, n_shards=4, max_parallel=None,
+                              spm_path="/Users/jsilva/software/spm12"):
+
+    def generate(shard_mfile, shard_images):
+        spm.generate_mfile_smooth_imgs(spm_path, shard_mfile, shard_images, smoothing)
+
+    return run_sharded_spm_batch(generate, images_to_smooth, mfile_name, "s", n_shards, max_parallel)
+
+
+def old_normalize_spm_sharded(images_to_norm, template_image, mfile_name, n_shards=4, max_parallel=None,
+                              spm_path="/Users/jsilva/software/spm12"):
+
+    def generate(shard_mfile, shard_images):
+        spm.generate_mfile_old_normalize(spm_path, shard_mfile, shard_images, template_image)
+
+    return run_sharded_spm_batch(generate, images_to_norm, mfile_name, "w", n_shards, max_parallel)
+
+
+def new_deformations_sharded(images_to_deform, def_matrix, interpolation, mfile_name, n_shards=4,
+                             max_parallel=None, spm_path="/Users/jsilva/software/spm12"):
+
+    def generate(shard_mfile, shard_images):
+        spm.generate_mfile_new_deformations(spm_path, shard_mfile, def_matrix, shard_images, interpolation)
+
+    return run_sharded_spm_batch(generate, images_to_deform, mfile_name, "w", n_shards, max_parallel)
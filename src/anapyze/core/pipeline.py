@@ -0,0 +1,234 @@
+"""
+Small DAG scheduler for per-subject processing pipelines.
+
+Each ``Stage`` declares, for a subject, the function that processes it, the
+files it produces and the stages of the same subject it depends on. A
+``Pipeline`` expands the stages over a list of subjects into (subject, stage)
+nodes and runs every node as soon as its dependencies are finished, within a
+CPU and memory budget. Subject A does not wait for subject Z, so the wall time
+of a cohort approaches the longest single-subject path instead of the sum of
+the numbered scripts.
+
+A node whose outputs already exist is skipped (unless one of its dependencies
+was re-run), so an interrupted run resumes from the first missing output.
+Every node keeps a count of its unfinished dependencies, so when a node
+finishes only its children are checked (outputs and inputs on disk), not the
+whole cohort.
+"""
+
+import os
+import time
+import traceback
+from os.path import exists
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from anapyze.core.instrumentation import subject_label, with_context
+
+
+class Stage:
+    """A processing step applied to every subject.
+
+    :param name: unique name of the stage
+    :param func: function(subject) that processes one subject
+    :param outputs: function(subject) returning the list of files the stage writes
+    :param inputs: optional function(subject) returning files that must exist before running
+    :param after: names of the stages (of the same subject) that must finish first
+    :param cpus: cores used by one run of the stage
+    :param mem_gb: memory used by one run of the stage
+    """
+
+    def __init__(self, name, func, outputs, inputs=None, after=(), cpus=1, mem_gb=0):
+
+        self.name = name
+        self.func = func
+        self.outputs = outputs
+        self.inputs = inputs
+        self.after = [after] if type(after) is str else list(after)
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+
+    def is_complete(self, subject):
+        outputs = self.outputs(subject)
+        return len(outputs) > 0 and all(exists(f) for f in outputs)
+
+    def missing_inputs(self, subject):
+        if self.inputs is None:
+            return []
+        return [f for f in self.inputs(subject) if not exists(f)]
+
+
+class Pipeline:
+    """A set of stages forming a DAG, run over a cohort of subjects.
+
+    :param stages: list of Stage objects
+    """
+
+    def __init__(self, stages):
+
+        self.stages = {}
+
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicated stage name: {stage.name}")
+            self.stages[stage.name] = stage
+
+        for stage in stages:
+            for dep in stage.after:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"The pipeline has a cycle through stage {name}")
+            state[name] = "visiting"
+            for dep in self.stages[name].after:
+                visit(dep)
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        return order
+
+    def run(self, subjects, max_cpus=None, max_mem_gb=None, force=False):
+        """Runs every stage for every subject.
+
+        :param subjects: list of subject identifiers passed to the stage functions
+        :param max_cpus: maximum number of cores used at the same time, defaults to all the cores
+        :param max_mem_gb: maximum memory used at the same time (None for no limit)
+        :param force: run every node even if its outputs already exist
+        :return: pandas DataFrame with subject, stage, status, seconds and error of every node
+        """
+        if max_cpus is None:
+            max_cpus = os.cpu_count()
+
+        depth = {}
+        for name in self.order:
+            depth[name] = 1 + max([depth[dep] for dep in self.stages[name].after], default=0)
+
+        nodes = [(subject, name) for subject in subjects for name in self.order]
+
+        # deeper stages first, so subjects are finished before new ones are started
+        priority = {node: (-depth[node[1]], i) for i, node in enumerate(nodes)}
+
+        # number of unfinished dependencies of every node, and the nodes that depend on it
+        n_waiting = {}
+        children = {node: [] for node in nodes}
+        for node in nodes:
+            subject, name = node
+            n_waiting[node] = len(self.stages[name].after)
+            for dep in self.stages[name].after:
+                children[(subject, dep)].append(node)
+
+        # nodes whose dependencies are finished, not checked yet
+        ready = [node for node in nodes if n_waiting[node] == 0]
+        # checked nodes waiting for cores or memory, in priority order
+        queue = []
+
+        status = {}
+        ran = set()
+        results = []
+        running = {}
+        free_cpus = max_cpus
+        free_mem = max_mem_gb
+
+        def finish(node, state, seconds=0.0, error=None):
+            status[node] = state
+            results.append({"subject": node[0], "stage": node[1], "status": state,
+                            "seconds": round(seconds, 2), "error": error})
+
+            # only the children of the finished node can become ready (or blocked)
+            for child in children[node]:
+                if child in status:
+                    continue
+                if state in ("done", "skipped"):
+                    n_waiting[child] -= 1
+                    if n_waiting[child] == 0:
+                        ready.append(child)
+                else:
+                    finish(child, "blocked")
+
+        def run_node(node):
+            subject, name = node
+            start = time.time()
+            try:
+                with subject_label(subject):
+                    self.stages[name].func(subject)
+                return node, "done", time.time() - start, None
+            except Exception as e:
+                print(f"{name} failed for {subject}: {e}")
+                return node, "failed", time.time() - start, traceback.format_exc(limit=3)
+
+        with ThreadPoolExecutor(max_workers=max_cpus) as executor:
+
+            while ready or queue or running:
+
+                checked = bool(ready)
+                while ready:
+                    node = ready.pop()
+                    subject, name = node
+                    stage = self.stages[name]
+
+                    rerun_upstream = any((subject, dep) in ran for dep in stage.after)
+                    if not force and not rerun_upstream and stage.is_complete(subject):
+                        finish(node, "skipped")
+                        continue
+
+                    missing = stage.missing_inputs(subject)
+                    if missing:
+                        finish(node, "missing_input", error=", ".join(missing))
+                        continue
+
+                    queue.append(node)
+
+                if checked:
+                    queue.sort(key=priority.get)
+
+                for node in list(queue):
+                    stage = self.stages[node[1]]
+
+                    cpus = min(stage.cpus, max_cpus)
+                    fits_mem = free_mem is None or stage.mem_gb <= free_mem or not running
+                    if cpus > free_cpus or not fits_mem:
+                        continue
+
+                    queue.remove(node)
+                    free_cpus -= cpus
+                    if free_mem is not None:
+                        free_mem -= stage.mem_gb
+                    running[executor.submit(with_context(run_node), node)] = (cpus, stage.mem_gb)
+
+                if not running:
+                    for node in queue:
+                        finish(node, "blocked")
+                    break
+
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in completed:
+                    cpus, mem_gb = running.pop(future)
+                    free_cpus += cpus
+                    if free_mem is not None:
+                        free_mem += mem_gb
+
+                    node, state, seconds, error = future.result()
+                    if state == "done":
+                        ran.add(node)
+                    finish(node, state, seconds, error)
+
+        report = pd.DataFrame(results, columns=["subject", "stage", "status", "seconds", "error"])
+        print(report["status"].value_counts().to_string())
+
+        return report
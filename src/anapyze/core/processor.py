@@ -1,27 +1,77 @@
 import nibabel as nib
 import numpy as np
+import pandas as pd
 import subprocess
 import os
+import glob
+import time
+import signal
+import shutil
+import hashlib
 from os.path import join, exists
 from concurrent.futures import ThreadPoolExecutor
 
 from anapyze.io import spm
 from anapyze.io import cat12
+from anapyze.core import matlab_pool
+from anapyze.core.instrumentation import instrumented, external_tool, subject_label, with_context
+from anapyze.core.image_access import get_data, get_volume
+from anapyze.core.cache import file_digest
 
 
-def run_matlab_command(mfile, matlab_cmd="/usr/local/MATLAB/R2025a/bin/matlab"):
+@instrumented
+def run_matlab_command(mfile, matlab_cmd="/usr/local/MATLAB/R2025a/bin/matlab", timeout=None):
+    """Runs an m-file in MATLAB.
+
+    If a pool was started with ``matlab_pool.start_matlab_pool`` the m-file is sent
+    to one of its warm workers, otherwise a new ``matlab -batch`` process is launched.
+
+    :param mfile: path to the m-file
+    :param matlab_cmd: MATLAB executable used for one-shot execution
+    :param timeout: seconds before the job is aborted
+    :return: the MATLAB output of the job
+    """
     mfile_path, mfile_name = os.path.split(mfile)
 
+    pool = matlab_pool.get_matlab_pool()
+
+    if pool is not None:
+        with external_tool("matlab"):
+            log = pool.run(mfile, timeout=timeout)
+        print(f"Successfully executed {mfile_name}")
+        return log
+
     command = f"{matlab_cmd} -nosplash -sd {mfile_path} -batch {mfile_name[0:-2]}"
     
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    with external_tool("matlab"):
+        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
 
     if len(result.stderr) == 0:
         print(f"Successfully executed {mfile_name}")
+        return result.stdout
     else:
         print(result)
         raise Exception(result.stderr)
 
+def _histogram_norm_value(fdg_values, template_values, mean_template):
+    """Scale factor and histogram mode used by the PET histogram normalization.
+
+    :param fdg_values: PET values inside the mask
+    :param template_values: template values inside the mask
+    :param mean_template: mean of `template_values`
+    :return: (scale applied to match the template mean, histogram normalization value)
+    """
+    scale = mean_template / np.mean(fdg_values)
+
+    division = template_values / (fdg_values * scale)
+    values, bins = np.histogram(division, 200, range=(0.5, 2))
+    amax = np.amax(values)
+    indx = np.where(values == amax)
+    norm_value = float(bins[indx][0])
+
+    return scale, norm_value
+
+@instrumented
 def intensity_normalize_pet_histogram(input_image, template, mask):
     """Normalizes an image using the mode of an intensity histogram.
     More info at: https://pubmed.ncbi.nlm.nih.gov/32771619/
@@ -33,30 +83,85 @@ def intensity_normalize_pet_histogram(input_image, template, mask):
     :return: the normalization value used to scale the input image
     """
 
-    fdg_data = input_image.get_fdata()
-    template_data = template.get_fdata()
-    mask_data = mask.get_fdata()
-
-    if len(mask.shape) == 4:
-        mask_data = mask_data[:, :, :, 0]
+    fdg_data = get_data(input_image, dtype = np.float64)
+    template_data = get_data(template, dtype = np.float64)
+    mask_data = get_volume(mask)
 
     indx = np.where(mask_data == 1)
-    mean_template = np.mean(template_data[indx])
-    mean_fdg = np.mean(fdg_data[indx])
+    template_values = template_data[indx]
+    mean_template = np.mean(template_values)
 
-    fdg_data = fdg_data * (mean_template / mean_fdg)
-
-    division = template_data[indx] / fdg_data[indx]
-    values, bins = np.histogram(division, 200, range=(0.5, 2))
-    amax = np.amax(values)
-    indx = np.where(values == amax)
-    norm_value = float(bins[indx][0])
-    norm_data = fdg_data * norm_value
+    scale, norm_value = _histogram_norm_value(fdg_data[indx], template_values, mean_template)
+    norm_data = fdg_data * scale * norm_value
 
     norm_img = nib.Nifti1Image(norm_data, input_image.affine, input_image.header)
 
     return norm_value, norm_img
 
+@instrumented
+def intensity_normalize_pet_histogram_cohort(input_images, template, mask, save = True,
+                                             output_suffix = "_normhist", n_jobs = None):
+    """Histogram intensity normalization for a whole cohort.
+
+    Same method as intensity_normalize_pet_histogram, but the template and the mask are
+    read only once: the mask index and the template values under the mask are computed
+    up front and the subjects are processed in a thread pool, read as float32.
+
+    :param input_images: list of PET images (paths or nibabel images)
+    :param template: template nibabel image
+    :param mask: mask nibabel image (voxels == 1 are used)
+    :param save: if True, the normalized images are written next to the inputs. nibabel images
+        must then have been loaded from a file (get_filename() is not None)
+    :param output_suffix: suffix added to the input file name for the normalized images
+    :param n_jobs: number of threads, defaults to the number of cores
+    :return: pandas DataFrame with the image, its normalization value and the output path
+    """
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    if save:
+        in_memory = [n for n, image in enumerate(input_images)
+                     if type(image) is not str and image.get_filename() is None]
+        if in_memory:
+            raise ValueError(f"save=True needs a file name for every image; images {in_memory} "
+                             "are in memory only")
+
+    mask_data = get_volume(mask)
+
+    indx = np.flatnonzero(mask_data == 1)
+    template_values = get_data(template, dtype = np.float64).ravel()[indx]
+    mean_template = np.mean(template_values)
+
+    del mask_data
+
+    def process_subject(image):
+
+        input_image = nib.load(image) if type(image) is str else image
+        fdg_data = get_data(input_image)
+
+        scale, norm_value = _histogram_norm_value(fdg_data.ravel()[indx].astype(np.float64),
+                                                  template_values, mean_template)
+
+        path = image if type(image) is str else input_image.get_filename()
+        output = None
+
+        if save:
+            name = os.path.basename(path)
+            ext = ".nii.gz" if name.endswith(".nii.gz") else os.path.splitext(name)[1]
+            output = join(os.path.dirname(path), name[0:-len(ext)] + output_suffix + ext)
+
+            fdg_data *= np.float32(scale * norm_value)
+            nib.save(nib.Nifti1Image(fdg_data, input_image.affine, input_image.header), output)
+
+        return {"image": path, "norm_value": norm_value, "output": output}
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+        rows = list(executor.map(with_context(process_subject), input_images))
+
+    return pd.DataFrame(rows)
+
+@instrumented
 def intensity_normalize_pet_ref_region(input_image, ref_region_img, ref_region_val=1):
     """Normalizes an image using a reference region.
     :param input_image: the path to the input image
@@ -64,115 +169,300 @@ def intensity_normalize_pet_ref_region(input_image, ref_region_img, ref_region_v
     :param ref_region_val:
     :return: the normalization value used to scale the input image
     """
-    ref_data = ref_region_img.get_fdata()
-
-    if len(ref_data) == 4:
-        ref_data = ref_data[:, :, :, 0]
+    ref_data = get_volume(ref_region_img)
 
     ref_vox = np.where(ref_data == ref_region_val)
-    img_data = input_image.get_fdata()
 
-    if len(img_data.shape) == 4:
-        img_data = img_data[:, :, :, 0]
+    # only the first frame of a 4D image is read
+    img_data = get_volume(input_image, dtype = np.float64)
 
-    ref_value = np.mean(img_data[ref_vox])
+    ref_value = np.mean(img_data[ref_vox], dtype = np.float64)
     normalized_data = img_data / ref_value
 
     normalized_img = nib.Nifti1Image(normalized_data, input_image.affine, input_image.header)
 
     return normalized_img, ref_value
 
-def histogram_matching(reference_img, input_img):
-    """Matches the histogram of an input image to a reference image.
+class ReferenceDistribution:
+    """Empirical intensity distribution of a reference image, used for histogram matching.
+
+    Building it sorts the whole reference volume (np.unique), so when a cohort is matched
+    to one template it should be built once and passed to histogram_matching or
+    logpow_histogram_matching for every subject. It can be saved to and loaded from .npz.
 
-    :param reference_nii: the path to the reference image
-    :param input_nii: the path to the input image
-    :param output_nii: the path to the output image
-    :return: None
+    :param values: sorted unique intensities of the reference
+    :param counts: number of voxels for each value
     """
 
-    nt_data = reference_img.get_fdata()
-    pt_data = input_img.get_fdata()
+    def __init__(self, values, counts):
 
-    # Stores the image data shape that will be used later
-    old_shape = pt_data.shape
+        self.values = np.asarray(values, dtype = np.float64)
+        self.counts = np.asarray(counts)
+        self._quantiles = {}
 
-    # Converts the data arrays to single dimension and normalizes by the maximum
-    nt_data_array = nt_data.ravel()
-    pt_data_array = pt_data.ravel()
+    @classmethod
+    def from_image(cls, reference_img, mask = None):
+        """Builds the distribution from a nibabel image, optionally only inside a mask image."""
 
-    # get the set of unique pixel values and their corresponding indices and counts
-    s_values, bin_idx, s_counts = np.unique(
-        pt_data_array, return_inverse=True, return_counts=True
-    )
-    t_values, t_counts = np.unique(nt_data_array, return_counts=True)
+        data = get_data(reference_img, dtype = np.float64)
 
-    # take the cumsum of the counts and normalize by the number of pixels to
-    # get the empirical cumulative distribution functions for the source and
-    # template images (maps pixel value --> quantile)
-    s_quantiles = np.cumsum(s_counts).astype(np.float64)
-    s_quantiles /= s_quantiles[-1]
-    t_quantiles = np.cumsum(t_counts).astype(np.float64)
-    t_quantiles /= t_quantiles[-1]
+        if mask is not None:
+            data = data[_mask_voxels(mask, data.shape)]
 
-    # interpolate linearly to find the pixel values in the template image
-    # that correspond most closely to the quantiles in the source image
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+        values, counts = np.unique(data.ravel(), return_counts = True)
 
-    # Reshapes the corresponding values to the indexes and reshapes the array to input
-    final_image_data = interp_t_values[bin_idx].reshape(old_shape)
+        return cls(values, counts)
 
-    final_image = nib.Nifti1Image(final_image_data, input_img.affine, input_img.header)
+    def quantiles(self, alpha = None, beta = None):
+        """Cumulative distribution of the reference (maps value --> quantile).
 
-    return final_image
+        If alpha and beta are given, the counts are log-power transformed first
+        as in logpow_histogram_matching.
+        """
+        key = (alpha, beta)
 
-def logpow_histogram_matching(reference_img, input_img, alpha: int = 1, beta: int = 3):
-    """Matches the histogram of an input image to a reference image using a log-power transformation.
-    More info: https://doi.org/10.1117/1.JEI.23.6.063017
+        if key not in self._quantiles:
+            counts = self.counts
+            if alpha is not None:
+                counts = np.power(np.log10(counts + alpha), beta)
 
-    :param reference_nii: the path to the reference image
-    :param input_nii: the path to the input image
-    :param output_nii: the path to the output image
-    :param alpha: the additive constant for the log transformation, defaults to 1
-    :param beta: the power exponent for the log transformation, defaults to 3
+            quantiles = np.cumsum(counts).astype(np.float64)
+            quantiles /= quantiles[-1]
+            self._quantiles[key] = quantiles
+
+        return self._quantiles[key]
+
+    def binned_cdf(self, n_bins):
+        """Cumulative distribution of the reference at `n_bins` equal-width bin edges.
+
+        :return: (bin edges, cdf at the edges), both of length n_bins + 1
+        """
+        key = ("binned", n_bins)
+
+        if key not in self._quantiles:
+            finite = np.isfinite(self.values)
+            self._quantiles[key] = _binned_cdf(self.values[finite], n_bins, self.counts[finite])[0:2]
+
+        return self._quantiles[key]
+
+    def save(self, path, source = ""):
+        """Writes the distribution to .npz; `source` identifies what it was built from."""
+        np.savez(path, values = self.values, counts = self.counts, source = np.array(source))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["values"], f["counts"])
+
+def _reference_source(reference_img_path, mask):
+    """Digest of the reference image content and of the mask voxels it is restricted to."""
+
+    source = file_digest(reference_img_path)
+
+    if mask is not None:
+        mask_data = get_volume(mask) != 0
+        sha = hashlib.sha256(str(mask_data.shape).encode())
+        sha.update(np.packbits(mask_data).tobytes())
+        source += "_" + sha.hexdigest()
+
+    return source
+
+@instrumented
+def load_reference_distribution(reference_img_path, cache_file, mask = None):
+    """Loads a ReferenceDistribution from `cache_file`, building and saving it the first time.
+
+    The cache stores the digests of the reference image and of the mask; a cache built
+    from a different reference or mask is rebuilt.
+
+    :param reference_img_path: path to the reference image
+    :param cache_file: .npz file where the distribution is stored
+    :param mask: optional nibabel mask image restricting the reference voxels
+    """
+    source = _reference_source(reference_img_path, mask)
+
+    if exists(cache_file):
+        with np.load(cache_file) as f:
+            if "source" in f.files and str(f["source"]) == source:
+                return ReferenceDistribution(f["values"], f["counts"])
+
+    reference = ReferenceDistribution.from_image(nib.load(reference_img_path), mask)
+    reference.save(cache_file, source)
+
+    return reference
+
+def _mask_voxels(mask, shape):
+
+    mask_data = get_volume(mask) != 0
+
+    if len(shape) == 4:
+        mask_data = np.repeat(mask_data[..., np.newaxis], shape[3], axis = 3)
+
+    return mask_data
+
+def _binned_cdf(values, n_bins, weights = None):
+    """Equal-width binned cumulative distribution of `values`, computed in O(N).
+
+    :return: (bin edges, cdf at the edges, continuous bin position of every value)
+    """
+    lo = values.min()
+    hi = values.max()
+    width = (hi - lo) / n_bins if hi > lo else 1
+
+    position = (values - lo) * (1 / width)
+    bins = np.minimum(position.astype(np.int32), n_bins - 1)
+
+    counts = np.bincount(bins, weights = weights, minlength = n_bins)
+    cdf = np.zeros(n_bins + 1)
+    cdf[1:] = np.cumsum(counts)
+    cdf /= cdf[-1]
+
+    edges = lo + width * np.arange(n_bins + 1)
+
+    return edges, cdf, position
+
+def _match_histogram_binned(reference, input_img, mask, n_bins):
+    """Histogram matching with fixed-width bins and float32 working memory.
+
+    The source CDF is linearly interpolated inside each bin, and the quantiles are
+    mapped through a lookup table of the reference inverse CDF sampled at n_bins
+    equally spaced quantiles, so every voxel is mapped in a single vectorized pass.
+    Non-finite voxels (NaN, inf) are left out of the histograms and kept unchanged.
     """
-    nt_data = reference_img.get_fdata()
-    pt_data = input_img.get_fdata()
+    pt_data = get_data(input_img)
+
+    if mask is not None:
+        voxels = _mask_voxels(mask, pt_data.shape)
+        pt_data_array = pt_data[voxels]
+    else:
+        pt_data_array = pt_data.ravel()
+
+    finite = np.isfinite(pt_data_array)
+    all_finite = bool(finite.all())
+    if not all_finite:
+        if not finite.any():
+            return nib.Nifti1Image(pt_data, input_img.affine, input_img.header)
+        pt_data_array_all = pt_data_array
+        pt_data_array = pt_data_array[finite]
+
+    if isinstance(reference, ReferenceDistribution):
+        t_edges, t_cdf = reference.binned_cdf(n_bins)
+    else:
+        t_data = get_data(reference)
+        t_data = t_data[_mask_voxels(mask, t_data.shape)] if mask is not None else t_data.ravel()
+        t_data = t_data[np.isfinite(t_data)]
+        t_edges, t_cdf = _binned_cdf(t_data, n_bins)[0:2]
+        del t_data
+
+    s_edges, s_cdf, position = _binned_cdf(pt_data_array, n_bins)
+    s_cdf = s_cdf.astype(np.float32)
+
+    # quantile of every voxel, interpolated inside its bin
+    bins = np.minimum(position.astype(np.int32), n_bins - 1)
+    position -= bins
+    quantiles = s_cdf[bins]
+    quantiles += position * (s_cdf[bins + 1] - s_cdf[bins])
+    del bins, position
+
+    # reference value of every quantile, from a lookup table of the inverse CDF
+    lut = np.interp(np.linspace(0, 1, n_bins + 1), t_cdf, t_edges).astype(np.float32)
+    quantiles *= n_bins
+    lut_idx = np.minimum(quantiles.astype(np.int32), n_bins - 1)
+    quantiles -= lut_idx
+    matched = lut[lut_idx]
+    matched += quantiles * (lut[lut_idx + 1] - lut[lut_idx])
+
+    if not all_finite:
+        pt_data_array_all[finite] = matched
+        matched = pt_data_array_all
+
+    if mask is not None:
+        pt_data[voxels] = matched
+        final_image_data = pt_data
+    else:
+        final_image_data = matched.reshape(pt_data.shape)
+
+    return nib.Nifti1Image(final_image_data, input_img.affine, input_img.header)
 
-    # Stores the image data shape that will be used later
-    old_shape = pt_data.shape
+def _match_histogram(reference, input_img, mask, alpha = None, beta = None):
 
-    # Converts the data arrays to single dimension and normalizes by the maximum
-    nt_data_array = nt_data.ravel()
-    pt_data_array = pt_data.ravel()
+    if not isinstance(reference, ReferenceDistribution):
+        reference = ReferenceDistribution.from_image(reference, mask)
+
+    pt_data = get_data(input_img, dtype = np.float64)
+
+    if mask is not None:
+        voxels = _mask_voxels(mask, pt_data.shape)
+        pt_data_array = pt_data[voxels]
+    else:
+        pt_data_array = pt_data.ravel()
 
     # get the set of unique pixel values and their corresponding indices and counts
-    s_values, bin_idx, s_counts = np.unique(pt_data_array, return_inverse=True, return_counts=True)
-    t_values, t_counts = np.unique(nt_data_array, return_counts=True)
+    s_values, bin_idx, s_counts = np.unique(pt_data_array, return_inverse = True, return_counts = True)
 
-    s_counts = np.power(np.log10(s_counts + alpha), beta)
-    t_counts = np.power(np.log10(t_counts + alpha), beta)
+    if alpha is not None:
+        s_counts = np.power(np.log10(s_counts + alpha), beta)
 
     # take the cumsum of the counts and normalize by the number of pixels to
     # get the empirical cumulative distribution functions for the source and
     # template images (maps pixel value --> quantile)
     s_quantiles = np.cumsum(s_counts).astype(np.float64)
     s_quantiles /= s_quantiles[-1]
-    t_quantiles = np.cumsum(t_counts).astype(np.float64)
-    t_quantiles /= t_quantiles[-1]
+    t_quantiles = reference.quantiles(alpha, beta)
 
     # interpolate linearly to find the pixel values in the template image
     # that correspond most closely to the quantiles in the source image
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+    interp_t_values = np.interp(s_quantiles, t_quantiles, reference.values)
+
+    # Maps the corresponding values to the indexes and reshapes the array to input
+    if mask is not None:
+        final_image_data = pt_data.copy()
+        final_image_data[voxels] = interp_t_values[bin_idx.ravel()]
+    else:
+        final_image_data = interp_t_values[bin_idx.ravel()].reshape(pt_data.shape)
 
-    # Reshapes the corresponding values to the indexes and reshapes the array to input
-    final_image_data = interp_t_values[bin_idx].reshape(old_shape)
-    # final_image_data[indx] = 0
+    return nib.Nifti1Image(final_image_data, input_img.affine, input_img.header)
 
-    final_image = nib.Nifti1Image(final_image_data, input_img.affine, input_img.header)
+@instrumented
+def histogram_matching(reference_img, input_img, mask = None, method = "exact", n_bins = 4096):
+    """Matches the histogram of an input image to a reference image.
 
-    return final_image
+    The "exact" method uses the CDF over every unique value, which needs a full sort of
+    the volume. The "binned" method builds fixed-width cumulative histograms of `n_bins`
+    bins in O(N) with float32 working memory; it is much faster and lighter on float PET
+    data at the cost of a small error, largest in the sparsely populated tails of the
+    histogram (see examples/benchmark_histogram_matching.py).
+
+    :param reference_img: the reference nibabel image, or a ReferenceDistribution built once for a cohort
+    :param input_img: the input nibabel image
+    :param mask: optional nibabel mask image; only voxels inside it are matched, the rest are kept
+    :param method: "exact" or "binned"
+    :param n_bins: number of bins for the "binned" method
+    :return: the matched image
+    """
 
+    if method == "exact":
+        return _match_histogram(reference_img, input_img, mask)
+    elif method == "binned":
+        return _match_histogram_binned(reference_img, input_img, mask, n_bins)
+    else:
+        raise ValueError("method must be exact or binned")
+
+@instrumented
+def logpow_histogram_matching(reference_img, input_img, alpha: int = 1, beta: int = 3, mask = None):
+    """Matches the histogram of an input image to a reference image using a log-power transformation.
+    More info: https://doi.org/10.1117/1.JEI.23.6.063017
+
+    :param reference_img: the reference nibabel image, or a ReferenceDistribution built once for a cohort
+    :param input_img: the input nibabel image
+    :param alpha: the additive constant for the log transformation, defaults to 1
+    :param beta: the power exponent for the log transformation, defaults to 3
+    :param mask: optional nibabel mask image; only voxels inside it are matched, the rest are kept
+    :return: the matched image
+    """
+
+    return _match_histogram(reference_img, input_img, mask, alpha = alpha, beta = beta)
+
+@instrumented
 def coregister_spm(reference_nii, input_nii, mfile_name, spm_path="/Users/jsilva/software/spm12"):
     """Performs coregistration between two images using SPM."""
 
@@ -181,12 +471,14 @@ def coregister_spm(reference_nii, input_nii, mfile_name, spm_path="/Users/jsilva
 
     run_matlab_command(mfile_name)
 
+@instrumented
 def old_normalize_spm(images_to_norm, template_image, mfile_name, spm_path="/Users/jsilva/software/spm12"):
 
     spm.generate_mfile_old_normalize(spm_path, mfile_name, images_to_norm, template_image)
 
     run_matlab_command(mfile_name)
 
+@instrumented
 def new_normalize_spm(images_to_norm, mfile_name, template_image = False, spm_path = "/Users/jsilva/software/spm12"):
 
     if template_image == False:
@@ -196,21 +488,25 @@ def new_normalize_spm(images_to_norm, mfile_name, template_image = False, spm_pa
 
     run_matlab_command(mfile_name)
 
+@instrumented
 def old_deformations(images_to_deform, base_image, def_matrix, interpolation, mfile_name, spm_path="/Users/jsilva/software/spm12"):
 
     spm.generate_mfile_old_deformations(spm_path, mfile_name, def_matrix, base_image, images_to_deform, interpolation)
     run_matlab_command(mfile_name)
 
+@instrumented
 def new_deformations(images_to_deform,def_matrix,interpolation,mfile_name, spm_path="/Users/jsilva/software/spm12"):
 
     spm.generate_mfile_new_deformations(spm_path, mfile_name, def_matrix, images_to_deform, interpolation)
     run_matlab_command(mfile_name)
 
+@instrumented
 def smooth_images_spm(images_to_smooth, smoothing, mfile_name, spm_path="/Users/jsilva/software/spm12"):
 
     spm.generate_mfile_smooth_imgs(spm_path, mfile_name, images_to_smooth, smoothing)
     run_matlab_command(mfile_name)
 
+@instrumented
 def cat12_segmentation_crossec(images_to_segment, mfile_name, template_tpm = False, template_volumes = False,
                                output_vox_size = 1.5, bounding_box = "cat12", surface_processing = 0,
                                spm_path="/Users/jsilva/software/spm12"):
@@ -228,6 +524,7 @@ def cat12_segmentation_crossec(images_to_segment, mfile_name, template_tpm = Fal
 
     run_matlab_command(mfile_name)
 
+@instrumented
 def cat12_segmentation_longit(images_to_segment, mfile_name, template_tpm = False, template_volumes = False,
                               output_vox_size = 1.5, bounding_box = "cat12", surface_processing = 0,
                               spm_path="/Users/jsilva/software/spm12"):
@@ -245,7 +542,75 @@ def cat12_segmentation_longit(images_to_segment, mfile_name, template_tpm = Fals
 
     run_matlab_command(mfile_name)
 
-def recon_all_freesurfer(t1_nii, t2_nii=False):
+def _run_recon_all(pat_dir, t1_nii, subject_name = "FS_out", n_threads = 1, timeout = None,
+                   recon_all_cmd = "recon-all"):
+    """Runs (or resumes) recon-all for one subject and waits for it.
+
+    A subject whose scripts/recon-all.done exists is skipped. If a previous run was
+    interrupted after the input was imported, it is resumed with "-make all" after
+    removing stale IsRunning lock files; otherwise recon-all starts from the T1.
+    The output of recon-all is appended to <pat_dir>/recon-all_<subject_name>.log.
+
+    :return: dict with the subject directory, status, return code, mode, minutes and log path
+    """
+    fs_dir = join(pat_dir, subject_name)
+    scripts_dir = join(fs_dir, "scripts")
+    log_file = join(pat_dir, f"recon-all_{subject_name}.log")
+
+    row = {"pat_dir": pat_dir, "status": None, "returncode": None, "mode": None,
+           "minutes": 0.0, "log": log_file}
+
+    if not exists(t1_nii):
+        row["status"] = "missing_t1"
+        return row
+
+    if exists(join(scripts_dir, "recon-all.done")):
+        row["status"] = "already_done"
+        return row
+
+    if exists(join(fs_dir, "mri", "orig", "001.mgz")):
+        row["mode"] = "resume"
+        for lock in glob.glob(join(scripts_dir, "IsRunning*")):
+            os.remove(lock)
+        if exists(join(scripts_dir, "recon-all.error")):
+            os.remove(join(scripts_dir, "recon-all.error"))
+        command = [recon_all_cmd, "-sd", pat_dir, "-s", subject_name, "-make", "all"]
+    else:
+        row["mode"] = "new"
+        if exists(fs_dir):
+            shutil.rmtree(fs_dir)
+        command = [recon_all_cmd, "-sd", pat_dir, "-i", t1_nii, "-s", subject_name, "-all"]
+
+    command += ["-openmp", str(n_threads)]
+
+    env = os.environ.copy()
+    env["OMP_NUM_THREADS"] = str(n_threads)
+    env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(n_threads)
+
+    start = time.time()
+
+    with open(log_file, "a") as log:
+        log.write(f"\n# {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(command)}\n")
+        log.flush()
+
+        # own process group, so a timeout kills recon-all and everything it launched
+        process = subprocess.Popen(command, stdout = log, stderr = subprocess.STDOUT, env = env,
+                                   start_new_session = True)
+        with external_tool("freesurfer"):
+            try:
+                row["returncode"] = process.wait(timeout = timeout)
+                row["status"] = "done" if row["returncode"] == 0 else "failed"
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                row["status"] = "timeout"
+
+    row["minutes"] = round((time.time() - start) / 60, 2)
+
+    return row
+
+@instrumented
+def recon_all_freesurfer(t1_nii, t2_nii=False, n_threads = 1, timeout = None, recon_all_cmd = "recon-all"):
 
     if "FREESURFER_HOME" in os.environ:
         pass
@@ -255,38 +620,79 @@ def recon_all_freesurfer(t1_nii, t2_nii=False):
     #directory containing the t1_nii file
     pat_dir = os.path.split(t1_nii)[0]
 
-    if exists(t1_nii):
-        os.system(f"recon-all -sd {pat_dir} -i {t1_nii} -s FS_out -all\n")
-    if exists(t1_nii) and exists(t2_nii):
+    row = _run_recon_all(pat_dir, t1_nii, n_threads = n_threads, timeout = timeout, recon_all_cmd = recon_all_cmd)
+
+    if t2_nii and exists(t1_nii) and exists(t2_nii):
         # TODO : hippocampal subfields
         pass
 
-def recon_all_freesurfer_whole_cohort(cohort_dir, pats: dict, n_parallel: int = 2) -> None:
+    return row["status"]
+
+@instrumented
+def recon_all_freesurfer_whole_cohort(cohort_dir, pats: dict, n_parallel: int = 2, n_cores: int = None,
+                                      timeout: float = None, subject_name = "FS_out",
+                                      recon_all_cmd = "recon-all", status_csv = None):
+    """Runs recon-all for a cohort, `n_parallel` subjects at a time.
+
+    The core budget `n_cores` is split between the concurrent jobs, each one running
+    recon-all with -openmp n_cores // n_parallel threads. Finished subjects are skipped
+    and interrupted ones resumed, so the function can simply be re-run on the cohort.
+
+    :param cohort_dir: directory with one folder per subject
+    :param pats: dict subject folder -> T1 file name (or a (T1, T2) tuple of file names)
+    :param n_parallel: number of subjects processed at the same time
+    :param n_cores: total number of cores to use, defaults to all the cores
+    :param timeout: maximum seconds per subject, as in recon_all_freesurfer (None for no limit)
+    :param subject_name: name of the FreeSurfer subject created in each subject folder
+    :param recon_all_cmd: recon-all executable
+    :param status_csv: if given, the final status table is also written to this csv
+    :return: pandas DataFrame with the status of every subject
+    """
 
     if "FREESURFER_HOME" in os.environ:
         pass
     else:
         raise Exception("FREESURFER_HOME environment variable not set")
 
+    if n_cores is None:
+        n_cores = os.cpu_count()
+
+    n_threads = max(1, n_cores // n_parallel)
+
+    columns = ["subject", "pat_dir", "status", "returncode", "mode", "minutes", "log"]
+    if not pats:
+        print("No subjects to process")
+        return pd.DataFrame(columns = columns)
+
     def process_patient(item: tuple):
 
-        pat, t1_name, t2_name = item
+        pat, names = item
+        t1_name = names if type(names) is str else names[0]
         pat_dir = join(cohort_dir, pat)
-        t1_nii = join(cohort_dir, pat, t1_name)
-        t2_nii = join(cohort_dir, pat, t2_name)
+        t1_nii = join(pat_dir, t1_name)
+
+        with subject_label(pat):
+            row = _run_recon_all(pat_dir, t1_nii, subject_name = subject_name, n_threads = n_threads,
+                                 timeout = timeout, recon_all_cmd = recon_all_cmd)
+        print(f"{pat}: {row['status']}")
+
+        # TODO : hippocampal subfields when a T2 is given
 
-        if exists(t1_nii):
-            os.system(f"recon-all -sd {pat_dir} -i {t1_nii} -s FS_out -all\n")
-        if exists(t1_nii) and exists(t2_nii):
-            # TODO : hippocampal subfields
-            pass
+        return dict(subject = pat, **row)
 
     with ThreadPoolExecutor(max_workers = n_parallel) as executor:
-        executor.map(process_patient, pats.items())
-        return None
+        status = pd.DataFrame(list(executor.map(with_context(process_patient), pats.items())), columns = columns)
+
+    print(status["status"].value_counts().to_string())
+
+    if status_csv:
+        status.to_csv(status_csv, index = False)
+
+    return status
 
     # TODO: Similar functions for SAMSEG and Synthseg
 
+@instrumented
 def synthstrip_skull_striping_freesurfer(img_to_strip: str, out_: str = False, includes_csf = True):
 
     if "FREESURFER_HOME" in os.environ:
@@ -303,7 +709,8 @@ def synthstrip_skull_striping_freesurfer(img_to_strip: str, out_: str = False, i
         csf_flag = '--no-csf'
 
     if exists(img_to_strip):
-        os.system(f"mri_synthstrip -i {img_to_strip} -o {out_} {csf_flag}")
+        with external_tool("freesurfer"):
+            os.system(f"mri_synthstrip -i {img_to_strip} -o {out_} {csf_flag}")
 
     else:
         raise FileExistsError("Input image does not exist")
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+Effective resolution (Mizutani FWHM) of whole cohorts.
+
+``estimate_fwhm_cohort`` runs ``utils.estimate_fwhm_mizutani`` for every
+(image, orientation) pair in a bounded process pool and appends one row per
+estimate to a csv as soon as the image finishes. A pool task is one image: it
+is hashed and read once and its orientations are estimated in turn, each on a
+single core, so the pool size is the number of cores used. Estimates are cached per file content
+(<user cache>/fwhm, keyed on the sha256 of the image and the parameters), so a
+re-run skips what is already in the table or in the cache, and an interrupted
+job resumes where it stopped. The same is available from the command line::
+
+    anapyze-fwhm -o fwhm.csv --list scans.txt -j 8
+"""
+
+import os
+import csv
+import json
+import argparse
+from os.path import join, exists
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from anapyze.core import utils
+from anapyze.core.cache import default_cache_dir, file_digest
+from anapyze.core.image_access import get_data
+
+ORIENTATIONS = ("axial", "coronal", "sagittal")
+COLUMNS = ["image", "sha256", "orientation", "bin_size", "n_segs", "fwhm", "sigma", "status", "error"]
+
+
+def _cache_file(cache_dir, digest, orientation, bin_size, n_segs):
+    return join(cache_dir, digest[0:2], f"{digest}_{orientation}_b{bin_size}_s{n_segs}.json")
+
+
+def _estimate(task):
+    """Worker: FWHM of one image in several orientations, from the cache when possible."""
+
+    image, orientations, bin_size, n_segs, cache_dir = task
+
+    rows = [{"image": image, "sha256": None, "orientation": orientation, "bin_size": bin_size,
+             "n_segs": n_segs, "fwhm": None, "sigma": None, "status": None, "error": None}
+            for orientation in orientations]
+
+    try:
+        digest = file_digest(image)
+    except Exception as e:
+        for row in rows:
+            row["status"] = "failed"
+            row["error"] = f"{type(e).__name__}: {e}"
+        return rows
+
+    img = None
+
+    for row in rows:
+        row["sha256"] = digest
+
+        try:
+            cache_file = _cache_file(cache_dir, digest, row["orientation"], bin_size, n_segs)
+
+            if exists(cache_file):
+                with open(cache_file) as f:
+                    row.update(json.load(f))
+                row["status"] = "cached"
+                continue
+
+            if img is None:
+                # read once for all the orientations
+                loaded = nib.load(image)
+                img = nib.Nifti1Image(get_data(loaded, dtype = np.float64), loaded.affine, loaded.header)
+
+            # one core per task: the pool already uses every core
+            fwhm, sigma = utils.estimate_fwhm_mizutani(img, bin_size = bin_size, n_segs = n_segs,
+                                                       orientation = row["orientation"], n_jobs = 1)
+            row["fwhm"], row["sigma"], row["status"] = float(fwhm), float(sigma), "ok"
+
+            os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"fwhm": row["fwhm"], "sigma": row["sigma"]}, f)
+            os.replace(tmp_file, cache_file)
+
+        except Exception as e:
+            row["status"] = "failed"
+            row["error"] = f"{type(e).__name__}: {e}"
+
+    return rows
+
+
+def estimate_fwhm_cohort(images, output_csv, orientations = ORIENTATIONS, bin_size = 5, n_segs = 2,
+                         n_workers = None, cache_dir = None):
+    """Mizutani FWHM and sigma of every image and orientation of a cohort.
+
+    Rows are appended to `output_csv` as the estimates finish. Pairs already in the
+    table with the same parameters are skipped, failed ones are retried.
+
+    :param images: list of nifti paths
+    :param output_csv: table with image, sha256, orientation, bin_size, n_segs, fwhm, sigma, status, error
+    :param orientations: planes to traverse (axial, coronal, sagittal)
+    :param bin_size: bin size of the Wilson plots (see estimate_fwhm_mizutani)
+    :param n_segs: number of segments of the piecewise fits
+    :param n_workers: number of estimates run at the same time, defaults to all the cores
+    :param cache_dir: directory of the per-file cache, defaults to <user cache>/fwhm
+    :return: pandas DataFrame with the whole table
+    """
+    if cache_dir is None:
+        cache_dir = join(default_cache_dir(), "fwhm")
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if type(orientations) is str:
+        orientations = [orientations]
+
+    done = set()
+    if exists(output_csv):
+        previous = pd.read_csv(output_csv)
+        previous = previous[previous["status"].isin(["ok", "cached"])]
+        done = set(zip(previous["image"], previous["orientation"], previous["bin_size"], previous["n_segs"]))
+
+    tasks = []
+    for image in images:
+        missing = [o for o in orientations if (image, o, bin_size, n_segs) not in done]
+        if missing:
+            tasks.append((image, missing, bin_size, n_segs, cache_dir))
+
+    n_estimates = sum(len(task[1]) for task in tasks)
+    print(f"{n_estimates} estimates to run, {len(images) * len(orientations) - n_estimates} already in {output_csv}")
+
+    new_file = not exists(output_csv)
+
+    with open(output_csv, "a", newline = "") as f, ProcessPoolExecutor(max_workers = n_workers) as executor:
+
+        writer = csv.DictWriter(f, fieldnames = COLUMNS)
+        if new_file:
+            writer.writeheader()
+
+        pending = iter(tasks)
+        running = set()
+        n_finished = 0
+
+        while True:
+            # keep at most 2 tasks per worker queued, so a huge list is not submitted at once
+            while len(running) < 2 * n_workers:
+                task = next(pending, None)
+                if task is None:
+                    break
+                running.add(executor.submit(_estimate, task))
+
+            if not running:
+                break
+
+            finished, running = wait(running, return_when = FIRST_COMPLETED)
+
+            n_before = n_finished
+            for future in finished:
+                for row in future.result():
+                    writer.writerow(row)
+                    n_finished += 1
+                    if row["status"] == "failed":
+                        print(f"{row['image']} ({row['orientation']}) failed: {row['error']}")
+
+            f.flush()
+
+            if n_finished // 50 > n_before // 50:
+                print(f"{n_finished}/{n_estimates} estimates finished")
+
+    table = pd.read_csv(output_csv)
+
+    # a pair retried after a failure appears twice, keep its last row
+    table = table.drop_duplicates(subset = ["image", "orientation", "bin_size", "n_segs"], keep = "last")
+
+    print(table["status"].value_counts().to_string())
+
+    return table.reset_index(drop = True)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(prog = "anapyze-fwhm",
+                                     description = "Mizutani FWHM of a list of images, resumable")
+    parser.add_argument("images", nargs = "*", help = "nifti images")
+    parser.add_argument("-l", "--list", help = "text file with one image path per line")
+    parser.add_argument("-o", "--output", required = True, help = "output csv (appended to when it exists)")
+    parser.add_argument("--orientations", nargs = "+", default = list(ORIENTATIONS), choices = ORIENTATIONS)
+    parser.add_argument("--bin-size", type = int, default = 5)
+    parser.add_argument("--n-segs", type = int, default = 2)
+    parser.add_argument("-j", "--workers", type = int, default = None, help = "parallel estimates")
+    parser.add_argument("--cache-dir", default = None)
+
+    args = parser.parse_args(argv)
+
+    images = list(args.images)
+    if args.list:
+        with open(args.list) as f:
+            images += [line.strip() for line in f if line.strip()]
+
+    if not images:
+        parser.error("no images given")
+
+    estimate_fwhm_cohort(images, args.output, orientations = args.orientations, bin_size = args.bin_size,
+                         n_segs = args.n_segs, n_workers = args.workers, cache_dir = args.cache_dir)
+
+
+if __name__ == "__main__":
+    main()
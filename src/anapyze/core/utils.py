@@ -1,12 +1,20 @@
 import nibabel as nib
 import numpy as np
-from scipy.ndimage import zoom
-from scipy.stats import t
+import os
+import threading
+from collections import OrderedDict
+from scipy.ndimage import map_coordinates, spline_filter
 import xmltodict
 import re
-from scipy.fftpack import fftn, fftshift
+from scipy.fft import fft2
 import pwlf
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from anapyze.core.instrumentation import instrumented
+from anapyze.core.cohort import CohortCube
+from anapyze.core.atlas import LabelIndex
+from anapyze.core.image_access import get_data, get_volume
+from anapyze.core.multiple_comparisons import correct_map
 
 def check_input_image_shape(img_data):
 
@@ -16,6 +24,7 @@ def check_input_image_shape(img_data):
 
     return img_data
 
+@instrumented
 def change_image_dtype(img, new_dtype):
     """
     Changes datatype for input image
@@ -25,8 +34,7 @@ def change_image_dtype(img, new_dtype):
     """
 
     # Change the data type of the image data
-    img_data = img.get_fdata()
-    new_img_data = img_data.astype(new_dtype)
+    new_img_data = get_data(img, dtype = new_dtype)
 
     # Create a new NIfTI or Analyze image with the changed data type
     if isinstance(img, nib.nifti1.Nifti1Image):
@@ -40,114 +48,193 @@ def change_image_dtype(img, new_dtype):
 
     return new_img
 
-def resample_image_by_matrix_size(img, target_shape, interpolation = "quadratic"):
+# scipy spline orders of the interpolation names used by the resampling functions
+INTERPOLATION_ORDERS = {
+    "nearest": 0,
+    "linear": 1,
+    "cubic": 3,
+    "quadratic": 4,
+    }
+
+_grid_cache = OrderedDict()
+_grid_cache_lock = threading.Lock()
+_GRID_CACHE_SIZE = 8
+
+
+def _grid_world_coordinates(target_affine, target_shape):
+    """World coordinates (3, n_voxels) of the voxels of a target grid, float32.
+
+    Kept in a small LRU cache keyed on the target grid only, so a cohort resliced to the
+    same grid (e.g. MNI) computes them once, whatever the affines of the source images.
+    """
+    key = (np.asarray(target_affine, dtype = np.float64).tobytes(), tuple(target_shape))
+
+    with _grid_cache_lock:
+        if key in _grid_cache:
+            _grid_cache.move_to_end(key)
+            return _grid_cache[key]
+
+    grid = np.indices(target_shape, dtype = np.float32).reshape(3, -1)
+    world = np.asarray(target_affine)[0:3, 0:3].astype(np.float32) @ grid
+    world += np.asarray(target_affine)[0:3, 3:4].astype(np.float32)
+
+    with _grid_cache_lock:
+        _grid_cache[key] = world
+        while len(_grid_cache) > _GRID_CACHE_SIZE:
+            _grid_cache.popitem(last = False)
+
+    return world
+
+
+def _grid_coordinates(source_affine, target_affine, target_shape):
+    """Source voxel coordinates (3, *target_shape) of the target grid voxels, float32.
+
+    The world coordinates of the target grid come from the cache, and only the inverse
+    affine of the source image is applied per call.
+    """
+    world = _grid_world_coordinates(target_affine, target_shape)
+
+    # world -> source voxel
+    inverse = np.linalg.inv(np.asarray(source_affine, dtype = np.float64))
+
+    coords = inverse[0:3, 0:3].astype(np.float32) @ world
+    coords += inverse[0:3, 3:4].astype(np.float32)
+
+    return coords.reshape((3,) + tuple(target_shape))
+
+
+def _voxel_sizes(affine):
+    return np.sqrt(np.sum(np.asarray(affine)[0:3, 0:3] ** 2, axis = 0))
+
+
+def _scaled_grid_affine(affine, scale):
+    """Affine of a grid covering the same field of view with voxels `scale` times the source ones."""
+
+    scale = np.asarray(scale, dtype = np.float64)
+
+    # target voxel i samples the source at (i + 0.5) * scale - 0.5
+    grid_to_source = np.eye(4)
+    grid_to_source[0:3, 0:3] = np.diag(scale)
+    grid_to_source[0:3, 3] = (scale - 1) / 2
+
+    return np.asarray(affine) @ grid_to_source
+
+
+@instrumented
+def resample_to_grid(img, target_affine, target_shape, interpolation = "linear", n_jobs = None, cval = 0.0):
+    """
+    Resamples an image onto the grid defined by an affine and a shape (e.g. 1.5 mm MNI).
+
+    The mapping uses the full affines, so rotations and origins are respected. The world
+    coordinates of a target grid are cached, and the grid is interpolated in slabs in
+    parallel threads, in float32.
+
+    :param img: nibabel image (3D or 4D, 4D volumes are resampled one by one)
+    :param target_affine: 4x4 affine of the target grid
+    :param target_shape: 3D shape of the target grid
+    :param interpolation: nearest, linear, cubic or quadratic. Nearest keeps integer
+        label images in their data type
+    :param n_jobs: number of threads, defaults to the number of cores
+    :param cval: value of the target voxels that fall outside the source image
+    :return: resampled image of the same class as `img`
+    """
+    if interpolation not in INTERPOLATION_ORDERS:
+        raise ValueError(f"interpolation must be one of {list(INTERPOLATION_ORDERS)}")
+
+    order = INTERPOLATION_ORDERS[interpolation]
+    target_affine = np.asarray(target_affine, dtype = np.float64)
+    target_shape = tuple(int(n) for n in target_shape[0:3])
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    dtype = np.float32
+    source_dtype = img.get_data_dtype()
+    unscaled = getattr(img.dataobj, "slope", 1) == 1 and getattr(img.dataobj, "inter", 0) == 0
+    if order == 0 and np.issubdtype(source_dtype, np.integer) and unscaled:
+        dtype = source_dtype
+
+    data = get_data(img, dtype = dtype)
+    volumes = data.reshape(data.shape[0:3] + (-1,))
+
+    coords = _grid_coordinates(img.affine, target_affine, target_shape)
+
+    out = np.empty(target_shape + (volumes.shape[3],), dtype = dtype)
+
+    # slabs along the first axis, so the coordinate and output slabs are contiguous
+    bounds = np.linspace(0, target_shape[0], min(n_jobs, target_shape[0]) + 1).astype(int)
+    slabs = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+
+        for v in range(volumes.shape[3]):
+
+            volume = volumes[..., v]
+            if order > 1:
+                # spline coefficients once per volume instead of once per slab
+                volume = spline_filter(volume, order = order, output = np.float32, mode = "constant")
+
+            def interpolate(slab):
+                out[slab, :, :, v] = map_coordinates(volume, coords[:, slab], order = order, mode = "constant",
+                                                     cval = cval, prefilter = False, output = dtype)
+
+            list(executor.map(interpolate, slabs))
+
+    out = out.reshape(target_shape + data.shape[3:])
+
+    header = img.header.copy()
+    header.set_data_dtype(dtype)
+
+    return img.__class__(out, target_affine, header)
+
+@instrumented
+def resample_image_by_matrix_size(img, target_shape, interpolation = "quadratic", n_jobs = None):
     """
+    Resamples an image to a new matrix size covering the same field of view.
+
     # Example usage
-    input_image_file = '/path/to/input/image/file.nii.gz'
-    output_resampled_image_file = '/path/to/output/resampled/image/file.nii.gz'
+    img = nib.load('/path/to/input/image/file.nii.gz')
     target_shape = (128, 128, 64)
     interpolation_method = 'quadratic'  # Specify the desired interpolation method
-    resample_image(input_image_file, output_resampled_image_file, target_shape, interpolation_method)
+    resampled_img = resample_image_by_matrix_size(img, target_shape, interpolation_method)
 
     Interpolation options: nearest, linear, cubic, quadratic
+    The affine keeps the rotations and origin of the input (see resample_to_grid).
     """
 
-    # Load NIfTI or Analyze image
-    img_data = img.get_fdata()
-
-    # Calculate zoom factors for each dimension
-    zoom_factors = np.array(target_shape) / np.array(img_data.shape)
-
-    # Determine the order of interpolation based on the given method
-    interpolation_methods = {
-        "nearest": 0,
-        "linear": 1,
-        "cubic": 3,
-        "quadratic": 4,
-        # Add more interpolation methods and their corresponding order values here
-        }
-    order = interpolation_methods.get(
-            interpolation, 1
-            )  # Default to linear if method not recognized
-
-    # Resample the image data using scipy's zoom function
-    resampled_img_data = zoom(img_data, zoom_factors, order = order)
-
-    # Update the affine matrix to reflect the new voxel dimensions
-    voxel_sizes = np.array(img.header.get_zooms()) * (
-            np.array(img_data.shape) / target_shape
-    )
-    new_affine = img.affine.copy()
-    np.fill_diagonal(new_affine, voxel_sizes)
-
-    # Create a new NIfTI or Analyze image with the resampled data and updated affine
-    if isinstance(img, nib.nifti1.Nifti1Image):
-        resampled_img = nib.Nifti1Image(
-                resampled_img_data, new_affine, header = img.header
-                )
-    elif isinstance(img, nib.analyze.AnalyzeImage):
-        header = img.header.copy()
-        header.set_data_shape(target_shape)
-        resampled_img: nib.AnalyzeImage = nib.analyze.AnalyzeImage(
-                resampled_img_data, new_affine, header
-                )
-    else:
-        raise TypeError("Unsupported image type. Input must be Nifti of Analyze")
+    source_shape = np.array(img.shape[0:3])
+    target_shape = tuple(int(n) for n in target_shape[0:3])
+
+    target_affine = _scaled_grid_affine(img.affine, source_shape / np.array(target_shape))
 
-    return resampled_img
+    return resample_to_grid(img, target_affine, target_shape, interpolation = interpolation, n_jobs = n_jobs)
 
-def resample_image_by_voxel_sizes(img, target_voxel_sizes, interpolation = "linear"):
+@instrumented
+def resample_image_by_voxel_sizes(img, target_voxel_sizes, interpolation = "linear", n_jobs = None):
     """
+    Resamples an image to new voxel sizes covering the same field of view.
+
     # Example usage
-    input_image_file = '/path/to/input/image/file.nii.gz'
-    output_resampled_image_file = '/path/to/output/resampled/image/file.nii.gz'
+    img = nib.load('/path/to/input/image/file.nii.gz')
     target_voxel_sizes = (2.0, 2.0, 2.0)  # Specify the desired voxel sizes
     interpolation_method = 'linear'  # Specify the desired interpolation method
 
-    resample_image_with_voxel_sizes(input_image_file, output_resampled_image_file, target_voxel_sizes, interpolation_method)
+    resampled_img = resample_image_by_voxel_sizes(img, target_voxel_sizes, interpolation_method)
+
+    Interpolation options: nearest, linear, cubic, quadratic
+    The affine keeps the rotations and origin of the input (see resample_to_grid).
     """
 
-    # Load NIfTI or Analyze image
-    img_data = img.get_fdata()
-
-    # Calculate zoom factors based on target voxel sizes
-    current_voxel_sizes = np.array(img.header.get_zooms())
-    zoom_factors = current_voxel_sizes / target_voxel_sizes
-
-    # Determine the order of interpolation based on the given method
-    interpolation_methods = {
-        "nearest": 0,
-        "linear": 1,
-        "cubic": 3,
-        "quadratic": 4,
-        # Add more interpolation methods and their corresponding order values here
-        }
-    order = interpolation_methods.get(
-            interpolation, 1
-            )  # Default to linear if method not recognized
-
-    # Resample the image data using scipy's zoom function
-    resampled_img_data = zoom(img_data, zoom_factors, order = order)
-
-    # Update the affine matrix to reflect the new voxel sizes
-    new_affine = img.affine.copy()
-    np.fill_diagonal(new_affine, target_voxel_sizes)
-
-    # Create a new NIfTI or Analyze image with the resampled data and updated affine
-    if isinstance(img, nib.nifti1.Nifti1Image):
-        resampled_img = nib.Nifti1Image(
-                resampled_img_data, new_affine, header = img.header
-                )
-    elif isinstance(img, nib.analyze.AnalyzeImage):
-        header = img.header.copy()
-        resampled_img = nib.analyze.AnalyzeImage(
-                resampled_img_data, new_affine, header
-                )
-    else:
-        raise TypeError("Unsupported image type. Input must be Nifti of Analyze")
+    scale = np.asarray(target_voxel_sizes, dtype = np.float64) / _voxel_sizes(img.affine)
 
-    return resampled_img
+    # same output matrix size as scipy zoom with factors current / target voxel sizes
+    target_shape = tuple(int(n) for n in np.round(np.array(img.shape[0:3]) / scale))
 
+    target_affine = _scaled_grid_affine(img.affine, scale)
+
+    return resample_to_grid(img, target_affine, target_shape, interpolation = interpolation, n_jobs = n_jobs)
+
+@instrumented
 def remove_nan_negs(img):
     """
     Removes nan and neg values from image
@@ -156,7 +243,7 @@ def remove_nan_negs(img):
     """
 
     # Load NIfTI or Analyze image
-    img_data = img.get_fdata()
+    img_data = get_data(img, dtype = np.float64)
 
     # Replace NaN and negative values with zeros
     img_data[np.isnan(img_data) | (img_data < 0)] = 0
@@ -172,11 +259,12 @@ def remove_nan_negs(img):
 
     return cleaned_img
 
+@instrumented
 def add_poisson_noise(img, intensity_scaling_factor: float = 1.0):
     """Adds poison noise to an image"""
     # Load NIfTI or Analyze image
 
-    img_data = img.get_fdata()
+    img_data = get_data(img, dtype = np.float64)
 
     # Apply Poisson noise to the image
     noisy_img_data = np.random.poisson(img_data * intensity_scaling_factor)
@@ -185,44 +273,183 @@ def add_poisson_noise(img, intensity_scaling_factor: float = 1.0):
 
     return noisy_img
 
-def create_mean_std_imgs(images):
-    """
-    This function creates the mean and standard deviation images for a list of images,
-    and saves them in nifti files.
+class RunningMeanStd:
+    """Streaming voxel-wise mean and standard deviation (Welford's algorithm).
+
+    Images are folded in one at a time, so memory does not depend on the number of
+    images. Accumulators built on different chunks of a cohort can be combined with
+    ``merge``. Statistics are accumulated in float64 and written as float32 images.
 
-    :param images: a list of strings (nifti files paths)
-    :param output_mean: the name of the nifti file that will contain the mean image
-    :param output_std: the name of the nifti file that will contain the standard deviation image
+    :param mask: optional mask (nibabel image or array); only voxels > 0 are accumulated
     """
 
-    sample_nii = images[0]
-    sample_data = sample_nii.get_fdata()
+    def __init__(self, mask = None):
+
+        self.mask = None
+        if mask is not None:
+            if hasattr(mask, "dataobj"):
+                mask_data = get_volume(mask)
+            else:
+                mask_data = np.asarray(mask)
+                if mask_data.ndim == 4:
+                    mask_data = mask_data[:, :, :, 0]
+            self.mask = mask_data > 0
+
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.affine = None
+        self.header = None
+        self.shape = None
+
+    def _values(self, img):
+
+        if type(img) is str:
+            img = nib.load(img)
+
+        # always a copy, the buffer is updated in place by add()
+        if hasattr(img, "dataobj"):
+            data = get_data(img, dtype = np.float64)
+        else:
+            data = np.array(img, dtype = np.float64)
+
+        if self.shape is None:
+            self.shape = data.shape
+            if hasattr(img, "affine"):
+                self.affine = img.affine
+                self.header = img.header.copy()
+        elif data.shape != self.shape:
+            raise ValueError(f"Image shape {data.shape} does not match the accumulated shape {self.shape}")
+
+        if self.mask is not None:
+            if self.mask.shape != data.shape[0:3]:
+                raise ValueError(f"Mask shape {self.mask.shape} does not match image shape {data.shape}")
+            data = data[self.mask]
+
+        return data
+
+    def add(self, img):
+        """Folds one image (nibabel image, path or array) into the accumulator."""
+
+        values = self._values(img)
+
+        if self.n == 0:
+            self.mean = values.copy()
+            self.m2 = np.zeros_like(values)
+            self.n = 1
+            return self
+
+        self.n += 1
+
+        delta = values - self.mean
+        self.mean += delta / self.n
+        # m2 += delta * (x - new mean), reusing the values buffer
+        np.subtract(values, self.mean, out = values)
+        values *= delta
+        self.m2 += values
+
+        return self
+
+    def merge(self, other):
+        """Combines the statistics of another accumulator into this one (Chan et al.)."""
+
+        if other.n == 0:
+            return self
+
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            self.shape, self.affine, self.header = other.shape, other.affine, other.header
+            return self
+
+        if other.shape != self.shape:
+            raise ValueError(f"Cannot merge accumulators of shapes {self.shape} and {other.shape}")
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+
+        self.mean += delta * (other.n / n)
+        self.m2 += other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+
+        return self
+
+    def variance(self, ddof = 0):
+        if self.n - ddof <= 0:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof = 0):
+        return np.sqrt(self.variance(ddof))
+
+    def _to_volume(self, values):
+
+        if self.mask is None:
+            return values.astype(np.float32)
+
+        volume = np.zeros(self.mask.shape + tuple(self.shape[3:]), dtype = np.float32)
+        volume[self.mask] = values
 
-    mean_data = sample_data * 0
-    std_data = sample_data * 0
+        return volume
 
-    data = sample_data[:, :, :, np.newaxis]
+    def to_images(self, ddof = 0):
+        """Mean and standard deviation as float32 NIfTI images (zero outside the mask)."""
 
-    for i in range(1, len(images)):
+        if self.n == 0:
+            raise ValueError("No images were added to the accumulator")
 
-        img_data = images[i].get_fdata()
-        img_data = img_data[:, :, :, np.newaxis]
-        data = np.append(data, img_data, axis = 3)
+        affine = self.affine if self.affine is not None else np.eye(4)
+        header = self.header.copy() if self.header is not None else None
+        if header is not None:
+            header.set_data_dtype(np.float32)
 
-    for i in range(sample_data.shape[0]):
-        for j in range(sample_data.shape[1]):
-            for k in range(sample_data.shape[2]):
-                values = data[i, j, k, :]
-                mean_val = np.mean(values)
-                std_val = np.std(values)
-                mean_data[i, j, k] = mean_val
-                std_data[i, j, k] = std_val
+        mean_img = nib.Nifti1Image(self._to_volume(self.mean), affine, header = header)
+        std_img = nib.Nifti1Image(self._to_volume(self.std(ddof)), affine, header = header)
 
-    mean_img = nib.Nifti1Image(mean_data, sample_nii.affine, header = sample_nii.header)
-    std_img = nib.Nifti1Image(std_data, sample_nii.affine, header = sample_nii.header)
+        return mean_img, std_img
 
-    return mean_img, std_img
 
+@instrumented
+def create_mean_std_imgs(images, mask = None, n_jobs = 1):
+    """
+    This function creates the mean and standard deviation images for a list of images.
+
+    The images are streamed through a RunningMeanStd accumulator, so memory does not
+    grow with the number of images. The standard deviation is the population one (as np.std).
+
+    :param images: a list of nibabel images or nifti file paths, or a CohortCube
+    :param mask: optional mask image, voxels outside it are set to 0 (a CohortCube uses its own mask)
+    :param n_jobs: number of chunks of the list accumulated in parallel threads and merged
+    :return: mean and standard deviation float32 nifti images
+    """
+
+    if isinstance(images, CohortCube):
+        mean_data = np.zeros(images.n_voxels, dtype = np.float32)
+        std_data = np.zeros(images.n_voxels, dtype = np.float32)
+        for voxels, block in images.iter_voxel_blocks():
+            mean_data[voxels] = block.mean(axis = 0, dtype = np.float64)
+            std_data[voxels] = block.std(axis = 0, dtype = np.float64)
+        return images.to_image(mean_data), images.to_image(std_data)
+
+    chunks = [images[i::n_jobs] for i in range(n_jobs)] if n_jobs > 1 else [images]
+
+    def accumulate(chunk):
+        accumulator = RunningMeanStd(mask)
+        for img in chunk:
+            accumulator.add(img)
+        return accumulator
+
+    if len(chunks) == 1:
+        total = accumulate(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+            partials = list(executor.map(accumulate, chunks))
+        total = RunningMeanStd(mask)
+        for partial in partials:
+            total.merge(partial)
+
+    return total.to_images()
+
+@instrumented
 def create_atlas_csv_from_normals_imgs(normals, atlas_df, atlas_img_):
 
     """This function creates a csv file with the mean and
@@ -235,23 +462,20 @@ def create_atlas_csv_from_normals_imgs(normals, atlas_df, atlas_img_):
     :param atlas_hdr: the name of the hdr file that contains the atlas image
     """
 
-    atlas_data = atlas_img_.get_fdata()
+    atlas_index = atlas_img_ if isinstance(atlas_img_, LabelIndex) else LabelIndex.from_image(atlas_img_)
 
-    for indx_, row_ in atlas_df.iterrows():
-        roi_num = row_["ROI_NUM"]
-        roi_name = row_["ROI_NAME"]
-        index_ = np.where(atlas_data == roi_num)
+    # (n_images, n_labels) ROI means, one pass per image
+    roi_values = atlas_index.reduce_many(normals, "mean")
+    positions = atlas_index.positions(atlas_df["ROI_NUM"].to_numpy())
 
-        roi_values = []
-
-        for img_ in normals:
-
-            img_data = img_.get_fdata()
-            value = np.mean(img_data[index_])
-            roi_values.append(value)
+    for (indx_, row_), pos in zip(atlas_df.iterrows(), positions):
+        roi_name = row_["ROI_NAME"]
 
-        roi_mean = np.mean(roi_values)
-        roi_std = np.std(roi_values)
+        if pos < 0:
+            roi_mean, roi_std = np.nan, np.nan
+        else:
+            roi_mean = np.mean(roi_values[:, pos])
+            roi_std = np.std(roi_values[:, pos])
 
         atlas_df.loc[indx_, "ROI_MEAN"] = roi_mean
         atlas_df.loc[indx_, "ROI_STD"] = roi_std
@@ -260,6 +484,7 @@ def create_atlas_csv_from_normals_imgs(normals, atlas_df, atlas_img_):
 
     return atlas_df
 
+@instrumented
 def transform_img_to_atlas_zscores(img_, atlas_df, atlas_img_):
     """This function transforms an image to atlas z-scores, based on an atlas csv and hdr file,
     and saves the output image in a nifti file.
@@ -270,27 +495,37 @@ def transform_img_to_atlas_zscores(img_, atlas_df, atlas_img_):
     :param atlas_hdr: the name of the hdr file that contains the atlas image
     """
 
-    atlas_data = atlas_img_.get_fdata()
-    pat_data = img_.get_fdata()
+    atlas_index = atlas_img_ if isinstance(atlas_img_, LabelIndex) else LabelIndex.from_image(atlas_img_)
+
+    roi_values = atlas_index.reduce(img_, "mean")
+    positions = atlas_index.positions(atlas_df["ROI_NUM"].to_numpy())
+    in_atlas = positions >= 0
 
-    pat_atlas = np.zeros(atlas_data.shape)
+    z_scores = np.zeros(atlas_index.n_labels)
+    z_scores[positions[in_atlas]] = ((roi_values[positions[in_atlas]] - atlas_df["ROI_MEAN"].to_numpy()[in_atlas])
+                                     / atlas_df["ROI_STD"].to_numpy()[in_atlas])
 
-    for indx, row in atlas_df.iterrows():
+    out_img = atlas_index.paint(z_scores)
 
-        roi_num = row["ROI_NUM"]
-        roi_mean = row["ROI_MEAN"]
-        roi_std = row["ROI_STD"]
+    return out_img
 
-        index_ = np.where(atlas_data == roi_num)
-        value = np.mean(pat_data[index_])
-        z_score = (value - roi_mean) / roi_std
-        pat_atlas[index_] = z_score
+def _fit_wilson_plot(args):
+    """Piecewise linear fit of one Wilson plot, returns the slope of the first segment
+    and the fitted line (x, y) used for plotting."""
 
-    out_img = nib.Nifti1Image(pat_atlas, atlas_img_.affine, header = atlas_img_.header)
+    k_squared, log_square_norm, n_segs = args
 
-    return out_img
+    model = pwlf.PiecewiseLinFit(k_squared, log_square_norm)
+    model.fit(n_segs)
 
-def estimate_fwhm_mizutani(nifti: str, bin_size: int = 5, n_segs: int = 2, orientation = "axial", plot = False):
+    x_pred = np.linspace(k_squared.min(), k_squared.max(), 100)
+    y_pred = model.predict(x_pred)
+
+    return model.slopes[0], (x_pred, y_pred)
+
+@instrumented
+def estimate_fwhm_mizutani(nifti: str, bin_size: int = 5, n_segs: int = 2, orientation = "axial", plot = False,
+                           n_jobs: int = None):
     
     """
     This function estimates image xy resolution based on a previous method
@@ -306,7 +541,7 @@ def estimate_fwhm_mizutani(nifti: str, bin_size: int = 5, n_segs: int = 2, orien
     domain(essentially from what is known as a Wilson plot).
     The lower frequencies in the Wilson plot are linearly fitted and the PSF is estimated from the slope.
 
-    :param nifti: input nifti image
+    :param nifti: input nifti image (path or nibabel image)
 
     :param bin_size:  In the original paper from Mizutani, the logarithm of the average squared norm in
     each  5 × 5 pixel bin of the Fourier transform was used. You can vary this to check what fits your data
@@ -314,15 +549,15 @@ def estimate_fwhm_mizutani(nifti: str, bin_size: int = 5, n_segs: int = 2, orien
     :param n_segs: the number of segments of the Fourier transform.
     :param orientation: plane to walk traverse the image (axial, sagittal, coronal).
     :param plot: If True, the function will plot the Wilson plots and fitted lines for quality check.
+    :param n_jobs: number of processes fitting the slices and of FFT threads (None for all the cores,
+        1 to run everything in this process on one core).
     :return: The average FWHM and sigma across all slices in the image.
     """
 
-    img = nib.load(nifti)
-    volume = img.get_fdata()
-    
+    img = nib.load(nifti) if type(nifti) is str else nifti
+    volume = get_data(img, dtype = np.float64)
+
     image_xy_size = np.abs(img.affine[0, 0])
-    fwhm_values = []
-    sigma_values = []
 
     if orientation == "axial":
         orient = 2
@@ -333,103 +568,79 @@ def estimate_fwhm_mizutani(nifti: str, bin_size: int = 5, n_segs: int = 2, orien
     else:
         raise ValueError("orientation must be set to axial, coronal or sagital")
 
-    for i in range(volume.shape[orient]):
-        if orientation == "axial":
-            slice_2d = volume[:, :, i]
-        elif orientation == "coronal":
-            slice_2d = volume[:, i, :]
-        elif orientation == "sagittal":
-            slice_2d = volume[i, :, :]
-        else:
-            raise TypeError("orientation must be set to axial, coronal or sagital")
-
-        # Compute the 2D Fourier transform of the input slice
-        fourier_slice = fftshift(fftn(slice_2d))
+    # (n_slices, rows, columns) stack of the slices in the requested orientation
+    slices = np.moveaxis(volume, orient, 0)
+    n_slices, n_rows, n_cols = slices.shape
 
-        # Compute the square norm of the Fourier transform
-        square_norm = np.abs(fourier_slice) ** 2
+    # 2D Fourier transform of every slice in one batched call
+    fourier_slices = np.fft.fftshift(fft2(slices, axes = (1, 2), workers = -1 if n_jobs is None else n_jobs),
+                                     axes = (1, 2))
 
-        # Calculate logarithm of the square norm
-        log_square_norm = np.log(square_norm + np.finfo(float).eps)
+    # Logarithm of the square norm of the Fourier transform
+    log_square_norm = np.log(np.abs(fourier_slices) ** 2 + np.finfo(float).eps)
+    del fourier_slices
 
-        # Calculate k^2 values (distances from the origin in Fourier domain)
-        k_values = np.array(
-                np.meshgrid(
-                        np.fft.fftshift(np.fft.fftfreq(slice_2d.shape[0])),
-                        np.fft.fftshift(np.fft.fftfreq(slice_2d.shape[1])),
-                        indexing = "ij",
-                        )
-                )
-        k_squared = np.sum(k_values ** 2, axis = 0)
-
-        # Calculate the number of bins along each axis
-        num_bins_x = slice_2d.shape[0] // bin_size
-        num_bins_y = slice_2d.shape[1] // bin_size
-
-        # Initialize binned arrays for the logarithm of the average squared norm and k^2 values
-        log_square_norm_binned = np.zeros((num_bins_x, num_bins_y))
-        k_squared_binned = np.zeros((num_bins_x, num_bins_y))
-
-        for x in range(num_bins_x):
-            for y in range(num_bins_y):
-                # Compute the average of log_square_norm and k_squared within the 5x5 bin
-                log_square_norm_binned[x, y] = np.mean(
-                        log_square_norm[
-                        x * bin_size: (x + 1) * bin_size,
-                        y * bin_size: (y + 1) * bin_size,
-                        ]
-                        )
-                k_squared_binned[x, y] = np.mean(
-                        k_squared[
-                        x * bin_size: (x + 1) * bin_size,
-                        y * bin_size: (y + 1) * bin_size,
-                        ]
-                        )
-
-        # Flatten the binned arrays and remove zero elements
-        k_squared_flat = k_squared_binned.flatten()
-        log_square_norm_flat = log_square_norm_binned.flatten()
-
-        non_zero_mask = k_squared_flat > 0
-        k_squared_flat = k_squared_flat[non_zero_mask]
-        log_square_norm_flat = log_square_norm_flat[non_zero_mask]
-
-        # Instantiate the piecewise linear regression model
-        model = pwlf.PiecewiseLinFit(k_squared_flat, log_square_norm_flat)
-
-        # Determine the optimal number of line segments
-        n_segments = n_segs
-        model.fit(n_segments)
-
-        # Predict the fitted line
-        x_pred = np.linspace(k_squared_flat.min(), k_squared_flat.max(), 100)
-        y_pred = model.predict(x_pred)
-
-        # Extract the slope and intercept of the fitted line
-        slope, intercept = model.slopes[0], model.intercepts[0]
-
-        # Calculate the width σ of the standard PSF
-        sigma = np.sqrt(-slope / (4 * np.pi ** 2))
-        sigma_values.append(sigma)
-
-        # Calculate the FWHM of the PSF
-        fwhm = 2 * np.sqrt(2 * np.log(2)) * sigma * image_xy_size
-        fwhm_values.append(fwhm)
-
-        if i == volume.shape[2] // 3 and plot:
-            # Plot the Wilson plot with the fitted line overlaid
-            plt.scatter(k_squared_flat, log_square_norm_flat, s = 1)
-            plt.plot(x_pred, y_pred, color = "black", linewidth = 1)
-            plt.xlabel("|k|^2")
-            plt.ylabel("ln|F(k)|^2")
-            plt.title("Wilson plot with fitted line")
-            plt.ylim(
-                    [np.min(log_square_norm_flat) - 5, np.max(log_square_norm_flat) + 5]
+    # k^2 values (distances from the origin in Fourier domain), the same for every slice
+    k_values = np.array(
+            np.meshgrid(
+                    np.fft.fftshift(np.fft.fftfreq(n_rows)),
+                    np.fft.fftshift(np.fft.fftfreq(n_cols)),
+                    indexing = "ij",
                     )
-            plt.show()
+            )
+    k_squared = np.sum(k_values ** 2, axis = 0)
+
+    # Average of each bin_size x bin_size bin, by reshaping the cropped arrays
+    num_bins_x = n_rows // bin_size
+    num_bins_y = n_cols // bin_size
+    crop_x = num_bins_x * bin_size
+    crop_y = num_bins_y * bin_size
+
+    log_square_norm_binned = log_square_norm[:, 0:crop_x, 0:crop_y].reshape(
+            n_slices, num_bins_x, bin_size, num_bins_y, bin_size).mean(axis = (2, 4))
+    k_squared_binned = k_squared[0:crop_x, 0:crop_y].reshape(
+            num_bins_x, bin_size, num_bins_y, bin_size).mean(axis = (1, 3))
+
+    # Flatten the binned arrays and remove zero elements
+    k_squared_flat = k_squared_binned.flatten()
+    non_zero_mask = k_squared_flat > 0
+    k_squared_flat = k_squared_flat[non_zero_mask]
+    log_square_norm_flat = log_square_norm_binned.reshape(n_slices, -1)[:, non_zero_mask]
+
+    # Piecewise linear fits of the Wilson plots, in parallel
+    fit_args = [(k_squared_flat, log_square_norm_flat[i], n_segs) for i in range(n_slices)]
+
+    if n_jobs == 1:
+        fits = [_fit_wilson_plot(args) for args in fit_args]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            fits = list(executor.map(_fit_wilson_plot, fit_args, chunksize = max(1, n_slices // 64)))
+
+    slopes = np.array([slope for slope, _ in fits])
+
+    # Calculate the width σ of the standard PSF
+    sigma_values = np.sqrt(-slopes / (4 * np.pi ** 2))
+
+    # Calculate the FWHM of the PSF
+    fwhm_values = 2 * np.sqrt(2 * np.log(2)) * sigma_values * image_xy_size
+
+    plot_slice = n_slices // 3
+    if plot:
+        # Plot the Wilson plot with the fitted line overlaid
+        x_pred, y_pred = fits[plot_slice][1]
+        plt.scatter(k_squared_flat, log_square_norm_flat[plot_slice], s = 1)
+        plt.plot(x_pred, y_pred, color = "black", linewidth = 1)
+        plt.xlabel("|k|^2")
+        plt.ylabel("ln|F(k)|^2")
+        plt.title("Wilson plot with fitted line")
+        plt.ylim(
+                [np.min(log_square_norm_flat[plot_slice]) - 5, np.max(log_square_norm_flat[plot_slice]) + 5]
+                )
+        plt.show()
 
     return np.nanmean(fwhm_values), np.nanmean(sigma_values)
 
+@instrumented
 def spm_map_2_cohens_d(img_path: str, out_path: str, len_1: int, len_2: int):
     """
     Converts an image of t_values to cohens_d
@@ -441,7 +652,7 @@ def spm_map_2_cohens_d(img_path: str, out_path: str, len_1: int, len_2: int):
 
     """
     img = nib.load(img_path)
-    data = img.get_fdata()
+    data = get_data(img, dtype = np.float64)
 
     d_coeff = np.sqrt(1 / len_1 + 1 / len_2)
     data = data * d_coeff
@@ -450,33 +661,26 @@ def spm_map_2_cohens_d(img_path: str, out_path: str, len_1: int, len_2: int):
 
     nib.save(cohens_img, out_path)
 
-def get_fdr_thresholds_from_spmt(img_, n1: int, n2: int):
+@instrumented
+def get_fdr_thresholds_from_spmt(img_, n1: int, n2: int, alpha = 0.05, method = "fdr_bh"):
     """
     :param img_: Path to spmT_0001.nii
     :param n1: len of group 1 in stat comparison
     :param n2: len of group 2 in stat comparison
-    :return: FDR-corrected Cohen's d threshold
+    :param alpha: FDR level
+    :param method: correction of multiple_comparisons.correct_pvalues, Benjamini-Hochberg by default
+    :return: FDR-corrected (two-tailed) t threshold and the corresponding Cohen's d threshold,
+        inf when no voxel survives
     """
-    # Load the NIFTI image
-    img_in = nib.load(img_)
-    data = img_in.get_fdata()
-
-    # Flatten the data to get a 1D array of t-values
-    t_values = data.flatten()
-    t_values = abs(np.unique(t_values[t_values != 0]))
-    t_values = np.sort(t_values)
-
-    df = n1 + n2 - 2
-    p_values = t.sf(abs(t_values), df=df)
-    indx = np.where(p_values < 0.05)
-    thresholded = t_values[indx]
-    t_thres = np.percentile(thresholded, 5)
+    # voxels different from 0 (the SPM analysis mask) are the tests
+    _, _, t_thres = correct_map(img_, "t", df = n1 + n2 - 2, method = method, alpha = alpha)
 
     d_coeff = np.sqrt(1 / n1 + 1 / n2)
     cohens_thres = t_thres * d_coeff
 
     return t_thres, cohens_thres
 
+@instrumented
 def get_tiv_from_cat12_xml_report(cat_xml_filepath: str):
     """parse the information from a list-like object of "cat_*.xml" filepaths to
     a list of dictionaries for more easy data handling"""
@@ -491,6 +695,7 @@ def get_tiv_from_cat12_xml_report(cat_xml_filepath: str):
         except KeyError:
             raise KeyError("Could not extract TIV")
 
+@instrumented
 def get_weighted_average_iqrs_from_cat12_xml_report(cat_xml_filepath: str):
     """Extract Weighted Average IQRS from dictionaries produced by _parse_xml_files_to_dict"""
 
@@ -1,6 +1,6 @@
 """
 I/O helpers for:
-  - CAT12 (segmentation scripts)
+  - CAT12 (segmentation scripts, report harvesting)
   - ADNI (data reordering, biomarker extraction, etc.)
   - Generic dcm→nii conversion (via dcm2niix)
   - SPM (coregistration, normalization, smoothing, design matrix, etc.)
@@ -10,6 +10,8 @@ from .cat12 import (
     generate_mfile_cat12_segmentation_crossec,
     generate_mfile_cat12_segmentation_longit,
     generate_mfile_cat12_new_tiv_model,
+    parse_cat12_xml_report,
+    harvest_cat12_reports,
 )
 from .adni import (
     reorder_ADNI_data,
@@ -39,6 +41,8 @@ __all__ = [
     'generate_mfile_cat12_segmentation_crossec',
     'generate_mfile_cat12_segmentation_longit',
     'generate_mfile_cat12_new_tiv_model',
+    'parse_cat12_xml_report',
+    'harvest_cat12_reports',
     # from adni.py
     'reorder_ADNI_data',
     'filter_ADNI_mri_csv',
@@ -1,6 +1,12 @@
 import os
-from os.path import join, exists
+import re
+import fnmatch
+import tempfile
+import xml.etree.ElementTree as ET
+from os.path import join, exists, basename, dirname
+from concurrent.futures import ThreadPoolExecutor
 import shutil
+import pandas as pd
 
 def generate_mfile_cat12_segmentation_crossec(spm_path: str, mfile_name: str,
                                               images_to_seg: list,
@@ -353,3 +359,162 @@ def generate_mfile_cat12_new_tiv_model(spm_path: str, mfile_name: str, save_dir:
     new_spm.write(design_type + "delete = 0;\n")
 
     new_spm.close()
+
+
+# order of the tissue classes in vol_abs_CGW / vol_rel_CGW
+CAT12_VOLUME_CLASSES = ("CSF", "GM", "WM", "WMH")
+
+# sections of a cat_*.xml report whose numeric fields become columns, with their prefix
+CAT12_REPORT_SECTIONS = {"subjectmeasures": "", "qualityratings": "qr_", "qualitymeasures": "qm_"}
+
+_IQR_PATTERN = re.compile(r"Image Quality Rating \(IQR\):\s*(\d+(?:\.\d+)?)%\s*\(([A-Z][-+]?)\)")
+_NUMBER_PATTERN = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?(?:Inf|NaN)", re.IGNORECASE)
+
+
+def _report_values(name, text):
+    """Columns of one numeric field: scalars as they are, matlab vectors one column per element."""
+
+    text = text or ""
+    numbers = _NUMBER_PATTERN.findall(text)
+
+    # anything else than numbers, brackets and separators is not a numeric field
+    if not numbers or _NUMBER_PATTERN.sub("", text).strip("[];, \n\t"):
+        return {}
+
+    values = [float(n) for n in numbers]
+
+    if len(values) == 1:
+        return {name: values[0]}
+
+    if name.endswith("_CGW"):
+        labels = [CAT12_VOLUME_CLASSES[i] if i < len(CAT12_VOLUME_CLASSES) else str(i) for i in range(len(values))]
+        return {f"{name[0:-3]}{label}": v for label, v in zip(labels, values)}
+
+    return {f"{name}_{i}": v for i, v in enumerate(values)}
+
+
+def parse_cat12_xml_report(cat_xml_filepath: str):
+    """Every subject and quality measure of a CAT12 report (cat_*.xml), in one streaming pass.
+
+    Fields of <subjectmeasures> keep their name (vol_TIV, vol_abs_GM, vol_rel_WMH, ...), those of
+    <qualityratings> and <qualitymeasures> are prefixed with qr_ and qm_. Vectors are split into one
+    column per element (tissue classes for the *_CGW volumes). The weighted average IQR of the
+    processing log is returned as catlog_IQR (percent) and catlog_IQR_grade.
+
+    :param cat_xml_filepath: path of the report
+    :return: dict of column name to float (catlog_IQR_grade is a str)
+    """
+    measures = {}
+    path = []
+
+    for event, element in ET.iterparse(cat_xml_filepath, events = ("start", "end")):
+
+        if event == "start":
+            path.append(element.tag)
+            continue
+
+        path.pop()
+
+        if len(path) == 2 and path[1] in CAT12_REPORT_SECTIONS:
+            # cell fields (e.g. dist_thickness) keep their values in <item> children
+            text = " ".join(element.itertext())
+            measures.update(_report_values(CAT12_REPORT_SECTIONS[path[1]] + element.tag, text))
+
+        elif len(path) == 2 and path[1] == "catlog" and element.text and "catlog_IQR" not in measures:
+            match = _IQR_PATTERN.search(element.text)
+            if match:
+                measures["catlog_IQR"] = float(match.group(1))
+                measures["catlog_IQR_grade"] = match.group(2)
+
+        if len(path) <= 2:
+            # finished sections and top-level fields are not needed any more
+            element.clear()
+
+    return measures
+
+
+def _find_cat12_reports(root, pattern):
+
+    reports = []
+    for directory, _, files in os.walk(root):
+        reports += [join(directory, f) for f in fnmatch.filter(files, pattern)]
+
+    return sorted(reports)
+
+
+def _read_table(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+
+
+def _parse_report_row(report):
+
+    stat = os.stat(report)
+    row = {"subject": basename(report)[4:-4] if basename(report).startswith("cat_") else basename(report)[0:-4],
+           "report": report, "mtime_ns": stat.st_mtime_ns, "status": "ok", "error": None}
+
+    try:
+        row.update(parse_cat12_xml_report(report))
+    except (ET.ParseError, OSError) as e:
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    return row
+
+
+def harvest_cat12_reports(root, output, pattern = "cat_*.xml", n_jobs = 8):
+    """Table of the measures of every CAT12 report under a derivatives tree.
+
+    Each report is parsed once (see ``parse_cat12_xml_report``) in a thread pool. When `output`
+    already exists it is used as the cache: reports whose modification time did not change are
+    not parsed again, and reports that were deleted are dropped from the table.
+
+    :param root: directory searched recursively for reports
+    :param output: table written, Parquet when it ends in .parquet (requires pyarrow), CSV otherwise
+    :param pattern: file name pattern of the reports
+    :param n_jobs: number of reports parsed at the same time
+    :return: pandas DataFrame with subject, report, mtime_ns, status, error and one float column per measure
+    """
+    reports = _find_cat12_reports(root, pattern)
+
+    previous = None
+    if exists(output):
+        previous = _read_table(output)
+        current = {r: os.stat(r).st_mtime_ns for r in reports}
+        unchanged = previous["report"].map(current).eq(previous["mtime_ns"]) & previous["status"].eq("ok")
+        previous = previous[unchanged]
+
+    to_parse = reports if previous is None else sorted(set(reports) - set(previous["report"]))
+
+    print(f"{len(reports)} reports found, {len(to_parse)} to parse")
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+        rows = list(executor.map(_parse_report_row, to_parse))
+
+    table = pd.DataFrame(rows)
+    if previous is not None:
+        table = pd.concat([previous, table], ignore_index = True) if rows else previous
+
+    id_columns = ["subject", "report", "mtime_ns", "status", "error"]
+    measure_columns = sorted(c for c in table.columns if c not in id_columns)
+
+    table = table.reindex(columns = id_columns + measure_columns)
+    table = table.sort_values("report").reset_index(drop = True)
+    table["mtime_ns"] = table["mtime_ns"].astype("int64")
+    table["error"] = table["error"].astype(object)
+    for column in measure_columns:
+        if column != "catlog_IQR_grade":
+            table[column] = pd.to_numeric(table[column], errors = "coerce").astype("float64")
+
+    for _, row in table[table["status"] == "failed"].iterrows():
+        print(f"{row['report']} failed: {row['error']}")
+
+    # written next to the output and moved, so an interrupted run keeps the previous table
+    fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", dir = dirname(os.path.abspath(output)))
+    os.close(fd)
+    if output.endswith(".parquet"):
+        table.to_parquet(tmp_path, index = False)
+    else:
+        table.to_csv(tmp_path, index = False)
+    os.replace(tmp_path, output)
+
+    return table
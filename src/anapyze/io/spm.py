@@ -169,8 +169,7 @@ def generate_mfile_new_deformations(spm_path, mfile_name,
                                     interpolation, prefix = "w"):
 
     if type(images_to_deform) is str:
-        # Do something
-        images_to_norm = [images_to_deform]
+        images_to_deform = [images_to_deform]
 
     new_spm = open(mfile_name, "w")
 
@@ -197,6 +196,10 @@ def generate_mfile_new_deformations(spm_path, mfile_name,
             + design_type_out + "pull.prefix ='" + prefix + "';\n"
             )
 
+    new_spm.write("spm('defaults','fmri');\n")
+    new_spm.write("spm_jobman('initcfg');\n")
+    new_spm.write("spm_jobman('run',matlabbatch);\n")
+
     new_spm.close()
 
 def generate_mfile_smooth_imgs(spm_path, mfile_name, images_to_smooth, smoothing):
@@ -282,7 +285,7 @@ def generate_mfile_model(spm_path, mfile_name,
         new_spm.write(design_type + "cov(2).c = [")
         for covar2 in group1_covar2:
             new_spm.write(str(covar2) + "\n")
-        for covar in group2_covar2:
+        for covar2 in group2_covar2:
             new_spm.write(str(covar2) + "\n")
         new_spm.write("];\n")
 
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname, join
+
+# the package lives in src/ (setup.py package_dir); make it importable without installing
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "src"))
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from anapyze.analysis import glm
+from anapyze.analysis.two_samples import run_2sample_anova_with_covariate_atlas
+
+sm = pytest.importorskip("statsmodels.api")
+
+
+def _cohort(root, n1 = 8, n2 = 9, shape = (8, 8, 6), n_labels = 6, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    atlas = rng.integers(0, n_labels + 1, shape).astype(np.int16)
+    atlas_path = os.path.join(root, "atlas.nii")
+    nib.save(nib.Nifti1Image(atlas, affine), atlas_path)
+
+    covariates = np.column_stack([rng.normal(70, 8, n1 + n2), rng.normal(1500, 120, n1 + n2)])
+    paths = []
+    for i in range(n1 + n2):
+        volume = rng.normal(size = shape) + 0.02 * covariates[i, 0] + 0.001 * covariates[i, 1]
+        volume[atlas == 1] += 0.8 * (i < n1)
+        paths.append(os.path.join(root, f"sub{i}.nii"))
+        nib.save(nib.Nifti1Image(volume.astype(np.float32), affine), paths[-1])
+
+    # reference ROI means, straight from the arrays
+    roi_values = np.array([[nib.load(p).get_fdata()[atlas == label].mean() for label in range(1, n_labels + 1)]
+                           for p in paths])
+
+    return atlas, atlas_path, paths[0:n1], paths[n1:], covariates[0:n1], covariates[n1:], roi_values
+
+
+def test_batched_ancova_matches_statsmodels(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    atlas, atlas_path, group1, group2, covar1, covar2, roi_values = _cohort(str(tmp_path))
+    n1, n2 = len(group1), len(group2)
+
+    out = tmp_path / "out"
+    out.mkdir()
+    run_2sample_anova_with_covariate_atlas(group1, group2, covar1, covar2, atlas_path, str(out), correction = None)
+
+    f_map = nib.load(str(out / "f_stat_group.nii")).get_fdata()
+    p_map = nib.load(str(out / "p_values_group.nii")).get_fdata()
+    d_map = nib.load(str(out / "cohens_d_group.nii")).get_fdata()
+
+    group = np.r_[np.zeros(n1), np.ones(n2)]
+    X = sm.add_constant(np.column_stack([group, np.vstack([covar1, covar2])]))
+
+    for label in range(1, roi_values.shape[1] + 1):
+        fit = sm.OLS(roi_values[:, label - 1], X).fit()
+        f_test = fit.f_test(np.r_[0, 1, 0, 0].reshape(1, -1))
+        f_val = float(np.squeeze(f_test.fvalue))
+
+        voxel = tuple(np.argwhere(atlas == label)[0])
+        # the maps are float32
+        assert f_map[voxel] == pytest.approx(f_val, rel = 1e-5)
+        assert p_map[voxel] == pytest.approx(float(np.squeeze(f_test.pvalue)), rel = 1e-5)
+        assert d_map[voxel] == pytest.approx(np.sqrt(f_val * (n1 + n2) / (n1 * n2)), rel = 1e-5)
+
+
+def test_batched_t_matches_statsmodels(tmp_path):
+
+    _, _, group1, group2, covar1, covar2, roi_values = _cohort(str(tmp_path))
+    n1, n2 = len(group1), len(group2)
+    covariates = np.vstack([covar1, covar2])
+
+    # every ROI with one solve
+    fit = glm.fit_glm(roi_values, glm.two_sample_design(n1, n2, covariates.T), np.r_[1, -1, 0, 0])
+
+    X = sm.add_constant(np.column_stack([np.r_[np.ones(n1), np.zeros(n2)], covariates]))
+    for roi in range(roi_values.shape[1]):
+        reference = sm.OLS(roi_values[:, roi], X).fit()
+        assert fit["t"][roi] == pytest.approx(reference.tvalues[1], rel = 1e-10)
+
+    assert fit["df"] == n1 + n2 - 4
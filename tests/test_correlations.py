@@ -0,0 +1,50 @@
+import warnings
+
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.stats import pearsonr, spearmanr
+
+from anapyze.analysis.correlations import voxel_wise_corr_images_vs_scale
+
+
+def _cohort(n_subjects = 14, shape = (6, 7, 5), seed = 0):
+
+    rng = np.random.default_rng(seed)
+    scale = rng.normal(25, 4, n_subjects).round()  # ties in the scale
+    data = rng.normal(size = (n_subjects,) + shape) + 0.1 * scale[:, None, None, None]
+    data[:, 0] = np.round(data[:, 0])  # ties in the voxel values
+    data[:, 1, 1, 1] = 3.0  # constant voxel
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    images = [nib.Nifti1Image(volume, affine) for volume in data]
+
+    mask = np.ones(shape, dtype = np.uint8)
+    mask[-1] = 0
+
+    return images, scale, nib.Nifti1Image(mask, affine), data
+
+
+@pytest.mark.parametrize("corr, reference", [("pearson", pearsonr), ("spearman", spearmanr)])
+def test_maps_match_scipy(corr, reference):
+
+    images, scale, mask, data = _cohort()
+
+    # tiny blocks, so the voxels are read in several slabs
+    r_img, p_img = voxel_wise_corr_images_vs_scale(images, scale, mask, corr = corr, max_block_mb = 0.001, n_jobs = 2)
+    r_map, p_map = r_img.get_fdata(), p_img.get_fdata()
+
+    assert r_img.get_data_dtype() == np.float64 and p_img.get_data_dtype() == np.float64
+
+    in_mask = mask.get_fdata() > 0
+    for voxel in zip(*np.nonzero(in_mask)):
+        if voxel == (1, 1, 1):
+            assert np.isnan(r_map[voxel])
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            r, p = reference(data[(slice(None),) + voxel], scale)
+        assert abs(r_map[voxel] - r) < 1e-12
+        assert abs(p_map[voxel] - p) < 1e-12
+
+    assert np.all(r_map[~in_mask] == 0) and np.all(p_map[~in_mask] == 0)
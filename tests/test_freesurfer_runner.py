@@ -0,0 +1,130 @@
+import os
+import sys
+import stat
+import pytest
+
+from anapyze.core import processor
+
+# Stub "recon-all": imports the T1 (mri/orig/001.mgz) when given -i and then acts on its content:
+# "fail" exits with an error, "hang" blocks, anything else finishes and writes scripts/recon-all.done.
+# The command line and thread settings are printed, so they end up in the subject log.
+FAKE_RECON_ALL = f"""#!{sys.executable}
+import os, sys, time
+
+args = sys.argv[1:]
+print("ARGS", " ".join(args))
+print("OMP_NUM_THREADS", os.environ.get("OMP_NUM_THREADS"))
+
+subject_dir = os.path.join(args[args.index("-sd") + 1], args[args.index("-s") + 1])
+orig = os.path.join(subject_dir, "mri", "orig", "001.mgz")
+scripts = os.path.join(subject_dir, "scripts")
+os.makedirs(scripts, exist_ok = True)
+
+if "-i" in args:
+    os.makedirs(os.path.dirname(orig), exist_ok = True)
+    with open(args[args.index("-i") + 1]) as src, open(orig, "w") as dst:
+        dst.write(src.read())
+
+content = open(orig).read()
+open(os.path.join(scripts, "IsRunning.lh+rh"), "w").close()
+
+if "hang" in content:
+    time.sleep(600)
+if "fail" in content:
+    open(os.path.join(scripts, "recon-all.error"), "w").close()
+    sys.exit(1)
+
+os.remove(os.path.join(scripts, "IsRunning.lh+rh"))
+open(os.path.join(scripts, "recon-all.done"), "w").close()
+"""
+
+
+@pytest.fixture
+def fake_recon_all(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "recon-all"
+    script.write_text(FAKE_RECON_ALL)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FREESURFER_HOME", str(tmp_path / "freesurfer"))
+    return script
+
+
+def make_cohort(root, subjects):
+    cohort = root / "cohort"
+    for subject, content in subjects.items():
+        (cohort / subject).mkdir(parents = True)
+        if content is not None:
+            (cohort / subject / "T1.nii").write_text(content)
+    return cohort
+
+
+def test_cohort_status_table(fake_recon_all, tmp_path):
+
+    cohort = make_cohort(tmp_path, {"sub01": "ok", "sub02": "fail", "sub03": None})
+    status_csv = tmp_path / "status.csv"
+
+    status = processor.recon_all_freesurfer_whole_cohort(str(cohort), {s: "T1.nii" for s in ["sub01", "sub02", "sub03"]},
+                                                         n_parallel = 2, n_cores = 4, status_csv = str(status_csv))
+
+    status = status.set_index("subject")
+    assert status.loc["sub01", "status"] == "done"
+    assert status.loc["sub02", "status"] == "failed"
+    assert status.loc["sub02", "returncode"] == 1
+    assert status.loc["sub03", "status"] == "missing_t1"
+    assert status_csv.exists()
+
+    # the core budget is split between the concurrent jobs
+    log = open(status.loc["sub01", "log"]).read()
+    assert "-openmp 2" in log
+    assert "OMP_NUM_THREADS 2" in log
+
+
+def test_finished_subjects_are_skipped_and_interrupted_ones_resumed(fake_recon_all, tmp_path):
+
+    cohort = make_cohort(tmp_path, {"sub01": "ok", "sub02": "fail"})
+    pats = {"sub01": "T1.nii", "sub02": "T1.nii"}
+
+    processor.recon_all_freesurfer_whole_cohort(str(cohort), pats, n_parallel = 1, n_cores = 1)
+
+    # the subject is fixed and the cohort run again
+    (cohort / "sub02" / "FS_out" / "mri" / "orig" / "001.mgz").write_text("ok")
+    status = processor.recon_all_freesurfer_whole_cohort(str(cohort), pats, n_parallel = 1, n_cores = 1)
+    status = status.set_index("subject")
+
+    assert status.loc["sub01", "status"] == "already_done"
+    assert status.loc["sub02", "status"] == "done"
+    assert status.loc["sub02", "mode"] == "resume"
+
+    scripts = cohort / "sub02" / "FS_out" / "scripts"
+    assert not (scripts / "recon-all.error").exists()
+    assert "-make all" in open(status.loc["sub02", "log"]).read()
+
+
+def test_timeout_is_in_seconds_and_kills_the_job(fake_recon_all, tmp_path):
+
+    cohort = make_cohort(tmp_path, {"sub01": "hang"})
+
+    status = processor.recon_all_freesurfer_whole_cohort(str(cohort), {"sub01": "T1.nii"}, n_parallel = 1,
+                                                         n_cores = 1, timeout = 1)
+
+    row = status.iloc[0]
+    assert row["status"] == "timeout"
+    assert row["minutes"] < 1
+
+
+def test_single_subject_runner(fake_recon_all, tmp_path):
+
+    cohort = make_cohort(tmp_path, {"sub01": "ok"})
+
+    assert processor.recon_all_freesurfer(str(cohort / "sub01" / "T1.nii"), n_threads = 3) == "done"
+    assert "-openmp 3" in open(cohort / "sub01" / "recon-all_FS_out.log").read()
+
+
+def test_empty_cohort_returns_an_empty_table(fake_recon_all, tmp_path):
+
+    status = processor.recon_all_freesurfer_whole_cohort(str(tmp_path), {})
+
+    assert len(status) == 0
+    assert "status" in status.columns
@@ -0,0 +1,190 @@
+import os
+import sys
+import stat
+import pytest
+
+from anapyze.core import matlab_pool, processor
+from anapyze.core.matlab_pool import MatlabPool, MatlabWorker, READY_TOKEN, DONE_TOKEN, FAILED_TOKEN, WORKER_NAME
+
+# Stub "matlab": speaks the worker protocol and acts on the content of the m-files it is sent.
+# "crash" in a job kills the process, "hang" blocks it and "error(" makes the job fail.
+# A file named fail_start next to the stub makes it exit before announcing itself.
+FAKE_MATLAB = f"""#!{sys.executable}
+import os, sys, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(here, "starts.log"), "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if os.path.exists(os.path.join(here, "fail_start")):
+    sys.exit(1)
+
+print("{READY_TOKEN}", flush = True)
+for line in sys.stdin:
+    cmd = line.strip()
+    if cmd == "EXIT":
+        break
+    elif cmd == "PING":
+        print("{READY_TOKEN}", flush = True)
+    elif cmd.startswith("RUN "):
+        job = open(cmd[4:]).read()
+        if "crash" in job:
+            sys.exit(1)
+        if "hang" in job:
+            time.sleep(600)
+        if "error(" in job:
+            print("{FAILED_TOKEN} job failed", flush = True)
+        else:
+            print("ran " + os.path.basename(cmd[4:]), flush = True)
+            print("{DONE_TOKEN}", flush = True)
+"""
+
+
+@pytest.fixture
+def fake_matlab(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "matlab"
+    script.write_text(FAKE_MATLAB)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    return bin_dir
+
+
+def write_job(directory, name, body):
+    path = directory / name
+    path.write_text(body)
+    return str(path)
+
+
+def starts(bin_dir):
+    return (bin_dir / "starts.log").read_text().splitlines()
+
+
+def test_start_launches_workers_in_batch_mode(fake_matlab):
+
+    with MatlabPool(n_workers = 2, matlab_cmd = "matlab", spm_path = "/opt/spm12") as pool:
+
+        assert len(pool.workers) == 2
+        assert all(worker.is_alive() for worker in pool.workers)
+        assert pool.health_check() == [True, True]
+
+        worker_file = os.path.join(pool._worker_dir, WORKER_NAME + ".m")
+        assert "spm_jobman('initcfg')" in open(worker_file).read()
+
+    lines = starts(fake_matlab)
+    assert len(lines) == 2
+    assert all(line.endswith("-batch " + WORKER_NAME) for line in lines)
+
+
+def test_run_returns_the_job_output(fake_matlab, tmp_path):
+
+    job = write_job(tmp_path, "job.m", "disp('hello');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        assert pool.run(job).strip() == "ran job.m"
+        assert pool.run(job).strip() == "ran job.m"
+
+    # the same process served both jobs
+    assert len(starts(fake_matlab)) == 1
+
+
+def test_failed_job_raises_and_keeps_the_worker(fake_matlab, tmp_path):
+
+    bad = write_job(tmp_path, "bad.m", "error('boom');")
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        with pytest.raises(Exception, match = "job failed"):
+            pool.run(bad)
+        assert pool.run(good).strip() == "ran good.m"
+        assert pool.workers[0].restarts == 0
+
+
+def test_timeout_kills_and_restarts_the_worker(fake_matlab, tmp_path):
+
+    hang = write_job(tmp_path, "hang.m", "hang")
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        with pytest.raises(Exception, match = "timeout"):
+            pool.run(hang, timeout = 1)
+
+        assert pool.workers[0].restarts == 1
+        assert pool.run(good).strip() == "ran good.m"
+
+    assert len(starts(fake_matlab)) == 2
+
+
+def test_crashed_worker_is_restarted(fake_matlab, tmp_path):
+
+    crash = write_job(tmp_path, "crash.m", "crash")
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        with pytest.raises(Exception, match = "crashed"):
+            pool.run(crash)
+
+        assert pool.run(good).strip() == "ran good.m"
+        assert pool.health_check() == [True]
+
+
+def test_worker_that_died_while_idle_is_restarted(fake_matlab, tmp_path):
+
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        pool.workers[0].kill()
+        assert pool.health_check() == [False]
+        pool.workers[0].kill()
+        assert pool.run(good).strip() == "ran good.m"
+        assert pool.workers[0].restarts == 2
+
+
+def test_worker_that_cannot_restart_is_replaced(fake_matlab, tmp_path, monkeypatch):
+
+    crash = write_job(tmp_path, "crash.m", "crash")
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        broken = pool.workers[0]
+
+        def failing_restart():
+            raise RuntimeError("restart failed")
+
+        monkeypatch.setattr(broken, "restart", failing_restart)
+
+        with pytest.raises(Exception, match = "crashed"):
+            pool.run(crash)
+
+        assert broken not in pool.workers
+        assert len(pool.workers) == 1
+        assert pool.run(good).strip() == "ran good.m"
+
+
+def test_pool_without_live_workers_raises_instead_of_blocking(fake_matlab, tmp_path):
+
+    crash = write_job(tmp_path, "crash.m", "crash")
+    good = write_job(tmp_path, "good.m", "disp('ok');")
+
+    with MatlabPool(n_workers = 1, matlab_cmd = "matlab") as pool:
+        (fake_matlab / "fail_start").write_text("")
+
+        with pytest.raises(RuntimeError, match = "did not start"):
+            pool.run(crash)
+
+        assert pool.workers == []
+        with pytest.raises(RuntimeError, match = "no live workers"):
+            pool.run(good)
+
+
+def test_run_matlab_command_uses_the_active_pool(fake_matlab, tmp_path):
+
+    job = write_job(tmp_path, "job.m", "disp('hello');")
+
+    matlab_pool.start_matlab_pool(n_workers = 1, matlab_cmd = "matlab")
+    try:
+        assert processor.run_matlab_command(job).strip() == "ran job.m"
+    finally:
+        matlab_pool.stop_matlab_pool()
+
+    assert matlab_pool.get_matlab_pool() is None
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from anapyze.core.multiple_comparisons import METHODS, correct_pvalues
+
+multitest = pytest.importorskip("statsmodels.stats.multitest")
+
+
+def _pvalues(seed = 0):
+
+    rng = np.random.default_rng(seed)
+    p = np.concatenate([rng.uniform(0, 0.002, 40), rng.uniform(size = 400)])
+    p[10:15] = p[3]  # ties
+    rng.shuffle(p)
+
+    return p
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_adjusted_pvalues_match_multipletests(method):
+
+    p = _pvalues()
+    reject, reference, _, _ = multitest.multipletests(p, alpha = 0.05, method = method)
+
+    adjusted, p_threshold = correct_pvalues(p, method, alpha = 0.05)
+
+    np.testing.assert_allclose(adjusted, reference, rtol = 1e-12, atol = 1e-15)
+    assert p_threshold == (p[reject].max() if reject.any() else 0.0)
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_nan_entries_are_not_tested(method):
+
+    p = _pvalues(seed = 1)
+    with_nan = np.insert(p, [0, 100, 200], np.nan).reshape(-1, 1)
+
+    adjusted, _ = correct_pvalues(with_nan, method)
+    _, reference, _, _ = multitest.multipletests(p, method = method)
+
+    assert adjusted.shape == with_nan.shape
+    assert np.isnan(adjusted[np.isnan(with_nan)]).all()
+    np.testing.assert_allclose(adjusted[~np.isnan(with_nan)], reference, rtol = 1e-12, atol = 1e-15)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from anapyze.analysis import glm
+from anapyze.analysis.permutation import permutation_test
+
+
+def _data(n1 = 7, n2 = 6, n_features = 25, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    ages = rng.normal(70, 8, n1 + n2)
+    X = glm.two_sample_design(n1, n2, [ages])
+    Y = rng.normal(size = (n1 + n2, n_features)) + 0.05 * ages[:, None]
+    Y[0:n1, 0:3] += 1.5
+
+    return X, Y
+
+
+def _permutations(n, n_permutations, block_size, seed):
+    """The permutations drawn by permutation_test: one generator per block, identity first."""
+
+    sizes = [min(block_size, n_permutations - start) for start in range(0, n_permutations, block_size)]
+    blocks = []
+    for seed_sequence, size in zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes):
+        rng = np.random.default_rng(seed_sequence)
+        blocks.append(np.vstack([rng.permutation(n) for _ in range(size)]))
+    permutations = np.vstack(blocks)
+    permutations[0] = np.arange(n)
+
+    return permutations
+
+
+def _brute_force(Y, X, C, permutations, stat):
+    """Freedman-Lane, one OLS refit of the whole design per permutation."""
+
+    n, p = X.shape
+    Z = X @ (np.eye(p) - np.linalg.pinv(C) @ C)
+    nuisance_fit = Z @ np.linalg.lstsq(Z, Y, rcond = None)[0]
+    residuals = Y - nuisance_fit
+
+    XtX_inv = np.linalg.pinv(X.T @ X)
+    df = n - np.linalg.matrix_rank(X)
+
+    stats = []
+    for permutation in permutations:
+        Y_perm = residuals[permutation] + nuisance_fit
+        beta = XtX_inv @ X.T @ Y_perm
+        sigma2 = np.sum((Y_perm - X @ beta) ** 2, axis = 0) / df
+        effect = C @ beta
+        if stat == "t":
+            stats.append(np.abs(effect[0]) / np.sqrt(sigma2 * (C @ XtX_inv @ C.T)[0, 0]))
+        else:
+            weights = np.linalg.inv(C @ XtX_inv @ C.T)
+            stats.append(np.einsum("kv,kl,lv->v", effect, weights, effect) / C.shape[0] / sigma2)
+
+    return np.array(stats)
+
+
+@pytest.mark.parametrize("stat, contrast", [("t", [[1, -1, 0]]), ("F", [[1, -1, 0], [0, 0, 1]])])
+def test_max_statistic_matches_brute_force(stat, contrast):
+
+    X, Y = _data()
+    C = np.array(contrast, dtype = np.float64)
+    n_permutations, block_size, seed = 300, 64, 11
+
+    result = permutation_test(Y, X, C, n_permutations = n_permutations, stat = stat, n_jobs = 1,
+                              seed = seed, block_size = block_size)
+
+    reference = _brute_force(Y, X, C, _permutations(len(Y), n_permutations, block_size, seed), stat)
+    observed = reference[0]
+    max_null = reference.max(axis = 1)
+
+    # the engine stores the residuals in float32
+    np.testing.assert_allclose(np.abs(result["stat"]) if stat == "t" else result["stat"], observed, rtol = 1e-5)
+    np.testing.assert_allclose(result["max_null"], max_null, rtol = 1e-5)
+
+    threshold = observed - 1e-6 * observed
+    np.testing.assert_array_equal(result["p_fwe"], (max_null[:, None] >= threshold).mean(axis = 0))
+    np.testing.assert_array_equal(result["p_uncorrected"], (reference >= threshold).mean(axis = 0))
+    assert result["df"] == len(Y) - 3
+
+
+def test_observed_t_matches_fit_glm():
+
+    X, Y = _data()
+
+    result = permutation_test(Y, X, "[1 -1 0]", n_permutations = 20, n_jobs = 1, seed = 0)
+
+    np.testing.assert_allclose(result["stat"], glm.fit_glm(Y, X, "[1 -1 0]")["t"], rtol = 1e-5)
+    assert np.all(result["p_fwe"] >= result["p_uncorrected"])
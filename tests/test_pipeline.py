@@ -0,0 +1,59 @@
+import os
+
+from anapyze.core.pipeline import Stage, Pipeline
+
+
+def _stage(root, name, after = (), fail = ()):
+
+    def func(subject):
+        if subject in fail:
+            raise RuntimeError(f"{name} failed")
+        open(os.path.join(root, f"{subject}_{name}"), "w").close()
+
+    return Stage(name, func, outputs = lambda subject: [os.path.join(root, f"{subject}_{name}")], after = after)
+
+
+def test_each_node_is_checked_once(tmp_path, monkeypatch):
+
+    checks = []
+    is_complete = Stage.is_complete
+
+    def counted(self, subject):
+        checks.append((subject, self.name))
+        return is_complete(self, subject)
+
+    monkeypatch.setattr(Stage, "is_complete", counted)
+
+    root = str(tmp_path)
+    names = [f"s{i}" for i in range(5)]
+    stages = [_stage(root, name, after = names[i - 1:i]) for i, name in enumerate(names)]
+    subjects = [f"sub{i}" for i in range(10)]
+
+    # sub0 is already processed: all its stages are skipped, the other subjects wait for a core
+    for name in names:
+        open(os.path.join(root, f"sub0_{name}"), "w").close()
+
+    report = Pipeline(stages).run(subjects, max_cpus = 1)
+
+    assert (report["status"] == "skipped").sum() == len(names)
+    assert (report["status"] == "done").sum() == len(names) * (len(subjects) - 1)
+    assert len(checks) == len(set(checks))
+    assert set(checks) >= {("sub0", name) for name in names} | {(subject, "s0") for subject in subjects}
+
+
+def test_failure_blocks_descendants_only(tmp_path):
+
+    root = str(tmp_path)
+    stages = [_stage(root, "a"), _stage(root, "b", after = "a", fail = ("sub1",)),
+              _stage(root, "c", after = "b"), _stage(root, "d", after = "a")]
+
+    report = Pipeline(stages).run(["sub0", "sub1"], max_cpus = 1)
+    status = {(s, n): st for s, n, st in zip(report["subject"], report["stage"], report["status"])}
+
+    assert status[("sub1", "b")] == "failed"
+    assert status[("sub1", "c")] == "blocked"
+    assert status[("sub1", "d")] == "done"
+    assert all(status[("sub0", name)] == "done" for name in "abcd")
+
+    rerun = Pipeline(stages).run(["sub0"], max_cpus = 1)
+    assert (rerun["status"] == "skipped").all()
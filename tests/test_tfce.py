@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from anapyze.analysis.tfce import mask_adjacency, tfce_scores
+
+
+def _map(shape = (12, 11, 10), seed = 0):
+
+    rng = np.random.default_rng(seed)
+    volume = ndimage.gaussian_filter(rng.normal(size = shape), 1.2) * 12
+    mask = ndimage.binary_erosion(np.ones(shape, dtype = bool), iterations = 1)
+    mask[0:4, 0:4, :] = False
+
+    return volume, mask
+
+
+def _brute_force(volume, mask, connectivity, E, H, dh):
+    """TFCE from scratch: label the map thresholded at every height."""
+
+    structure = ndimage.generate_binary_structure(3, {6: 1, 18: 2, 26: 3}[connectivity])
+    scores = np.zeros(volume.shape)
+
+    for step in range(1, int(volume[mask].max() / dh) + 1):
+        h = step * dh
+        labels, _ = ndimage.label((volume >= h) & mask, structure = structure)
+        sizes = np.bincount(labels.ravel())
+        above = labels > 0
+        scores[above] += sizes[labels[above]] ** E * h ** H * dh
+
+    return scores[mask]
+
+
+@pytest.mark.parametrize("connectivity", [6, 18, 26])
+def test_tfce_matches_per_threshold_labelling(connectivity):
+
+    volume, mask = _map()
+    edges = mask_adjacency(mask, connectivity)
+
+    # heights on the dh grid, away from the step boundaries
+    dh = 0.25
+    volume = (np.floor(volume / dh) + 0.5) * dh
+
+    scores = tfce_scores(volume[mask], edges, E = 0.5, H = 2.0, dh = dh)
+
+    np.testing.assert_allclose(scores, _brute_force(volume, mask, connectivity, 0.5, 2.0, dh), rtol = 1e-10)
+
+
+def test_two_sided_enhances_the_negative_part():
+
+    volume, mask = _map(seed = 1)
+    edges = mask_adjacency(mask, 26)
+
+    dh = 0.2
+    volume = (np.floor(volume / dh) + 0.5) * dh
+
+    scores = tfce_scores(volume[mask], edges, E = 0.6, H = 1.8, dh = dh, two_sided = True)
+    expected = (_brute_force(volume, mask, 26, 0.6, 1.8, dh) - _brute_force(-volume, mask, 26, 0.6, 1.8, dh))
+
+    np.testing.assert_allclose(scores, expected, rtol = 1e-10, atol = 1e-10)
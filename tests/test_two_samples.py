@@ -0,0 +1,24 @@
+import os
+
+from anapyze.analysis import two_samples
+from anapyze.core import processor
+
+
+def test_cat12_spm_backend_runs_model_estimate_and_results(tmp_path, monkeypatch):
+
+    ran = []
+    monkeypatch.setattr(processor, "run_matlab_command", lambda mfile, *args, **kwargs: ran.append(mfile))
+    monkeypatch.setattr(two_samples.utils, "spm_map_2_cohens_d", lambda *args, **kwargs: None)
+    monkeypatch.setattr(two_samples.utils, "get_fdr_thresholds_from_spmt", lambda *args, **kwargs: (None, None))
+
+    save_dir = str(tmp_path / "cat12")
+    two_samples.run_2sample_ttest_cat12_new_tiv_model("/opt/spm12", save_dir,
+                                                      ["a1.nii", "a2.nii"], ["b1.nii", "b2.nii"],
+                                                      [60, 61], [62, 63], [1500, 1510], [1520, 1530], mask = "mask.nii")
+
+    assert [os.path.basename(mfile) for mfile in ran] == ["model_cat12.m", "estimate.m", "results.m"]
+    for mfile in ran:
+        assert os.path.getsize(mfile) > 0
+
+    model = open(os.path.join(save_dir, "model_cat12.m")).read()
+    assert "b2.nii" in model and "1530" in model